@@ -1,11 +1,12 @@
 import json
 import os
+import signal
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from kafka import KafkaConsumer
 from kafka import KafkaProducer
-from kafka.errors import KafkaTimeoutError
 
 from spider.util import logger
 from spider.conf import init_observe_meta_config
@@ -13,20 +14,43 @@ from spider.conf.observe_meta import ObserveMetaMgt
 from cause_inference.config import infer_config
 from cause_inference.config import init_infer_config
 from cause_inference.cause_infer import cause_locating
+from cause_inference.cause_infer import incident_cause_locating
+from cause_inference.cause_infer import init_metric_db_mgt
+from cause_inference.cause_infer import init_topo_db_mgt
 from cause_inference.rule_parser import rule_engine
+from cause_inference.exceptions import ConfigException
 from cause_inference.exceptions import InferenceException
 from cause_inference.exceptions import NoKpiEventException
 from cause_inference.abnormal_event import AbnEvtMgt
+from cause_inference.abnormal_event import MetricEvtConsumeThread
+from cause_inference.evt_consumer import EvtConsumeThread
+from cause_inference.evt_consumer import TimeSeekReader
+from cause_inference.evt_consumer import OffsetRestoreListener
+from cause_inference.evt_consumer import DEFAULT_MAX_RECORDS, DEFAULT_QUEUE_SIZE, DEFAULT_SEEK_WORKERS
 from cause_inference.output import gen_cause_msg
+from cause_inference.cause_sender import CauseSender
+from cause_inference.cause_sender import DEFAULT_LINGER_MS, DEFAULT_BATCH_SIZE, DEFAULT_COMPRESSION_TYPE
+from cause_inference.cause_sender import DEFAULT_MAX_OUTSTANDING, DEFAULT_SEND_TIMEOUT
 from cause_inference.cause_keyword import cause_keyword_mgt
+from cause_inference.arangodb import connect_to_arangodb
+from cause_inference.db_mgt import ArangodbMgt
+from cause_inference.db_mgt import PromMgt
+from cause_inference.prefetch import HistPrefetcher
+from cause_inference.result_cache import result_cache
+from cause_inference.snapshot import ObsvMetaRecorder, SnapshotThread
+from cause_inference.snapshot import evt_from_dict, get_snapshot_offsets, load_snapshot
+from cause_inference.partition import MachinePartition
+from cause_inference.inproc_kafka import InprocConsumer, InprocProducer, is_inproc_server
+from cause_inference.skeleton import SkeletonWarmThread
+from cause_inference.skeleton import skeleton_cache
 
 INFER_CONFIG_PATH = '/etc/gala-inference/gala-inference.yaml'
 EXT_OBSV_META_PATH = '/etc/gala-inference/ext-observe-meta.yaml'
 RULE_META_PATH = '/etc/gala-inference/infer-rule.yaml'
+# 主循环检查停止标志的周期，单位：秒
+STOP_CHECK_SEC = 1
 CAUSE_KEYWORD_PATH = '/etc/gala-inference/cause-keyword.yaml'
 
-ABN_KPI_POLL_INTERVAL_SEC = 30
-
 
 def init_config():
     conf_path = os.environ.get('INFER_CONFIG_PATH') or INFER_CONFIG_PATH
@@ -53,7 +77,7 @@ def init_config():
 
 
 class ObsvMetaCollThread(threading.Thread):
-    def __init__(self, observe_meta_mgt: ObserveMetaMgt, metadata_consumer):
+    def __init__(self, observe_meta_mgt: ObsvMetaRecorder, metadata_consumer):
         super().__init__()
         self.observe_meta_mgt = observe_meta_mgt
         self.metadata_consumer = metadata_consumer
@@ -73,6 +97,18 @@ def config_kafka_sasl_plaintext(conf):
     conf['sasl_plain_password'] = infer_config.kafka_conf.get("password")
 
 
+def new_kafka_consumer(*topics, **conf):
+    if is_inproc_server(conf.get('bootstrap_servers')):
+        return InprocConsumer(*topics, **conf)
+    return KafkaConsumer(*topics, **conf)
+
+
+def new_kafka_producer(**conf):
+    if is_inproc_server(conf.get('bootstrap_servers')):
+        return InprocProducer(**conf)
+    return KafkaProducer(**conf)
+
+
 def init_metadata_consumer():
     metadata_topic = infer_config.kafka_conf.get('metadata_topic')
     conf = {
@@ -81,120 +117,306 @@ def init_metadata_consumer():
     }
     if infer_config.kafka_conf.get('auth_type') == 'sasl_plaintext':
         config_kafka_sasl_plaintext(conf)
-    metadata_consumer = KafkaConsumer(
+    metadata_consumer = new_kafka_consumer(
         metadata_topic.get('topic_id'),
         **conf
     )
     return metadata_consumer
 
 
-def init_kpi_consumer():
-    kpi_kafka_conf = infer_config.kafka_conf.get('abnormal_kpi_topic')
+def init_evt_consume_thd(topic_conf_name, offsets=None, group_id=None):
+    topic_conf = infer_config.kafka_conf.get(topic_conf_name)
     conf = {
         "bootstrap_servers": [infer_config.kafka_conf.get('server')],
-        "group_id": kpi_kafka_conf.get('group_id'),
-        "consumer_timeout_ms": kpi_kafka_conf.get('consumer_to') * 1000
+        "group_id": group_id or topic_conf.get('group_id')
     }
     if infer_config.kafka_conf.get('auth_type') == 'sasl_plaintext':
         config_kafka_sasl_plaintext(conf)
-    kpi_consumer = KafkaConsumer(
-        kpi_kafka_conf.get('topic_id'),
-        **conf
-    )
-    return kpi_consumer
+    if offsets:
+        # 从状态快照中保存的位移继续消费
+        consumer = new_kafka_consumer(**conf)
+        consumer.subscribe([topic_conf.get('topic_id')], listener=OffsetRestoreListener(consumer, offsets))
+    else:
+        consumer = new_kafka_consumer(
+            topic_conf.get('topic_id'),
+            **conf
+        )
+    consume_thread = EvtConsumeThread(consumer, topic_conf.get('topic_id'), topic_conf.get('consumer_to'),
+                                      max_records=topic_conf.get('max_records', DEFAULT_MAX_RECORDS),
+                                      queue_size=topic_conf.get('queue_size', DEFAULT_QUEUE_SIZE),
+                                      codec=infer_config.kafka_conf.get('json_codec'),
+                                      stats_interval=infer_config.kafka_conf.get('stats_interval'))
+    consume_thread.setDaemon(True)
+    return consume_thread
+
+
+def init_kpi_consumer(offsets=None):
+    return init_evt_consume_thd('abnormal_kpi_topic', offsets)
+
+
+def init_metric_consumer(offsets=None, partition: MachinePartition = None):
+    group_id = infer_config.kafka_conf.get('abnormal_metric_topic').get('group_id')
+    if partition is not None:
+        group_id = partition.get_group_id(group_id)
+    return init_evt_consume_thd('abnormal_metric_topic', offsets, group_id)
 
 
-def init_metric_consumer():
-    metric_kafka_conf = infer_config.kafka_conf.get('abnormal_metric_topic')
+def init_cause_producer():
+    infer_kafka_conf = infer_config.kafka_conf.get('inference_topic')
     conf = {
         "bootstrap_servers": [infer_config.kafka_conf.get('server')],
-        "group_id": metric_kafka_conf.get('group_id'),
-        "consumer_timeout_ms": metric_kafka_conf.get('consumer_to') * 1000
+        "linger_ms": infer_kafka_conf.get('linger_ms', DEFAULT_LINGER_MS),
+        "batch_size": infer_kafka_conf.get('batch_size', DEFAULT_BATCH_SIZE),
+        "compression_type": infer_kafka_conf.get('compression_type', DEFAULT_COMPRESSION_TYPE) or None
     }
     if infer_config.kafka_conf.get('auth_type') == 'sasl_plaintext':
         config_kafka_sasl_plaintext(conf)
-    metric_consumer = KafkaConsumer(
-        metric_kafka_conf.get('topic_id'),
-        **conf
-    )
-    return metric_consumer
+    cause_producer = new_kafka_producer(**conf)
+   
+    return cause_producer
 
 
-def init_cause_producer():
+def init_cause_sender():
+    infer_kafka_conf = infer_config.kafka_conf.get('inference_topic')
+    return CauseSender(init_cause_producer(), infer_kafka_conf.get('topic_id'),
+                       max_outstanding=infer_kafka_conf.get('max_outstanding', DEFAULT_MAX_OUTSTANDING),
+                       send_timeout=infer_kafka_conf.get('send_timeout', DEFAULT_SEND_TIMEOUT))
+
+
+def init_metric_seek_reader():
+    metric_kafka_conf = infer_config.kafka_conf.get('abnormal_metric_topic')
     conf = {
-        "bootstrap_servers": [infer_config.kafka_conf.get('server')]
+        "bootstrap_servers": [infer_config.kafka_conf.get('server')],
+        "enable_auto_commit": False
     }
     if infer_config.kafka_conf.get('auth_type') == 'sasl_plaintext':
         config_kafka_sasl_plaintext(conf)
-    cause_producer = KafkaProducer(**conf)
-   
-    return cause_producer
-
-
-def init_abn_evt_mgt():
-    kpi_consumer = init_kpi_consumer()
-    metric_consumer = init_metric_consumer()
+    return TimeSeekReader(lambda: new_kafka_consumer(**conf), metric_kafka_conf.get('topic_id'),
+                          metric_kafka_conf.get('consumer_to'),
+                          max_records=metric_kafka_conf.get('max_records', DEFAULT_MAX_RECORDS),
+                          workers=metric_kafka_conf.get('seek_workers', DEFAULT_SEEK_WORKERS),
+                          codec=infer_config.kafka_conf.get('json_codec'))
+
+
+def init_abn_evt_mgt(state: dict, partition: MachinePartition):
+    kafka_conf = infer_config.kafka_conf
+    kpi_consumer = init_kpi_consumer(get_snapshot_offsets(state, kafka_conf.get('abnormal_kpi_topic').get('topic_id')))
+    kpi_consumer.start()
+    metric_consumer = None
+    metric_seek_reader = None
+    foreign_seek_reader = None
+    metric_topic_conf = kafka_conf.get('abnormal_metric_topic')
+    if metric_topic_conf.get('seek_by_time'):
+        metric_seek_reader = init_metric_seek_reader()
+    else:
+        metric_consumer = init_metric_consumer(get_snapshot_offsets(state, metric_topic_conf.get('topic_id')),
+                                               partition)
+        metric_consumer.start()
+        if partition.is_partitioned():
+            foreign_seek_reader = init_metric_seek_reader()
     valid_duration = infer_config.infer_conf.get('evt_valid_duration')
     future_duration = infer_config.infer_conf.get('evt_future_duration')
     aging_duration = infer_config.infer_conf.get('evt_aging_duration')
     abn_evt_mgt = AbnEvtMgt(kpi_consumer, metric_consumer, valid_duration=valid_duration,
-                            aging_duration=aging_duration, future_duration=future_duration)
+                            aging_duration=aging_duration, future_duration=future_duration,
+                            metric_seek_reader=metric_seek_reader,
+                            incident_window=infer_config.infer_conf.get('incident_window'),
+                            partition=partition, foreign_seek_reader=foreign_seek_reader)
+    abn_evt_mgt.restore([evt_from_dict(evt) for evt in state.get('abnormal_events', [])],
+                        [evt_from_dict(evt) for evt in state.get('pending_kpis', [])])
     return abn_evt_mgt
 
 
-def init_obsv_meta_coll_thd():
-    obsv_meta_mgt = ObserveMetaMgt()
+def load_state_snapshot() -> dict:
+    infer_conf = infer_config.infer_conf
+    state = load_snapshot(infer_conf.get('snapshot_path'))
+    if state is None:
+        return {}
+    # 快照过旧时，其中的异常事件均已老化，从快照位移开始消费的消息也已老化，只恢复观测元数据
+    if int(time.time() * 1000) - state.get('timestamp', 0) > infer_conf.get('evt_aging_duration') * 1000:
+        logger.logger.info('State snapshot is too old, only observe metadata is restored.')
+        return {'metadata': state.get('metadata', [])}
+    return state
+
+
+def init_obsv_meta_coll_thd(obsv_meta_recorder: ObsvMetaRecorder):
     metadata_consumer = init_metadata_consumer()
-    obsv_meta_coll_thread = ObsvMetaCollThread(obsv_meta_mgt, metadata_consumer)
+    obsv_meta_coll_thread = ObsvMetaCollThread(obsv_meta_recorder, metadata_consumer)
     obsv_meta_coll_thread.setDaemon(True)
     return obsv_meta_coll_thread
 
 
-def send_cause_event(cause_producer: KafkaProducer, cause_msg):
-    logger.logger.debug(json.dumps(cause_msg, indent=2))
+def init_skeleton_warm_thd():
+    infer_conf = infer_config.infer_conf
+    arango_conf = infer_config.arango_conf
+    try:
+        arango_db = connect_to_arangodb(arango_conf.get('url'), arango_conf.get('db_name'))
+    except InferenceException as ex:
+        logger.logger.warning('Causal skeleton warming disabled, because {}'.format(ex))
+        return None
+    skeleton_cache.max_topo_num = infer_conf.get('warm_topo_num')
+    arango_db_mgt = ArangodbMgt(arango_db, infer_conf.get('topo_depth'), arango_conf.get('batch_size'))
+    skeleton_warm_thread = SkeletonWarmThread(arango_db_mgt, skeleton_cache, infer_conf.get('warm_interval'))
+    skeleton_warm_thread.setDaemon(True)
+    return skeleton_warm_thread
+
+
+def init_db_mgts():
+    try:
+        return init_topo_db_mgt(), init_metric_db_mgt()
+    except InferenceException as ex:
+        logger.logger.warning('Shared database connections unavailable, connect per event, because {}'.format(ex))
+        return None, None
+
+
+def init_hist_prefetcher(metric_db_mgt):
+    infer_conf = infer_config.infer_conf
+    if not infer_conf.get('hist_prefetch') or not isinstance(metric_db_mgt, PromMgt):
+        return None
+    hist_prefetcher = HistPrefetcher(metric_db_mgt,
+                                     workers=infer_conf.get('prefetch_workers'),
+                                     safe_lag=infer_conf.get('prefetch_safe_lag'),
+                                     max_metrics=infer_conf.get('prefetch_max_metrics'),
+                                     aging_duration=infer_conf.get('evt_aging_duration'))
+    metric_db_mgt.hist_prefetcher = hist_prefetcher
+    return hist_prefetcher
+
+
+def infer_and_send(cause_sender: CauseSender, abn_kpi, abn_metrics, topo_db_mgt, metric_db_mgt,
+                   foreign_evt_loader=None):
+    logger.logger.debug('Abnormal kpi is: {}'.format(abn_kpi))
+    logger.logger.debug('Abnormal metrics are: {}'.format(abn_metrics))
 
-    infer_kafka_conf = infer_config.kafka_conf.get('inference_topic')
     try:
-        cause_producer.send(infer_kafka_conf.get('topic_id'), json.dumps(cause_msg).encode())
-    except KafkaTimeoutError as ex:
-        logger.logger.error(ex)
+        cause_res = cause_locating(abn_kpi, abn_metrics, topo_db_mgt, metric_db_mgt, foreign_evt_loader)
+    except InferenceException as ie:
+        logger.logger.warning('{}, event_id={}'.format(ie, abn_kpi.event_id))
+        return
+    if not cause_res:
+        logger.logger.info('No cause detected, event_id={}'.format(abn_kpi.event_id))
         return
-    logger.logger.info('A cause inferring event has been sent to kafka.')
+    cause_msg = gen_cause_msg(abn_kpi, cause_res)
+    cause_sender.send(cause_msg)
+
+
+def infer_incident_and_send(cause_sender: CauseSender, abn_kpis, abn_metrics, topo_db_mgt, metric_db_mgt,
+                            foreign_evt_loader=None):
+    logger.logger.debug('Abnormal kpis are: {}'.format(abn_kpis))
+    logger.logger.debug('Abnormal metrics are: {}'.format(abn_metrics))
+
+    for abn_kpi, cause_res in incident_cause_locating(abn_kpis, abn_metrics, topo_db_mgt, metric_db_mgt,
+                                                      foreign_evt_loader):
+        if not cause_res:
+            logger.logger.info('No cause detected, event_id={}'.format(abn_kpi.event_id))
+            continue
+        cause_sender.send(gen_cause_msg(abn_kpi, cause_res))
+
+
+class InferWorkerPool:
+    """
+    并发处理多个异常KPI事件的根因定位，各工作线程共享数据库连接和缓存，结果按完成顺序输出。
+    待处理的事件数超过上限时，提交操作阻塞，避免事件无限堆积。
+    """
+    def __init__(self, workers, handler):
+        self.workers = max(workers, 1)
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='infer-worker')
+        self.slots = threading.BoundedSemaphore(self.workers * 2)
+
+    def submit(self, event_id, *args):
+        self.slots.acquire()
+        future = self.executor.submit(self.handler, *args)
+        future.add_done_callback(lambda f: self._on_done(f, event_id))
+
+    def shutdown(self):
+        """等待已提交的根因定位任务全部完成"""
+        self.executor.shutdown(wait=True)
+
+    def _on_done(self, future, event_id):
+        self.slots.release()
+        ex = future.exception()
+        if ex is not None:
+            logger.logger.error('Cause inference failed, event_id={}, because {}'.format(event_id, ex))
 
 
 def main():
     if not init_config():
         return
     logger.logger.info('Start cause inference service...')
+    try:
+        partition = MachinePartition(infer_config.infer_conf.get('partition_count'),
+                                     infer_config.infer_conf.get('partition_index'))
+    except ConfigException as ex:
+        logger.logger.error(ex)
+        return
 
-    cause_producer = init_cause_producer()
-    abn_evt_mgt = init_abn_evt_mgt()
-
-    obsv_meta_coll_thread = init_obsv_meta_coll_thd()
+    cause_sender = init_cause_sender()
+    state = load_state_snapshot()
+    obsv_meta_recorder = ObsvMetaRecorder(ObserveMetaMgt())
+    obsv_meta_recorder.restore(state.get('metadata', []))
+    abn_evt_mgt = init_abn_evt_mgt(state, partition)
+    if abn_evt_mgt.metric_consumer is not None:
+        metric_evt_consume_thread = MetricEvtConsumeThread(abn_evt_mgt)
+        metric_evt_consume_thread.setDaemon(True)
+        metric_evt_consume_thread.start()
+
+    obsv_meta_coll_thread = init_obsv_meta_coll_thd(obsv_meta_recorder)
     obsv_meta_coll_thread.start()
-    time.sleep(5)
-
-    while True:
-        logger.logger.info('Start consuming abnormal kpi event...')
+    if infer_config.infer_conf.get('snapshot_path'):
+        snapshot_thread = SnapshotThread(infer_config.infer_conf.get('snapshot_path'),
+                                         infer_config.infer_conf.get('snapshot_interval'),
+                                         abn_evt_mgt, obsv_meta_recorder)
+        snapshot_thread.setDaemon(True)
+        snapshot_thread.start()
+    if not state.get('metadata'):
+        # 没有从快照中恢复观测元数据时，等待元数据消息到达
+        time.sleep(5)
+    # 因果骨架中的拓扑节点按观测元数据投影字段，等待元数据恢复或到达后再开始预热
+    if infer_config.infer_conf.get('warm_skeleton'):
+        skeleton_warm_thread = init_skeleton_warm_thd()
+        if skeleton_warm_thread is not None:
+            skeleton_warm_thread.start()
+
+    result_cache.ttl = infer_config.infer_conf.get('result_cache_ttl')
+    result_cache.report_interval = infer_config.kafka_conf.get('stats_interval')
+    topo_db_mgt, metric_db_mgt = init_db_mgts()
+    abn_evt_mgt.hist_prefetcher = init_hist_prefetcher(metric_db_mgt)
+    incident_window = infer_config.infer_conf.get('incident_window')
+    if incident_window:
+        handler = infer_incident_and_send
+    else:
+        handler = infer_and_send
+    worker_pool = InferWorkerPool(infer_config.infer_conf.get('infer_workers'),
+                                  lambda abn_kpi, abn_metrics, foreign_evt_loader: handler(
+                                      cause_sender, abn_kpi, abn_metrics, topo_db_mgt, metric_db_mgt,
+                                      foreign_evt_loader))
+
+    # 收到终止信号后只设置停止标志，主循环退出后等待进行中的根因定位完成，再发送所有缓存的根因定位结果消息
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    infer_loop(abn_evt_mgt, worker_pool, incident_window, stop_event)
+    logger.logger.info('Stop cause inference service, wait for running inferences...')
+    worker_pool.shutdown()
+    cause_sender.close()
+
+
+def infer_loop(abn_evt_mgt: AbnEvtMgt, worker_pool: InferWorkerPool, incident_window, stop_event: threading.Event):
+    logger.logger.info('Start consuming abnormal kpi event...')
+    while not stop_event.is_set():
         try:
-            abn_kpi, abn_metrics = abn_evt_mgt.get_abnormal_info()
+            if incident_window:
+                abn_kpis, abn_metrics = abn_evt_mgt.get_abnormal_incident()
+                foreign_evt_loader = abn_evt_mgt.get_foreign_evt_loader(min(abn_kpi.timestamp for abn_kpi in abn_kpis),
+                                                                        max(abn_kpi.timestamp for abn_kpi in abn_kpis))
+                worker_pool.submit(','.join(abn_kpi.event_id for abn_kpi in abn_kpis), abn_kpis, abn_metrics,
+                                   foreign_evt_loader)
+            else:
+                abn_kpi, abn_metrics = abn_evt_mgt.get_abnormal_info()
+                foreign_evt_loader = abn_evt_mgt.get_foreign_evt_loader(abn_kpi.timestamp, abn_kpi.timestamp)
+                worker_pool.submit(abn_kpi.event_id, abn_kpi, abn_metrics, foreign_evt_loader)
         except NoKpiEventException:
-            time.sleep(ABN_KPI_POLL_INTERVAL_SEC)
-            abn_evt_mgt.consume_kpi_evts()
-            continue
-        logger.logger.debug('Abnormal kpi is: {}'.format(abn_kpi))
-        logger.logger.debug('Abnormal metrics are: {}'.format(abn_metrics))
-
-        try:
-            cause_res = cause_locating(abn_kpi, abn_metrics)
-        except InferenceException as ie:
-            logger.logger.warning(ie)
-            continue
-        if not cause_res:
-            logger.logger.info('No cause detected, event_id={}'.format(abn_kpi.event_id))
-            continue
-        cause_msg = gen_cause_msg(abn_kpi, cause_res)
-        send_cause_event(cause_producer, cause_msg)
+            abn_evt_mgt.wait_kpi_evts(STOP_CHECK_SEC)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,24 @@
-import json
+import heapq
+import itertools
+import threading
 from enum import Enum
-from queue import Queue, Empty
-from typing import List
+from typing import List, Optional
 import time
 
-from kafka import KafkaConsumer
-
 from spider.util import logger
 from spider.conf.observe_meta import ObserveMetaMgt
 from cause_inference.exceptions import DataParseException
 from cause_inference.exceptions import NoKpiEventException
 from cause_inference.model import AbnormalEvent
+from cause_inference.event_store import AbnEvtStore
+from cause_inference.evt_consumer import EvtConsumeThread
+from cause_inference.evt_consumer import TimeSeekReader
+from cause_inference.prefetch import HistPrefetcher
+from cause_inference.partition import MachinePartition
+from cause_inference.partition import ForeignEvtLoader
+
+
+METRIC_CATCH_UP_CHECK_SEC = 0.1
 
 
 class AbnEvtType(Enum):
@@ -19,33 +27,83 @@ class AbnEvtType(Enum):
 
 
 class AbnEvtMgt:
-    def __init__(self, kpi_consumer: KafkaConsumer, metric_consumer: KafkaConsumer,
-                 valid_duration, future_duration, aging_duration):
+    def __init__(self, kpi_consumer: EvtConsumeThread, metric_consumer: EvtConsumeThread,
+                 valid_duration, future_duration, aging_duration,
+                 metric_seek_reader: TimeSeekReader = None, incident_window=0,
+                 partition: MachinePartition = None, foreign_seek_reader: TimeSeekReader = None):
         self.kpi_consumer = kpi_consumer
         self.metric_consumer = metric_consumer
+        # 配置后，按时间查找位移读取每个异常KPI时间窗口内的异常指标事件，代替持续消费
+        self.metric_seek_reader = metric_seek_reader
         self.valid_duration = valid_duration * 1000
         self.future_duration = future_duration * 1000
         self.aging_duration = aging_duration * 1000
-
-        self.all_metric_evts: List[AbnormalEvent] = []
-        self.kpi_queue: Queue = Queue()
+        # 配置后，最早的异常KPI就绪后再等待该时间窗口，窗口内就绪的异常KPI作为同一事件一起处理
+        self.incident_window = incident_window * 1000
+        # 分区部署时，只缓存属于本实例的主机上的异常指标事件，其它主机上的事件在需要时按时间查找位移读取
+        self.partition = partition or MachinePartition()
+        self.foreign_seek_reader = foreign_seek_reader
+        self.foreign_read_lock = threading.Lock()
+
+        # 异常指标事件窗口，内部加锁，支持多个根因定位线程并发访问
+        self.evt_store = AbnEvtStore()
+        # 异常KPI的定时堆，元素为 (就绪时间, 序号, 异常KPI)，就绪时间为 KPI 时间戳加上未来周期
+        self.kpi_heap = []
+        self.kpi_seq = itertools.count()
+        self.kpi_lock = threading.Lock()
+        # 等待中的异常KPI的事件ID，从快照恢复后重复消费的异常KPI不会重复定位
+        self.kpi_evt_ids = set()
+        # 处理一条消息（更新事件窗口、等待中的异常KPI并确认位移）与保存状态快照互斥，保证快照中的位移与状态一致
+        self.state_lock = threading.Lock()
         self.last_kpi_evt_ts = 0
         self.last_metric_evt_ts = 0
+        # 后台消费线程最近一次消费完所有已到达的异常指标事件的时间
+        self.metric_idle_ts = 0
+        # 配置后，在异常KPI等待未来周期期间预取指标的历史数据
+        self.hist_prefetcher: Optional[HistPrefetcher] = None
 
     def get_abnormal_info(self) -> (AbnormalEvent, List[AbnormalEvent]):
-        try:
-            abn_kpi = self.kpi_queue.get_nowait()
-        except Empty as ex:
-            raise NoKpiEventException from ex
+        abn_kpi = self.pop_ready_kpi(int(time.time() * 1000))
+        if abn_kpi is None:
+            raise NoKpiEventException
 
-        self.wait_future_evts(abn_kpi.timestamp)
         self.consume_kpi_evts_with_deadline(abn_kpi.timestamp)
-        self.consume_metric_evts_with_deadline(abn_kpi.timestamp)
         self.clear_aging_evts(abn_kpi.timestamp)
         metric_evts = self.filter_valid_evts(abn_kpi.timestamp)
+        if self.metric_seek_reader is not None:
+            metric_evts = sorted(metric_evts + self.read_metric_evts_window(abn_kpi.timestamp, abn_kpi.timestamp),
+                                 key=lambda evt: evt.timestamp)
+        if self.hist_prefetcher is not None:
+            self.hist_prefetcher.top_up(abn_kpi, metric_evts)
 
         return abn_kpi, metric_evts
 
+    def get_abnormal_incident(self) -> (List[AbnormalEvent], List[AbnormalEvent]):
+        """获取同一时间窗口内就绪的所有异常KPI，以及这些异常KPI的有效时间范围内的全部异常指标事件"""
+        abn_kpis = self.pop_ready_incident(int(time.time() * 1000))
+        if not abn_kpis:
+            raise NoKpiEventException
+
+        first_ts = min(abn_kpi.timestamp for abn_kpi in abn_kpis)
+        last_ts = max(abn_kpi.timestamp for abn_kpi in abn_kpis)
+        self.consume_kpi_evts_with_deadline(last_ts)
+        self.clear_aging_evts(first_ts)
+        metric_evts = self.evt_store.query(first_ts - self.valid_duration, last_ts + self.future_duration)
+        if self.metric_seek_reader is not None:
+            metric_evts = sorted(metric_evts + self.read_metric_evts_window(first_ts, last_ts),
+                                 key=lambda evt: evt.timestamp)
+        if self.hist_prefetcher is not None:
+            for abn_kpi in abn_kpis:
+                self.hist_prefetcher.top_up(abn_kpi, metric_evts)
+
+        return abn_kpis, metric_evts
+
+    def handle_kpi_data(self, data):
+        with self.state_lock:
+            self.process_kpi_evt(data)
+            self.kpi_consumer.ack()
+        self.last_kpi_evt_ts = max(self.last_kpi_evt_ts, data.get('Timestamp'))
+
     def process_kpi_evt(self, data):
         try:
             abn_evt = parse_abn_evt(data)
@@ -56,87 +114,165 @@ class AbnEvtMgt:
             logger.logger.warning("Can't identify entity id of the abnormal kpi {}".format(abn_evt.abnormal_metric_id))
             return
 
-        self.all_metric_evts.append(abn_evt)
-        evt_type = data.get('Attributes', {}).get('event_type')
-        if evt_type == AbnEvtType.APP.value:
-            self.kpi_queue.put(abn_evt)
-
         metric_evts = parse_recommend_metric_evts(data)
-        self.all_metric_evts.extend(metric_evts)
-
-    def consume_kpi_evts(self):
-        for msg in self.kpi_consumer:
-            try:
-                data = json.loads(msg.value)
-            except (ValueError, TypeError) as ex:
-                logger.logger.warning(ex)
-                continue
-            self.process_kpi_evt(data)
+        self.evt_store.add(abn_evt)
+        self.evt_store.extend(metric_evts)
 
-            self.last_kpi_evt_ts = max(self.last_kpi_evt_ts, data.get('Timestamp'))
-            if not self.kpi_queue.empty():
-                return
+        evt_type = data.get('Attributes', {}).get('event_type')
+        if evt_type == AbnEvtType.APP.value:
+            self.schedule_kpi(abn_evt)
+            if self.hist_prefetcher is not None:
+                self.hist_prefetcher.prefetch(abn_evt, self.filter_valid_evts(abn_evt.timestamp))
+
+    def get_pending_kpis(self) -> List[AbnormalEvent]:
+        """还未就绪、等待根因定位的异常KPI"""
+        with self.kpi_lock:
+            return [item[2] for item in sorted(self.kpi_heap)]
+
+    def restore(self, abn_evts: List[AbnormalEvent], pending_kpis: List[AbnormalEvent]):
+        """从状态快照中恢复异常事件窗口和等待中的异常KPI，相对于等待中的异常KPI已老化的事件不再恢复"""
+        for abn_kpi in pending_kpis:
+            self.schedule_kpi(abn_kpi)
+        aging_base_ts = self.get_aging_base_ts()
+        self.evt_store.extend([evt for evt in abn_evts if not self.is_aging(evt.timestamp, aging_base_ts)])
+        logger.logger.info('Restore {} abnormal events and {} pending abnormal kpis from snapshot.'.format(
+            len(self.evt_store), len(pending_kpis)))
+
+    def schedule_kpi(self, abn_kpi: AbnormalEvent):
+        with self.kpi_lock:
+            if abn_kpi.event_id:
+                if abn_kpi.event_id in self.kpi_evt_ids:
+                    logger.logger.debug('Abnormal kpi {} is already pending, ignore it.'.format(abn_kpi.event_id))
+                    return
+                self.kpi_evt_ids.add(abn_kpi.event_id)
+            heapq.heappush(self.kpi_heap, (abn_kpi.timestamp + self.future_duration, next(self.kpi_seq), abn_kpi))
+
+    def is_kpi_ready(self, ready_ts, cur_ts):
+        if cur_ts < ready_ts:
+            return False
+        if self.metric_seek_reader is not None:
+            return True
+        # 未来周期内的异常指标事件已全部消费，才能开始根因定位
+        return self.last_metric_evt_ts > ready_ts or self.metric_idle_ts >= ready_ts
+
+    def pop_ready_kpi(self, cur_ts):
+        with self.kpi_lock:
+            if not self.kpi_heap or not self.is_kpi_ready(self.kpi_heap[0][0], cur_ts):
+                return None
+            return self._pop_kpi()
+
+    def pop_ready_incident(self, cur_ts) -> List[AbnormalEvent]:
+        """最早的异常KPI就绪并等待 incident_window 后，取出在此期间就绪的所有异常KPI"""
+        with self.kpi_lock:
+            if not self.kpi_heap:
+                return []
+            incident_ready_ts = self.kpi_heap[0][0] + self.incident_window
+            if not self.is_kpi_ready(incident_ready_ts, cur_ts):
+                return []
+            abn_kpis = []
+            while self.kpi_heap and self.kpi_heap[0][0] <= incident_ready_ts:
+                abn_kpis.append(self._pop_kpi())
+            return abn_kpis
+
+    def _pop_kpi(self) -> AbnormalEvent:
+        abn_kpi = heapq.heappop(self.kpi_heap)[2]
+        self.kpi_evt_ids.discard(abn_kpi.event_id)
+        return abn_kpi
+
+    def get_aging_base_ts(self):
+        """
+        异常指标事件的老化基准时间：等待中最早的异常KPI的时间戳，没有等待中的异常KPI时为最近消费的异常KPI的时间戳。
+        按异常KPI的时间而不是当前时间老化，积压消费或从快照位移恢复时不会丢弃仍需要的历史事件。
+        """
+        with self.kpi_lock:
+            if self.kpi_heap:
+                return self.kpi_heap[0][2].timestamp
+        return self.last_kpi_evt_ts
+
+    def next_ready_delay(self, cur_ts):
+        """距离最早的异常KPI（或其所在事件窗口）就绪的时间，单位：秒，没有待处理的异常KPI时返回 None"""
+        with self.kpi_lock:
+            if not self.kpi_heap:
+                return None
+            return max(self.kpi_heap[0][0] + self.incident_window - cur_ts, 0) / 1000
+
+    def wait_kpi_evts(self, max_wait=None):
+        """
+        阻塞等待，直到有新的异常KPI事件到达，或最早的异常KPI到达就绪时间，最多等待 max_wait 秒。
+        没有待处理的异常KPI且 max_wait 为 None 时一直阻塞，KPI 消费线程收到消息后立即唤醒。
+        """
+        timeout = self.next_ready_delay(int(time.time() * 1000))
+        if timeout == 0:
+            # 已到达就绪时间，等待异常指标事件消费完毕
+            timeout = METRIC_CATCH_UP_CHECK_SEC
+        if max_wait is not None:
+            timeout = max_wait if timeout is None else min(timeout, max_wait)
+        data = self.kpi_consumer.wait(timeout)
+        while data is not None:
+            self.handle_kpi_data(data)
+            data = self.kpi_consumer.wait(0)
 
     def consume_kpi_evts_with_deadline(self, cur_ts):
         if self.is_future(self.last_kpi_evt_ts, cur_ts):
             return
-        for msg in self.kpi_consumer:
-            try:
-                data = json.loads(msg.value)
-            except (ValueError, TypeError) as ex:
-                logger.logger.warning(ex)
-                continue
-            self.process_kpi_evt(data)
-
-            evt_ts = data.get('Timestamp')
-            self.last_kpi_evt_ts = max(self.last_kpi_evt_ts, evt_ts)
-            if self.is_future(evt_ts, cur_ts):
+        while True:
+            data = self.kpi_consumer.wait(0)
+            if data is None:
+                return
+            self.handle_kpi_data(data)
+            if self.is_future(data.get('Timestamp'), cur_ts):
                 break
 
     def process_metric_evt(self, data):
-        try:
-            metric_evt = parse_abn_evt(data)
-        except DataParseException as ex:
-            logger.logger.warning(ex)
+        metric_evt = parse_metric_evt(data)
+        if metric_evt is None:
             return
-        if not metric_evt.update_entity_id(ObserveMetaMgt()):
-            logger.logger.debug("Can't identify entity id of the metric {}".format(metric_evt.abnormal_metric_id))
+        if not self.partition.owns_evt(metric_evt):
             return
+        self.evt_store.add(metric_evt)
 
-        self.all_metric_evts.append(metric_evt)
+    def read_metric_evts_window(self, first_ts, last_ts, seek_reader: TimeSeekReader = None) -> List[AbnormalEvent]:
+        """读取时间戳为 first_ts 到 last_ts 的异常KPI的有效时间范围内的异常指标事件"""
+        seek_reader = seek_reader or self.metric_seek_reader
+        res = []
+        start = time.time()
+        for data in seek_reader.read_window(first_ts - self.valid_duration, last_ts + self.future_duration):
+            metric_evt = parse_metric_evt(data)
+            if metric_evt is not None:
+                res.append(metric_evt)
+        logger.logger.debug('Read {} abnormal metric events by time seeking, cost {:.3f}s.'.format(
+            len(res), time.time() - start))
+        return res
 
-    def consume_metric_evts_with_deadline(self, cur_ts):
-        if self.is_future(self.last_metric_evt_ts, cur_ts):
-            return
-        for msg in self.metric_consumer:
-            try:
-                data = json.loads(msg.value)
-            except (ValueError, TypeError) as ex:
-                logger.logger.error(ex)
-                continue
-            evt_ts = data.get('Timestamp')
-            self.last_kpi_evt_ts = max(self.last_metric_evt_ts, evt_ts)
-            if self.is_aging(evt_ts, cur_ts):
-                continue
-            self.process_metric_evt(data)
-            if self.is_future(evt_ts, cur_ts):
+    def read_foreign_evts_window(self, first_ts, last_ts) -> List[AbnormalEvent]:
+        # 读取位移的消费者不支持多线程共享，多个根因定位线程串行读取
+        with self.foreign_read_lock:
+            return self.read_metric_evts_window(first_ts, last_ts, self.foreign_seek_reader)
+
+    def get_foreign_evt_loader(self, first_ts, last_ts) -> Optional[ForeignEvtLoader]:
+        """分区部署时，返回读取时间戳为 first_ts 到 last_ts 的异常KPI涉及的其它实例的主机上的异常指标事件的对象"""
+        if not self.partition.is_partitioned() or self.foreign_seek_reader is None:
+            return None
+        return ForeignEvtLoader(self.partition, lambda: self.read_foreign_evts_window(first_ts, last_ts))
+
+    def consume_metric_evts(self):
+        while True:
+            data = self.metric_consumer.get()
+            if data is None:
                 break
+            evt_ts = data.get('Timestamp')
+            self.last_metric_evt_ts = max(self.last_metric_evt_ts, evt_ts)
+            with self.state_lock:
+                if not self.is_aging(evt_ts, self.get_aging_base_ts()):
+                    self.process_metric_evt(data)
+                self.metric_consumer.ack()
+        self.metric_idle_ts = int(time.time() * 1000)
 
     def filter_valid_evts(self, cur_ts):
-        res = []
-        for evt in self.all_metric_evts:
-            if not self.is_valid(evt.timestamp, cur_ts):
-                continue
-            res.append(evt)
-        return res
+        return self.evt_store.query(cur_ts - self.valid_duration, cur_ts + self.future_duration)
 
     def clear_aging_evts(self, cur_ts):
-        res = []
-        for evt in self.all_metric_evts:
-            if self.is_aging(evt.timestamp, cur_ts):
-                continue
-            res.append(evt)
-        self.all_metric_evts = res
+        self.evt_store.clear_before(cur_ts - self.aging_duration)
 
     def is_valid(self, evt_ts, cur_ts):
         return cur_ts - self.valid_duration < evt_ts <= cur_ts + self.future_duration
@@ -147,11 +283,16 @@ class AbnEvtMgt:
     def is_future(self, evt_ts, cur_ts):
         return evt_ts > cur_ts + self.future_duration
 
-    def wait_future_evts(self, evt_ts):
-        cur_ts = int(time.time()) * 1000
-        if evt_ts <= cur_ts < evt_ts + self.future_duration:
-            wait_sec = (evt_ts + self.future_duration - cur_ts) // 1000
-            time.sleep(wait_sec)
+
+class MetricEvtConsumeThread(threading.Thread):
+    """后台持续消费异常指标事件，异常KPI等待未来周期期间不阻塞其它事件的处理"""
+    def __init__(self, abn_evt_mgt: AbnEvtMgt):
+        super().__init__()
+        self.abn_evt_mgt = abn_evt_mgt
+
+    def run(self):
+        while True:
+            self.abn_evt_mgt.consume_metric_evts()
 
 
 def preprocess_abn_score(score):
@@ -177,6 +318,18 @@ def parse_abn_evt(data) -> AbnormalEvent:
     return abn_evt
 
 
+def parse_metric_evt(data) -> Optional[AbnormalEvent]:
+    try:
+        metric_evt = parse_abn_evt(data)
+    except DataParseException as ex:
+        logger.logger.warning(ex)
+        return None
+    if not metric_evt.update_entity_id(ObserveMetaMgt()):
+        logger.logger.debug("Can't identify entity id of the metric {}".format(metric_evt.abnormal_metric_id))
+        return None
+    return metric_evt
+
+
 def parse_recommend_metric_evts(abn_kpi_data: dict) -> List[AbnormalEvent]:
     metric_evts = []
     obsv_meta_mgt = ObserveMetaMgt()
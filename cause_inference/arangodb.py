@@ -1,16 +1,23 @@
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 
 from pyArango.connection import Connection
 from pyArango.database import Database
 from pyArango.theExceptions import AQLQueryError
 
 from spider.util import logger
+from spider.conf.observe_meta import ObserveMetaMgt
 from cause_inference.model import TopoNode, TopoEdge
 from cause_inference.exceptions import DBException
+from cause_inference.rule_parser import RULE_REFERENCED_LABELS
 
 _TIMESTAMP_COLL_NAME = 'Timestamps'
 _OBSERVE_ENTITY_COLL_PREFIX = 'ObserveEntities'
 
+_ENTITY_BASE_FIELDS = ['_id', '_key', 'type', 'machine_id', 'timestamp']
+_EDGE_FIELDS = ['_id', 'type', '_from', '_to']
+
+DEFAULT_BATCH_SIZE = 1000
+
 CODE_OF_EDGE_COLL_NOT_FOUND = 404
 
 
@@ -28,12 +35,24 @@ def connect_to_arangodb(arango_url, db_name):
     return conn.databases[db_name]
 
 
-def query_all(db, aql_query, bind_vars=None, raw_results=True):
-    res = []
-    query_hdl = db.AQLQuery(aql_query, bindVars=bind_vars, rawResults=raw_results)
+def get_entity_fields() -> List[str]:
+    # 只投影根因推导需要的字段：实体标识、规则引用的标签、以及作为指标标签的观测实体键值和标签
+    fields = set(_ENTITY_BASE_FIELDS)
+    fields.update(RULE_REFERENCED_LABELS)
+    for obsv_meta in list(ObserveMetaMgt().observe_meta_map.values()):
+        fields.update(obsv_meta.keys)
+        fields.update(obsv_meta.labels)
+    return sorted(fields)
+
+
+def iter_query(db, aql_query, bind_vars=None, batch_size=DEFAULT_BATCH_SIZE):
+    query_hdl = db.AQLQuery(aql_query, bindVars=bind_vars, rawResults=True, batchSize=batch_size)
     for item in query_hdl:
-        res.append(item)
-    return res
+        yield item
+
+
+def query_all(db, aql_query, bind_vars=None, batch_size=DEFAULT_BATCH_SIZE):
+    return list(iter_query(db, aql_query, bind_vars, batch_size))
 
 
 def query_recent_topo_ts(db: Database, ts) -> int:
@@ -55,27 +74,46 @@ def query_recent_topo_ts(db: Database, ts) -> int:
     return int(last_ts)
 
 
-def query_topo_entities(db: Database, ts, query_options=None) -> List[TopoNode]:
+def query_entity_by_key(db: Database, ts, entity_key) -> Optional[TopoNode]:
+    bind_vars = {
+        'coll': _get_collection_name(_OBSERVE_ENTITY_COLL_PREFIX, ts),
+        'key': entity_key,
+        'fields': get_entity_fields(),
+    }
+    aql_query = '''
+    LET v = DOCUMENT(@coll, @key)
+      FILTER v != null
+      RETURN KEEP(v, @fields)
+    '''
+    try:
+        query_res = query_all(db, aql_query, bind_vars)
+    except AQLQueryError as ex:
+        raise DBException(ex) from ex
+    if len(query_res) == 0:
+        return None
+    return create_node_from_dict(query_res[0])
+
+
+def query_topo_entities(db: Database, ts, query_options=None, batch_size=DEFAULT_BATCH_SIZE) -> List[TopoNode]:
     if not query_options:
         query_options = {}
 
     entity_coll_name = _get_collection_name(_OBSERVE_ENTITY_COLL_PREFIX, ts)
-    bind_vars = {'@collection': entity_coll_name}
+    bind_vars = {'@collection': entity_coll_name, 'fields': get_entity_fields()}
     bind_vars.update(query_options)
     filter_str = gen_filter_str(query_options)
     aql_query = '''
     FOR v IN @@collection
       {}
-      return v
+      return KEEP(v, @fields)
     '''.format(filter_str)
+
+    res = []
     try:
-        query_res = query_all(db, aql_query, bind_vars)
+        for node in iter_query(db, aql_query, bind_vars, batch_size):
+            res.append(create_node_from_dict(node))
     except AQLQueryError as ex:
         raise DBException(ex) from ex
-
-    res = []
-    for node in query_res:
-        res.append(create_node_from_dict(node))
     return res
 
 
@@ -88,8 +126,17 @@ def gen_filter_str(query_options) -> str:
     return filter_str
 
 
-def query_subgraph(db, ts, start_entity_id, edge_collection, depth=1, query_options=None)\
-        -> Tuple[Dict[str, TopoNode], Dict[str, TopoEdge]]:
+def gen_prune_str(query_options) -> str:
+    if not query_options:
+        return ''
+
+    prune_options = ['v.{} != @{}'.format(k, k) for k in query_options]
+    prune_str = 'prune ' + ' or '.join(prune_options)
+    return prune_str
+
+
+def query_subgraph(db, ts, start_entity_id, edge_collection, depth=1, query_options=None,
+                   batch_size=DEFAULT_BATCH_SIZE) -> Tuple[Dict[str, TopoNode], Dict[str, TopoEdge]]:
     query_options = query_options or {}
 
     entity_coll_name = _get_collection_name(_OBSERVE_ENTITY_COLL_PREFIX, ts)
@@ -98,72 +145,82 @@ def query_subgraph(db, ts, start_entity_id, edge_collection, depth=1, query_opti
         '@collection': entity_coll_name,
         'depth': depth,
         'start_v': start_node_id,
+        'fields': get_entity_fields(),
+        'edge_fields': _EDGE_FIELDS,
     }
     bind_vars.update(query_options)
 
     filter_str = gen_filter_str(query_options)
     edge_coll_str = ', '.join(edge_collection)
+    prune_str = gen_prune_str(query_options)
     aql_query = '''
     WITH @@collection
     FOR v, e IN 1..@depth ANY @start_v
+      {}
       {}
       options {{"uniqueVertices": "path"}}
       {}
-      return {{"node": v, "edge": e}}
-    '''.format(edge_coll_str, filter_str)
-    try:
-        query_res = query_all(db, aql_query, bind_vars)
-    except AQLQueryError as ex:
-        raise DBException(ex) from ex
+      return {{"node": KEEP(v, @fields), "edge": KEEP(e, @edge_fields)}}
+    '''.format(edge_coll_str, prune_str, filter_str)
 
     nodes = {}
     edges = {}
-    for item in query_res:
-        node = item.get('node')
-        edge = item.get('edge')
-        nodes.setdefault(node.get('_id'), create_node_from_dict(node))
-        edges.setdefault(edge.get('_id'), create_edge_from_dict(edge))
+    try:
+        for item in iter_query(db, aql_query, bind_vars, batch_size):
+            node = item.get('node')
+            edge = item.get('edge')
+            if node.get('_id') not in nodes:
+                nodes[node.get('_id')] = create_node_from_dict(node)
+            if edge.get('_id') not in edges:
+                edges[edge.get('_id')] = create_edge_from_dict(edge)
+    except AQLQueryError as ex:
+        raise DBException(ex) from ex
     return nodes, edges
 
 
-def query_cross_host_edges_detail(db: Database, edge_coll, ts) -> List[TopoEdge]:
+def query_cross_host_edges_detail(db: Database, edge_coll, ts, batch_size=DEFAULT_BATCH_SIZE) -> List[TopoEdge]:
     bind_vars = {
-        '@coll': _get_collection_name(_OBSERVE_ENTITY_COLL_PREFIX, ts),
         '@edge': edge_coll,
-        'ts': ts
+        'ts': ts,
+        'fields': get_entity_fields(),
+        'edge_fields': _EDGE_FIELDS,
     }
     aql_query = """
     for e in @@edge filter e.timestamp == @ts
-        let from = (for v in @@coll filter v._id == e._from return v)
-        let to = (for v in @@coll filter v._id == e._to return v)
-        filter from[0].machine_id != to[0].machine_id
-        return {edge: e, from: from, to: to}
+        let from = DOCUMENT(e._from)
+        let to = DOCUMENT(e._to)
+        filter from != null and to != null and from.machine_id != to.machine_id
+        return {
+            edge: KEEP(e, @edge_fields),
+            from: KEEP(from, @fields),
+            to: KEEP(to, @fields)
+        }
     """
+    res = []
     try:
-        query_res = query_all(db, aql_query, bind_vars)
+        for item in iter_query(db, aql_query, bind_vars, batch_size):
+            edge = create_edge_from_dict(item.get('edge'))
+            edge.from_node = create_node_from_dict(item.get('from'))
+            edge.to_node = create_node_from_dict(item.get('to'))
+            res.append(edge)
     except AQLQueryError as ex:
         if ex.errors.get('code') == CODE_OF_EDGE_COLL_NOT_FOUND:
             logger.logger.debug(ex.message)
             return []
         raise DBException(ex) from ex
-
-    res = []
-    for item in query_res:
-        edge = create_edge_from_dict(item.get('edge'))
-        edge.from_node = create_node_from_dict(item.get('from')[0])
-        edge.to_node = create_node_from_dict(item.get('to')[0])
-        res.append(edge)
     return res
 
 
 def create_node_from_dict(data: dict) -> TopoNode:
+    labels = {k: v for k, v in data.items() if k not in _ENTITY_BASE_FIELDS}
+    labels['machine_id'] = data.get('machine_id')
     return TopoNode(
         id=data.get('_id'),
         entity_id=data.get('_key'),
         entity_type=data.get('type'),
         machine_id=data.get('machine_id'),
         timestamp=data.get('timestamp'),
-        raw_data=data
+        raw_data=labels
     )
 
 
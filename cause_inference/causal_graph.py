@@ -1,7 +1,6 @@
 from typing import List, Dict
 
-import networkx as nx
-
+from cause_inference.compact_graph import CompactDiGraph
 from cause_inference.model import is_virtual_category, TopoNode, AbnormalEvent, MetricNodeId
 from cause_inference.trend import check_trend
 from spider.util import logger
@@ -9,8 +8,8 @@ from spider.util import logger
 
 class CausalGraph:
     def __init__(self):
-        self.entity_cause_graph = nx.DiGraph()
-        self.metric_cause_graph = nx.DiGraph()
+        self.entity_cause_graph = CompactDiGraph()
+        self.metric_cause_graph = CompactDiGraph()
 
     @staticmethod
     def is_virtual_metric_group(metric_group: dict) -> bool:
@@ -34,14 +33,12 @@ class CausalGraph:
         self.entity_cause_graph.add_node(node.id, id=node.id, entity_id=node.entity_id, entity_type=node.entity_type,
                                          machine_id=node.machine_id, raw_data=node.raw_data)
 
-    def add_abn_metrics(self, abn_metrics: List[AbnormalEvent]):
-        entity_ids = {n_attrs.get('entity_id'): n_id for n_id, n_attrs in self.entity_cause_graph.nodes.items()}
-        for abn_metric in abn_metrics:
-            node_id = entity_ids.get(abn_metric.abnormal_entity_id)
-            if not node_id:
-                continue
-            self.set_abnormal_status(node_id, True)
-            self.add_abnormal_metric(node_id, abn_metric)
+    def add_abn_metrics(self, abn_metrics: Dict[str, List[AbnormalEvent]]):
+        """abn_metrics 为按实体ID分组的异常指标事件，只查找图中实体上的事件"""
+        for node_id, node_attrs in self.entity_cause_graph.nodes.items():
+            for abn_metric in abn_metrics.get(node_attrs.get('entity_id'), []):
+                self.set_abnormal_status(node_id, True)
+                self.add_abnormal_metric(node_id, abn_metric)
 
     def prune_by_abnormal_node(self):
         node_ids = list(self.entity_cause_graph.nodes)
@@ -70,8 +67,6 @@ class CausalGraph:
         metric_labels = abn_metrics[abn_metric.abnormal_metric_id].get('metric_labels')
         if not metric_labels:
             metric_labels = dict(node_attrs.get('raw_data', {}))
-            if 'metrics' in metric_labels:
-                metric_labels.pop('metrics')
             abn_metrics[abn_metric.abnormal_metric_id].update({'metric_labels': metric_labels})
 
     def get_abnormal_metrics(self, node_id) -> dict:
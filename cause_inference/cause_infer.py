@@ -1,4 +1,7 @@
-from typing import List, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Optional
 
 from scipy.stats import pearsonr
 import numpy as np
@@ -8,7 +11,8 @@ from spider.conf.observe_meta import RelationType, ObserveMetaMgt
 from spider.collector import DataCollectorFactory
 
 from cause_inference.model import Cause, MetricNodeId, MetricNode, CauseTree, HostTopo, TopoNode, TopoEdge
-from cause_inference.model import AbnormalEvent
+from cause_inference.model import AbnormalEvent, TopoIndex
+from cause_inference.model import group_abn_evts_by_entity
 from cause_inference.model import is_virtual_metric
 from cause_inference.causal_graph import CausalGraph
 from cause_inference.exceptions import InferenceException
@@ -19,24 +23,64 @@ from cause_inference.infer_policy import InferPolicy
 from cause_inference.infer_policy import get_infer_policy
 from cause_inference.output import format_infer_result
 from cause_inference.db_mgt import ArangodbMgt, PromMgt
+from cause_inference.db_mgt import SingleFlightArangodbMgt, SingleFlightPromMgt
 from cause_inference.trend import trend
+from cause_inference.skeleton import skeleton_cache
+from cause_inference.deadline import Deadline
+from cause_inference.prefetch import get_hist_end_ts
+from cause_inference.result_cache import result_cache, reuse_infer_result
+from cause_inference.partition import ForeignEvtLoader
+
+
+class PrescreenStats:
+    """异常指标预筛选的累计计数"""
+    def __init__(self):
+        self.screened = 0
+        self.skipped_low_score = 0
+        self.skipped_missing = 0
+        self.skipped_flat = 0
+        self._lock = threading.Lock()
+
+    def record(self, screened, skipped_low_score, skipped_missing, skipped_flat):
+        with self._lock:
+            self.screened += screened
+            self.skipped_low_score += skipped_low_score
+            self.skipped_missing += skipped_missing
+            self.skipped_flat += skipped_flat
+
+    def __repr__(self):
+        with self._lock:
+            return 'PrescreenStats(screened={}, skipped_low_score={}, skipped_missing={}, skipped_flat={})'.format(
+                self.screened, self.skipped_low_score, self.skipped_missing, self.skipped_flat)
+
+
+prescreen_stats = PrescreenStats()
 
 
 class CauseLocator:
     def __init__(self, abn_kpi: AbnormalEvent, all_abn_metrics: List[AbnormalEvent], topo_db_mgt,
-                 metric_db_mgt, infer_policy: InferPolicy, top_k):
+                 metric_db_mgt, infer_policy: InferPolicy, top_k, deadline: Deadline = None,
+                 foreign_evt_loader: ForeignEvtLoader = None):
         self.abn_kpi = abn_kpi
         self.all_abn_metrics = all_abn_metrics
+        self.abn_metrics_by_entity = group_abn_evts_by_entity(all_abn_metrics)
         self.topo_db_mgt = topo_db_mgt
         self.metric_db_mgt = metric_db_mgt
         self.infer_policy = infer_policy
         self.top_k = top_k
+        self.deadline = deadline or Deadline()
+        # 分区部署时，因果图涉及不属于本实例的主机时，通过该对象补充读取这些主机上的异常指标事件，只读取一次
+        self.foreign_evt_loader = foreign_evt_loader
+        self._foreign_evts_loaded = False
+        self._foreign_evts_lock = threading.Lock()
 
         self.topo_ts = None
+        # 在截止时间内未完成全部阶段时，标记为部分结果
+        self.partial = False
 
     @staticmethod
     def gen_host_causal_relations(host_topo: HostTopo) -> List[tuple]:
-        return rule_engine.rule_parsing(host_topo.nodes, host_topo.edges)
+        return rule_engine.rule_parsing_by_index(host_topo.get_topo_index())
 
     @staticmethod
     def filter_affected_metric_node_ids(affected_cause_nodes: List[MetricNode], causal_graph: CausalGraph)\
@@ -68,19 +112,24 @@ class CauseLocator:
                     res.append(filtered_cause)
         return res
 
-    def construct_causal_graph(self, entity_causal_relations: List[tuple], abn_metrics: List[AbnormalEvent],
-                               topo_nodes: Dict[str, TopoNode]) -> CausalGraph:
+    def construct_causal_graph(self, entity_causal_relations: List[tuple],
+                               abn_metrics: Dict[str, List[AbnormalEvent]], topo_nodes: Dict[str, TopoNode]) -> CausalGraph:
         causal_graph = CausalGraph()
 
         # 构建实体因果图
         causal_graph.init_entity_cause_graph(entity_causal_relations, topo_nodes)
+        rule_engine.add_rule_meta(causal_graph)
+
+        return self.overlay_abn_metrics(causal_graph, abn_metrics)
+
+    def overlay_abn_metrics(self, causal_graph: CausalGraph, abn_metrics: Dict[str, List[AbnormalEvent]])\
+            -> CausalGraph:
         causal_graph.add_abn_metrics(abn_metrics)
 
         self.calc_corr_score(causal_graph)
         causal_graph.filter_abn_metrics_by_corr_score()
 
         # 构建指标因果图
-        rule_engine.add_rule_meta(causal_graph)
         causal_graph.init_metric_cause_graph()
 
         return causal_graph
@@ -88,13 +137,15 @@ class CauseLocator:
     def locating(self) -> List[Cause]:
         self.init_topo_timestamp()
 
+        self.deadline.check('querying abnormal entity')
         abn_entity = self.topo_db_mgt.query_entity_by_id(self.abn_kpi.abnormal_entity_id, self.topo_ts)
         causes = self.host_locating(abn_entity, self.abn_kpi.abnormal_metric_id, self.top_k)
 
         return self.filter_causes(causes)
 
     def host_locating(self, abn_entity: TopoNode, abn_metric_id: str, top_k) -> List[Cause]:
-        host_topo = self.topo_db_mgt.query_host_topo(abn_entity.machine_id, self.topo_ts)
+        self.deadline.check('querying host topology')
+        host_topo = self.query_host_topo(abn_entity.machine_id)
         causal_graph = self.construct_host_causal_graph(host_topo)
 
         logger.logger.debug("Host metric cause graph edges are: {}".format(causal_graph.metric_cause_graph.edges))
@@ -102,21 +153,64 @@ class CauseLocator:
         abn_metric_node_id = MetricNodeId(abn_entity.id, abn_metric_id)
         return self.infer_policy.infer(causal_graph.metric_cause_graph, abn_metric_node_id, top_k)
 
+    def load_foreign_abn_metrics(self, machine_id):
+        if self.foreign_evt_loader is None or not self.foreign_evt_loader.need_load(machine_id):
+            return
+        with self._foreign_evts_lock:
+            if self._foreign_evts_loaded:
+                return
+            self._foreign_evts_loaded = True
+            foreign_evts = self.foreign_evt_loader.load()
+            logger.logger.debug('Load {} abnormal metric events of foreign machines, event_id={}'.format(
+                len(foreign_evts), self.abn_kpi.event_id))
+            if not foreign_evts:
+                return
+            # 整体替换，不修改其它线程可能正在读取的字典
+            self.all_abn_metrics = self.all_abn_metrics + foreign_evts
+            self.abn_metrics_by_entity = group_abn_evts_by_entity(self.all_abn_metrics)
+
     def construct_host_causal_graph(self, host_topo: HostTopo) -> CausalGraph:
+        self.load_foreign_abn_metrics(host_topo.machine_id)
+        skeleton = skeleton_cache.get(host_topo.machine_id, self.topo_ts)
+        if skeleton is not None:
+            return self.overlay_abn_metrics(skeleton.new_causal_graph(), self.abn_metrics_by_entity)
+
         host_causal_relations = self.gen_host_causal_relations(host_topo)
-        return self.construct_causal_graph(host_causal_relations, self.all_abn_metrics, host_topo.nodes)
+        return self.construct_causal_graph(host_causal_relations, self.abn_metrics_by_entity, host_topo.nodes)
+
+    def query_host_topo(self, machine_id) -> HostTopo:
+        skeleton = skeleton_cache.get(machine_id, self.topo_ts)
+        if skeleton is not None:
+            return skeleton.host_topo
+        return self.topo_db_mgt.query_host_topo(machine_id, self.topo_ts)
 
     def init_topo_timestamp(self):
+        if self.topo_ts is not None:
+            return
         self.topo_ts = self.topo_db_mgt.query_recent_topo_ts(self.abn_kpi.timestamp // 1000)
 
-    def calc_corr_score(self, causal_graph: CausalGraph):
-        end_ts = self.abn_kpi.timestamp // 1000 + infer_config.infer_conf.get('evt_future_duration')
+    def init_kpi_hist_data(self) -> int:
+        """查询异常KPI的历史数据，返回历史数据时间窗口的结束时间"""
+        end_ts = get_hist_end_ts(self.abn_kpi)
         if not self.abn_kpi.hist_data:
             hist_data = self.metric_db_mgt.query_metric_hist_data(self.abn_kpi.abnormal_metric_id,
                                                                   self.abn_kpi.metric_labels,
                                                                   end_ts)
             self.abn_kpi.set_hist_data(hist_data)
+        return end_ts
+
+    def calc_corr(self, metric_hist_data: list) -> float:
+        return abs(pearsonr(self.abn_kpi.hist_data, metric_hist_data)[0])
+
+    def calc_metric_corr(self, metric_id, metric_labels, end_ts) -> (list, float):
+        """查询指标截至 end_ts 的历史数据，返回历史数据以及与异常KPI的相关系数"""
+        metric_hist_data = self.metric_db_mgt.query_metric_hist_data(metric_id, metric_labels, end_ts)
+        return metric_hist_data, self.calc_corr(metric_hist_data)
 
+    def calc_corr_score(self, causal_graph: CausalGraph):
+        end_ts = self.init_kpi_hist_data()
+
+        skipped_metrics = self.prescreen_metrics(causal_graph, end_ts)
         for node_id, node_attrs in causal_graph.entity_cause_graph.nodes.items():
             metric_labels = node_attrs.get('raw_data')
             if not metric_labels:
@@ -125,34 +219,92 @@ class CauseLocator:
 
             abn_metrics = causal_graph.get_abnormal_metrics(node_id)
             for metric_id, metric_attrs in abn_metrics.items():
-                metric_hist_data = self.metric_db_mgt.query_metric_hist_data(metric_id, metric_labels, end_ts)
+                if (node_id, metric_id) in skipped_metrics:
+                    continue
+                if self.deadline.expired():
+                    # 超时后不再查询剩余指标的历史数据，未计算相关性的指标将被过滤
+                    logger.logger.warning('Deadline exceeded while calculating correlation scores, '
+                                          'event_id={}'.format(self.abn_kpi.event_id))
+                    self.partial = True
+                    return
+                metric_hist_data, corr = self.calc_metric_corr(metric_id, metric_labels, end_ts)
 
                 data_trend = trend(metric_hist_data)
                 metric_attrs.setdefault('real_trend', data_trend)
 
-                corr = pearsonr(self.abn_kpi.hist_data, metric_hist_data)
-                if np.isnan(corr[0]):
+                if np.isnan(corr):
                     continue
-                metric_attrs.setdefault('corr_score', abs(corr[0]))
+                metric_attrs.setdefault('corr_score', corr)
+
+    def prescreen_metrics(self, causal_graph: CausalGraph, end_ts) -> set:
+        """
+        在查询完整历史数据前预筛选异常指标，返回跳过的 (实体节点ID, 指标ID) 集合。被跳过的指标不计算相关性，之后会被
+        filter_abn_metrics_by_corr_score 过滤，包括：
+        - 异常检测的 abnormal_score 小于配置的下限；
+        - 时间窗口内没有历史数据，或历史数据取值不变，此时相关系数无法计算。
+        """
+        infer_conf = infer_config.infer_conf
+        if not infer_conf.get('prescreen_metrics') or not isinstance(self.metric_db_mgt, PromMgt):
+            return set()
+
+        min_abn_score = infer_conf.get('prescreen_min_abnormal_score') or 0
+        skipped = set()
+        skipped_low_score = 0
+        candidates = []
+        for node_id, node_attrs in causal_graph.entity_cause_graph.nodes.items():
+            metric_labels = node_attrs.get('raw_data')
+            if not metric_labels:
+                continue
+            for metric_id, metric_attrs in causal_graph.get_abnormal_metrics(node_id).items():
+                if abs(metric_attrs.get('abnormal_score') or 0) < min_abn_score:
+                    skipped.add((node_id, metric_id))
+                    skipped_low_score += 1
+                    continue
+                candidates.append((node_id, metric_id, metric_labels))
+
+        summaries = self.metric_db_mgt.query_metric_summaries(
+            [(metric_id, metric_labels) for _, metric_id, metric_labels in candidates], end_ts,
+            infer_conf.get('prescreen_batch_size'), infer_conf.get('prescreen_summary_step') or 0)
+        skipped_missing = 0
+        skipped_flat = 0
+        for (node_id, metric_id, _), summary in zip(candidates, summaries):
+            if summary is None:
+                skipped_missing += 1
+            elif summary == 0:
+                skipped_flat += 1
+            else:
+                continue
+            skipped.add((node_id, metric_id))
+
+        prescreen_stats.record(len(candidates) + skipped_low_score, skipped_low_score, skipped_missing, skipped_flat)
+        logger.logger.debug('Prescreen skipped {} abnormal metrics, event_id={}, {}'.format(
+            len(skipped), self.abn_kpi.event_id, prescreen_stats))
+        return skipped
 
 
 class ClusterCauseLocator(CauseLocator):
     def __init__(self, abn_kpi: AbnormalEvent, all_abn_metrics: List[AbnormalEvent], topo_db_mgt,
-                 metric_db_mgt, infer_policy: InferPolicy, top_k):
-        super().__init__(abn_kpi, all_abn_metrics, topo_db_mgt, metric_db_mgt, infer_policy, top_k)
+                 metric_db_mgt, infer_policy: InferPolicy, top_k, deadline: Deadline = None,
+                 max_hops=5, time_budget=30, workers=4, foreign_evt_loader: ForeignEvtLoader = None):
+        super().__init__(abn_kpi, all_abn_metrics, topo_db_mgt, metric_db_mgt, infer_policy, top_k, deadline,
+                         foreign_evt_loader=foreign_evt_loader)
+        self.max_hops = max_hops
+        self.time_budget = time_budget
+        self.workers = workers
+        # 跨主机扩展的时间预算的截止时间，开始扩展时设置
+        self.cross_host_expire_at = None
 
         self.cause_tree: CauseTree = CauseTree()
         self.all_cross_host_edges: List[TopoEdge] = []
+        self.cross_host_edge_index: Dict[str, List[TopoEdge]] = {}
         self.cross_host_edge_types = [RelationType.RUNS_ON.value, RelationType.STORE_IN.value]
 
     @staticmethod
     def gen_cross_causal_relations(affected_host_topo: HostTopo, neigh_topo: HostTopo, cross_edge: TopoEdge)\
             -> List[tuple]:
-        topo_nodes = {}
-        topo_nodes.update(affected_host_topo.nodes)
-        topo_nodes.update(neigh_topo.nodes)
-        topo_edges = {cross_edge.id: cross_edge}
-        cross_causal_relations = rule_engine.cross_rule_parsing(topo_nodes, topo_edges)
+        topo_index = TopoIndex.merge([affected_host_topo.get_topo_index(), neigh_topo.get_topo_index()],
+                                     {cross_edge.id: cross_edge})
+        cross_causal_relations = rule_engine.cross_rule_parsing_by_index(topo_index)
 
         affected_causal_relations = []
         for causal_relation in cross_causal_relations:
@@ -170,15 +322,22 @@ class ClusterCauseLocator(CauseLocator):
 
     def locating(self) -> List[Cause]:
         self.init_topo_timestamp()
+        self.deadline.check('querying cross host edges')
         self.init_all_cross_host_edges()
 
+        self.deadline.check('querying abnormal entity')
         abn_entity = self.topo_db_mgt.query_entity_by_id(self.abn_kpi.abnormal_entity_id, self.topo_ts)
         causes = self.host_locating(abn_entity, self.abn_kpi.abnormal_metric_id, 0)
         newly_cause_nodes = self.cause_tree.append_all_causes(causes)
         if len(newly_cause_nodes) == 0:
             return []
 
-        self.cross_host_cause_locating(abn_entity.machine_id, newly_cause_nodes, 0)
+        if self.deadline.expired():
+            logger.logger.warning('Deadline exceeded, skip cross host cause locating, event_id={}'.format(
+                self.abn_kpi.event_id))
+            self.partial = True
+        else:
+            self.cross_host_cause_locating(abn_entity.machine_id, newly_cause_nodes, 0)
         cluster_cause_graph = self.cause_tree.to_cause_graph()
         logger.logger.debug('Cluster metric cause graph edges are: {}'.format(cluster_cause_graph.edges))
         causes = self.infer_policy.infer(cluster_cause_graph,
@@ -188,21 +347,61 @@ class ClusterCauseLocator(CauseLocator):
         return self.filter_causes(causes)
 
     def cross_host_cause_locating(self, affected_machine_id, affected_causes: List[MetricNode], top_k):
-        logger.logger.debug('===Start cross host cause locating, affected machine id is:{}'.format(affected_machine_id))
+        self.expand_cross_host({affected_machine_id: affected_causes}, top_k)
+
+    def expand_cross_host(self, frontier: Dict[str, List[MetricNode]], top_k):
+        """从 frontier 中的各个受影响主机开始，按广度优先逐跳向邻居主机扩展根因树"""
+        self.cross_host_expire_at = time.time() + self.time_budget
+        visited = set(frontier)
+        hops = 0
+        executor = ThreadPoolExecutor(max_workers=self.workers)
         try:
-            affected_host_topo = self.topo_db_mgt.query_host_topo(affected_machine_id, self.topo_ts)
-        except InferenceException as ex:
-            logger.logger.warning(ex)
-            return
-        cross_host_edges = self.filter_cross_host_edges(affected_machine_id)
-        for cross_edge in cross_host_edges:
-            neigh_entity = self.get_neigh_entity(affected_machine_id, cross_edge)
-            try:
-                neigh_topo = self.topo_db_mgt.query_host_topo(neigh_entity.machine_id, self.topo_ts)
-            except InferenceException as ex:
-                logger.logger.warning(ex)
+            while frontier and hops < self.max_hops:
+                remaining = self.cross_host_remaining()
+                if remaining <= 0:
+                    self.partial = True
+                    logger.logger.warning('Time budget of cross host cause locating exhausted after {} hops, '
+                                          'event_id={}'.format(hops, self.abn_kpi.event_id))
+                    break
+                frontier = self.expand_frontier(frontier, visited, top_k, executor, remaining)
+                hops += 1
+        finally:
+            executor.shutdown(wait=False)
+
+    def cross_host_remaining(self) -> float:
+        """跨主机扩展的剩余时间，取时间预算和根因定位截止时间的较小值"""
+        remaining = self.deadline.remaining()
+        if self.cross_host_expire_at is not None:
+            remaining = min(remaining, self.cross_host_expire_at - time.time())
+        return remaining
+
+    def expand_frontier(self, frontier: Dict[str, List[MetricNode]], visited: set, top_k, executor, timeout)\
+            -> Dict[str, List[MetricNode]]:
+        tasks = []
+        for affected_machine_id, affected_causes in frontier.items():
+            logger.logger.debug('===Start cross host cause locating, affected machine id is:{}'.format(
+                affected_machine_id))
+            for cross_edge in self.filter_cross_host_edges(affected_machine_id):
+                neigh_machine_id = self.get_neigh_entity(affected_machine_id, cross_edge).machine_id
+                if neigh_machine_id in visited:
+                    continue
+                future = executor.submit(self.build_cross_host_causal_graph, affected_machine_id, neigh_machine_id,
+                                         cross_edge)
+                tasks.append((affected_causes, neigh_machine_id, future))
+        visited.update(task[1] for task in tasks)
+        wait([task[2] for task in tasks], timeout=timeout)
+
+        next_frontier = {}
+        for affected_causes, neigh_machine_id, future in tasks:
+            if not future.done():
+                future.cancel()
+                self.partial = True
+                logger.logger.warning('Cross host causal graph of machine {} not built in time.'.format(
+                    neigh_machine_id))
+                continue
+            cross_causal_graph = future.result()
+            if cross_causal_graph is None:
                 continue
-            cross_causal_graph = self.construct_cross_host_causal_graph(affected_host_topo, neigh_topo, cross_edge)
 
             affected_metric_node_ids = self.filter_affected_metric_node_ids(affected_causes, cross_causal_graph)
             all_neigh_causes = []
@@ -212,28 +411,59 @@ class ClusterCauseLocator(CauseLocator):
 
             newly_cause_nodes = self.cause_tree.append_all_causes(all_neigh_causes)
             if len(newly_cause_nodes) > 0:
-                self.cross_host_cause_locating(neigh_entity.machine_id, newly_cause_nodes, top_k)
+                next_frontier.setdefault(neigh_machine_id, []).extend(newly_cause_nodes)
+        return next_frontier
+
+    def build_cross_host_causal_graph(self, affected_machine_id, neigh_machine_id, cross_edge: TopoEdge) \
+            -> Optional[CausalGraph]:
+        # 已提交的任务在超时后不会被取消，每次查询前检查剩余时间，超时后跳过剩余的查询和构建
+        try:
+            if self.check_cross_host_expired(neigh_machine_id):
+                return None
+            affected_host_topo = self.query_host_topo(affected_machine_id)
+            if self.check_cross_host_expired(neigh_machine_id):
+                return None
+            neigh_topo = self.query_host_topo(neigh_machine_id)
+        except InferenceException as ex:
+            logger.logger.warning(ex)
+            return None
+        if self.check_cross_host_expired(neigh_machine_id):
+            return None
+        return self.construct_cross_host_causal_graph(affected_host_topo, neigh_topo, cross_edge)
+
+    def check_cross_host_expired(self, neigh_machine_id) -> bool:
+        if self.cross_host_remaining() > 0:
+            return False
+        self.partial = True
+        logger.logger.warning('Time budget exhausted, skip building cross host causal graph of machine {}, '
+                              'event_id={}'.format(neigh_machine_id, self.abn_kpi.event_id))
+        return True
 
     def filter_cross_host_edges(self, machine_id: str) -> List[TopoEdge]:
-        filtered_edges = []
-        for edge in self.all_cross_host_edges:
-            if edge.from_node.machine_id == machine_id or edge.to_node.machine_id == machine_id:
-                filtered_edges.append(edge)
-        return filtered_edges
+        return self.cross_host_edge_index.get(machine_id, [])
 
     def construct_cross_host_causal_graph(self, affected_host_topo: HostTopo, neigh_topo: HostTopo,
                                           cross_edge: TopoEdge) -> CausalGraph:
+        self.load_foreign_abn_metrics(affected_host_topo.machine_id)
+        self.load_foreign_abn_metrics(neigh_topo.machine_id)
         cross_causal_relations = self.gen_cross_causal_relations(affected_host_topo, neigh_topo, cross_edge)
-        neigh_causal_relations = self.gen_host_causal_relations(neigh_topo)
+        topo_nodes = {}
+        topo_nodes.update(affected_host_topo.nodes)
+        topo_nodes.update(neigh_topo.nodes)
 
+        skeleton = skeleton_cache.get(neigh_topo.machine_id, self.topo_ts)
+        if skeleton is not None:
+            causal_graph = skeleton.new_causal_graph()
+            causal_graph.init_entity_cause_graph(cross_causal_relations, topo_nodes)
+            rule_engine.add_rule_meta(causal_graph)
+            return self.overlay_abn_metrics(causal_graph, self.abn_metrics_by_entity)
+
+        neigh_causal_relations = self.gen_host_causal_relations(neigh_topo)
         causal_relations = []
         causal_relations.extend(cross_causal_relations)
         causal_relations.extend(neigh_causal_relations)
-        topo_nodes = {}
-        topo_nodes.update(affected_host_topo.nodes)
-        topo_nodes.update(neigh_topo.nodes)
 
-        return self.construct_causal_graph(causal_relations, self.all_abn_metrics, topo_nodes)
+        return self.construct_causal_graph(causal_relations, self.abn_metrics_by_entity, topo_nodes)
 
     def init_all_cross_host_edges(self):
         all_edges = []
@@ -246,20 +476,173 @@ class ClusterCauseLocator(CauseLocator):
             all_edges.extend(query_res)
         self.all_cross_host_edges = all_edges
 
+        edge_index = {}
+        for edge in all_edges:
+            edge_index.setdefault(edge.from_node.machine_id, []).append(edge)
+            edge_index.setdefault(edge.to_node.machine_id, []).append(edge)
+        self.cross_host_edge_index = edge_index
+
+
+class IncidentCauseLocator(ClusterCauseLocator):
+    """
+    对同一事件中拓扑连通的多个异常KPI共享一棵根因树（一个集群因果图）进行根因定位：
+    - 各异常KPI所在主机的因果图只构建一次，各KPI的主机内根因均作为根因树的根节点挂载；
+    - 跨主机扩展从所有受影响的主机同时开始，只扩展一次；
+    - 异常指标的相关性取与各异常KPI的历史数据的相关系数的最大值，各KPI使用与单独定位时相同的历史数据时间窗口，
+      与 HistPrefetcher 按各KPI的时间窗口预取的结果一致；
+    - 在共享的集群因果图上，对每个异常KPI节点分别运行根因推导策略，输出各自的根因。
+    """
+    def __init__(self, abn_kpis: List[AbnormalEvent], all_abn_metrics: List[AbnormalEvent], topo_db_mgt,
+                 metric_db_mgt, infer_policy: InferPolicy, top_k, deadline: Deadline = None,
+                 max_hops=5, time_budget=30, workers=4, foreign_evt_loader: ForeignEvtLoader = None):
+        super().__init__(abn_kpis[0], all_abn_metrics, topo_db_mgt, metric_db_mgt, infer_policy, top_k, deadline,
+                         max_hops=max_hops, time_budget=time_budget, workers=workers,
+                         foreign_evt_loader=foreign_evt_loader)
+        self.abn_kpis = abn_kpis
+
+    def init_kpi_hist_data(self) -> int:
+        """查询各异常KPI在各自时间窗口内的历史数据，返回最晚的时间窗口结束时间，用于预筛选和趋势计算"""
+        for abn_kpi in self.abn_kpis:
+            if not abn_kpi.hist_data:
+                abn_kpi.set_hist_data(self.metric_db_mgt.query_metric_hist_data(abn_kpi.abnormal_metric_id,
+                                                                                abn_kpi.metric_labels,
+                                                                                get_hist_end_ts(abn_kpi)))
+        return max(get_hist_end_ts(abn_kpi) for abn_kpi in self.abn_kpis)
+
+    def calc_metric_corr(self, metric_id, metric_labels, end_ts) -> (list, float):
+        """按各异常KPI的时间窗口分别查询指标的历史数据，相关系数取各窗口内与对应KPI的相关系数的最大值"""
+        hist_data_by_end_ts = {}
+        corrs = []
+        for abn_kpi in self.abn_kpis:
+            kpi_end_ts = get_hist_end_ts(abn_kpi)
+            metric_hist_data = hist_data_by_end_ts.get(kpi_end_ts)
+            if metric_hist_data is None:
+                metric_hist_data = self.metric_db_mgt.query_metric_hist_data(metric_id, metric_labels, kpi_end_ts)
+                hist_data_by_end_ts[kpi_end_ts] = metric_hist_data
+            corr = abs(pearsonr(abn_kpi.hist_data, metric_hist_data)[0])
+            if not np.isnan(corr):
+                corrs.append(corr)
+        return hist_data_by_end_ts.get(end_ts), max(corrs) if corrs else float('nan')
+
+    def incident_locating(self) -> List[List[Cause]]:
+        """返回与 abn_kpis 一一对应的根因列表"""
+        self.init_topo_timestamp()
+        self.deadline.check('querying cross host edges')
+        self.init_all_cross_host_edges()
+
+        kpi_node_ids = []
+        host_causal_graphs: Dict[str, CausalGraph] = {}
+        frontier: Dict[str, List[MetricNode]] = {}
+        for abn_kpi in self.abn_kpis:
+            self.deadline.check('querying abnormal entity')
+            abn_entity = self.topo_db_mgt.query_entity_by_id(abn_kpi.abnormal_entity_id, self.topo_ts)
+            kpi_node_id = MetricNodeId(abn_entity.id, abn_kpi.abnormal_metric_id)
+            kpi_node_ids.append(kpi_node_id)
+
+            machine_id = abn_entity.machine_id
+            causal_graph = host_causal_graphs.get(machine_id)
+            if causal_graph is None:
+                self.deadline.check('querying host topology')
+                causal_graph = self.construct_host_causal_graph(self.query_host_topo(machine_id))
+                host_causal_graphs[machine_id] = causal_graph
+            causes = self.infer_policy.infer(causal_graph.metric_cause_graph, kpi_node_id, 0)
+            newly_cause_nodes = self.cause_tree.append_all_causes(causes, as_root=True)
+            if len(newly_cause_nodes) > 0:
+                frontier.setdefault(machine_id, []).extend(newly_cause_nodes)
+        if len(frontier) == 0:
+            return [[] for _ in self.abn_kpis]
+
+        if self.deadline.expired():
+            logger.logger.warning('Deadline exceeded, skip cross host cause locating, event_ids={}'.format(
+                [abn_kpi.event_id for abn_kpi in self.abn_kpis]))
+            self.partial = True
+        else:
+            self.expand_cross_host(frontier, 0)
+        cluster_cause_graph = self.cause_tree.to_cause_graph()
+        logger.logger.debug('Incident metric cause graph edges are: {}'.format(cluster_cause_graph.edges))
+        return [self.filter_causes(self.infer_policy.infer(cluster_cause_graph, kpi_node_id, self.top_k))
+                for kpi_node_id in kpi_node_ids]
+
 
-def cause_locating(abnormal_kpi: AbnormalEvent, abnormal_metrics: List[AbnormalEvent]):
+def init_topo_db_mgt() -> ArangodbMgt:
     arango_conf = infer_config.arango_conf
-    prom_conf = infer_config.prometheus_conf
-    infer_conf = infer_config.infer_conf
     arango_db = connect_to_arangodb(arango_conf.get('url'), arango_conf.get('db_name'))
-    arango_db_mgt = ArangodbMgt(arango_db, infer_conf.get('topo_depth'))
+    mgt_cls = SingleFlightArangodbMgt if infer_config.infer_conf.get('single_flight') else ArangodbMgt
+    return mgt_cls(arango_db, infer_config.infer_conf.get('topo_depth'), arango_conf.get('batch_size'))
+
+
+def init_metric_db_mgt() -> PromMgt:
+    prom_conf = infer_config.prometheus_conf
     collector = DataCollectorFactory.get_instance('prometheus', prom_conf)
-    metric_db_mgt = PromMgt(collector, prom_conf.get('sample_duration'), prom_conf.get('step'), ObserveMetaMgt())
+    mgt_cls = SingleFlightPromMgt if infer_config.infer_conf.get('single_flight') else PromMgt
+    return mgt_cls(collector, prom_conf.get('sample_duration'), prom_conf.get('step'), ObserveMetaMgt())
 
-    infer_policy = get_infer_policy(infer_conf.get('infer_policy'))
-    locator = ClusterCauseLocator(abnormal_kpi, abnormal_metrics, arango_db_mgt, metric_db_mgt, infer_policy,
-                                  infer_conf.get('root_topk'))
-    causes = locator.locating()
+
+def group_incident_kpis(abn_kpis: List[AbnormalEvent], topo_db_mgt: ArangodbMgt) -> List[List[AbnormalEvent]]:
+    """
+    按拓扑连通性对异常KPI分组：对应相同拓扑图时间点的异常KPI，若位于同一主机，或所在主机之间存在跨主机边，则属于同一组。
+    分组通过并查集传递合并，无法确定所在主机的异常KPI单独成组。
+    """
+    parents = list(range(len(abn_kpis)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    machines_by_topo: Dict[int, Dict[str, int]] = {}
+    for i, abn_kpi in enumerate(abn_kpis):
+        try:
+            topo_ts = topo_db_mgt.query_recent_topo_ts(abn_kpi.timestamp // 1000)
+            machine_id = topo_db_mgt.query_entity_by_id(abn_kpi.abnormal_entity_id, topo_ts).machine_id
+        except InferenceException as ex:
+            logger.logger.debug(ex)
+            continue
+        machines = machines_by_topo.setdefault(topo_ts, {})
+        if machine_id in machines:
+            parents[find(i)] = find(machines.get(machine_id))
+        else:
+            machines[machine_id] = i
+
+    for topo_ts, machines in machines_by_topo.items():
+        if len(machines) < 2:
+            continue
+        for r_type in (RelationType.RUNS_ON.value, RelationType.STORE_IN.value):
+            try:
+                cross_edges = topo_db_mgt.query_cross_host_edges_detail(r_type, topo_ts)
+            except InferenceException as ex:
+                logger.logger.debug(ex)
+                continue
+            for edge in cross_edges:
+                f_idx = machines.get(edge.from_node.machine_id)
+                t_idx = machines.get(edge.to_node.machine_id)
+                if f_idx is not None and t_idx is not None:
+                    parents[find(f_idx)] = find(t_idx)
+
+    groups: Dict[int, List[AbnormalEvent]] = {}
+    for i, abn_kpi in enumerate(abn_kpis):
+        groups.setdefault(find(i), []).append(abn_kpi)
+    return list(groups.values())
+
+
+def filter_window_evts(abn_metrics: List[AbnormalEvent], abn_kpis: List[AbnormalEvent]) -> List[AbnormalEvent]:
+    """过滤出各异常KPI的有效时间窗口合并后的时间范围内的异常指标事件"""
+    infer_conf = infer_config.infer_conf
+    start_ts = min(abn_kpi.timestamp for abn_kpi in abn_kpis) - infer_conf.get('evt_valid_duration') * 1000
+    end_ts = max(abn_kpi.timestamp for abn_kpi in abn_kpis) + infer_conf.get('evt_future_duration') * 1000
+    return [evt for evt in abn_metrics if start_ts < evt.timestamp <= end_ts]
+
+
+def init_infer_policy() -> InferPolicy:
+    infer_conf = infer_config.infer_conf
+    policy_options = {}
+    if infer_conf.get('infer_policy') == 'rw':
+        policy_options['mode'] = infer_conf.get('rw_mode')
+    return get_infer_policy(infer_conf.get('infer_policy'), **policy_options)
+
+
+def format_locating_result(abnormal_kpi: AbnormalEvent, causes: List[Cause], partial) -> dict:
     if len(causes) == 0:
         return {}
 
@@ -273,4 +656,81 @@ def cause_locating(abnormal_kpi: AbnormalEvent, abnormal_metrics: List[AbnormalE
         ))
 
     res = format_infer_result(causes)
+    if partial:
+        logger.logger.info('Partial inferring result is output, event_id={}'.format(abnormal_kpi.event_id))
+        res['partial'] = True
+    return res
+
+
+def cause_locating(abnormal_kpi: AbnormalEvent, abnormal_metrics: List[AbnormalEvent], topo_db_mgt=None,
+                   metric_db_mgt=None, foreign_evt_loader: ForeignEvtLoader = None):
+    deadline = Deadline(infer_config.infer_conf.get('infer_deadline'))
+    infer_conf = infer_config.infer_conf
+    # 未传入共享的数据库管理对象时，为本次根因定位单独创建
+    arango_db_mgt = topo_db_mgt or init_topo_db_mgt()
+    metric_db_mgt = metric_db_mgt or init_metric_db_mgt()
+
+    locator = ClusterCauseLocator(abnormal_kpi, abnormal_metrics, arango_db_mgt, metric_db_mgt, init_infer_policy(),
+                                  infer_conf.get('root_topk'),
+                                  deadline=deadline,
+                                  max_hops=infer_conf.get('cross_host_max_hops'),
+                                  time_budget=infer_conf.get('cross_host_time_budget'),
+                                  workers=infer_conf.get('cross_host_workers'),
+                                  foreign_evt_loader=foreign_evt_loader)
+    cache_key = None
+    # 分区部署时，缓存键不包含其它实例的主机上的异常指标事件，不使用结果缓存
+    if result_cache.enabled() and foreign_evt_loader is None:
+        locator.init_topo_timestamp()
+        cache_key = result_cache.gen_key(abnormal_kpi, abnormal_metrics, locator.topo_ts)
+        cached_res = result_cache.get(cache_key)
+        if cached_res is not None:
+            logger.logger.info('Reuse cached inferring result, event_id={}'.format(abnormal_kpi.event_id))
+            return reuse_infer_result(cached_res, abnormal_kpi)
+
+    causes = locator.locating()
+    res = format_locating_result(abnormal_kpi, causes, locator.partial)
+    if cache_key is not None and not locator.partial:
+        result_cache.put(cache_key, res)
+    return res
+
+
+def incident_cause_locating(abnormal_kpis: List[AbnormalEvent], abnormal_metrics: List[AbnormalEvent],
+                            topo_db_mgt=None, metric_db_mgt=None,
+                            foreign_evt_loader: ForeignEvtLoader = None) -> List[tuple]:
+    """
+    对一个时间窗口内的多个异常KPI按拓扑连通性分组，每组只构建一个共享的集群因果图进行根因定位。
+    返回 (异常KPI, 根因定位结果) 列表，没有根因或定位失败时结果为空字典。
+    """
+    infer_conf = infer_config.infer_conf
+    arango_db_mgt = topo_db_mgt or init_topo_db_mgt()
+    metric_db_mgt = metric_db_mgt or init_metric_db_mgt()
+
+    res = []
+    for group in group_incident_kpis(abnormal_kpis, arango_db_mgt):
+        group_metrics = filter_window_evts(abnormal_metrics, group)
+        if len(group) == 1:
+            try:
+                res.append((group[0], cause_locating(group[0], group_metrics, arango_db_mgt, metric_db_mgt,
+                                                     foreign_evt_loader)))
+            except InferenceException as ie:
+                logger.logger.warning('{}, event_id={}'.format(ie, group[0].event_id))
+                res.append((group[0], {}))
+            continue
+
+        logger.logger.info('Locate causes of {} abnormal kpis in one incident, event_ids={}'.format(
+            len(group), [abn_kpi.event_id for abn_kpi in group]))
+        locator = IncidentCauseLocator(group, group_metrics, arango_db_mgt, metric_db_mgt, init_infer_policy(),
+                                       infer_conf.get('root_topk'),
+                                       deadline=Deadline(infer_conf.get('infer_deadline')),
+                                       max_hops=infer_conf.get('cross_host_max_hops'),
+                                       time_budget=infer_conf.get('cross_host_time_budget'),
+                                       workers=infer_conf.get('cross_host_workers'),
+                                       foreign_evt_loader=foreign_evt_loader)
+        try:
+            all_causes = locator.incident_locating()
+        except InferenceException as ie:
+            logger.logger.warning('{}, event_ids={}'.format(ie, [abn_kpi.event_id for abn_kpi in group]))
+            all_causes = [[] for _ in group]
+        for abn_kpi, causes in zip(group, all_causes):
+            res.append((abn_kpi, format_locating_result(abn_kpi, causes, locator.partial)))
     return res
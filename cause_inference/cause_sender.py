@@ -0,0 +1,91 @@
+import json
+import logging
+import threading
+import time
+
+from kafka import KafkaProducer
+from kafka.errors import KafkaError
+
+from spider.util import logger
+
+DEFAULT_LINGER_MS = 10
+DEFAULT_BATCH_SIZE = 16384
+DEFAULT_COMPRESSION_TYPE = 'gzip'
+DEFAULT_MAX_OUTSTANDING = 1000
+DEFAULT_SEND_TIMEOUT = 10
+DEFAULT_FLUSH_TIMEOUT = 10
+
+
+class SendStats:
+    def __init__(self):
+        self.submitted = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __repr__(self):
+        with self._lock:
+            return 'SendStats(submitted={}, delivered={}, failed={}, dropped={})'.format(
+                self.submitted, self.delivered, self.failed, self.dropped)
+
+
+class CauseSender:
+    """
+    异步发送根因定位结果消息，根因定位线程只需将消息交给 producer ，无需等待发送完成：
+    - 由 producer 按 linger_ms 和 batch_size 攒批并压缩发送；
+    - 通过发送结果的回调统计发送成功和失败的消息数；
+    - 限制已提交但还未确认的消息数，超过上限时阻塞，等待 send_timeout 后仍未有空位则丢弃该消息；
+    - 服务退出时调用 close ，发送所有缓存的消息。
+    """
+    def __init__(self, producer: KafkaProducer, topic_id, max_outstanding=DEFAULT_MAX_OUTSTANDING,
+                 send_timeout=DEFAULT_SEND_TIMEOUT):
+        self.producer = producer
+        self.topic_id = topic_id
+        self.send_timeout = send_timeout
+        self.slots = threading.BoundedSemaphore(max(max_outstanding, 1))
+        self.stats = SendStats()
+
+    def send(self, cause_msg: dict):
+        event_id = cause_msg.get('Attributes', {}).get('event_id')
+        if logger.logger.isEnabledFor(logging.DEBUG):
+            logger.logger.debug(json.dumps(cause_msg, indent=2))
+
+        if not self.slots.acquire(timeout=self.send_timeout):
+            self.stats.incr('dropped')
+            logger.logger.error('Too many cause inferring events are waiting to be sent, drop event_id={}.'.format(
+                event_id))
+            return
+        try:
+            future = self.producer.send(self.topic_id, json.dumps(cause_msg).encode())
+        except KafkaError as ex:
+            self.slots.release()
+            self.stats.incr('failed')
+            logger.logger.error('Failed to send cause inferring event, event_id={}, because {}'.format(event_id, ex))
+            return
+        self.stats.incr('submitted')
+        future.add_callback(self._on_delivered, event_id)
+        future.add_errback(self._on_failed, event_id)
+
+    def _on_delivered(self, event_id, _):
+        self.slots.release()
+        self.stats.incr('delivered')
+        logger.logger.info('A cause inferring event has been sent to kafka, event_id={}.'.format(event_id))
+
+    def _on_failed(self, event_id, ex):
+        self.slots.release()
+        self.stats.incr('failed')
+        logger.logger.error('Failed to send cause inferring event, event_id={}, because {}'.format(event_id, ex))
+
+    def close(self, timeout=DEFAULT_FLUSH_TIMEOUT):
+        start = time.time()
+        try:
+            self.producer.flush(timeout=timeout)
+        except KafkaError as ex:
+            logger.logger.warning('Failed to flush cause inferring events, because {}'.format(ex))
+        self.producer.close(timeout=max(timeout - (time.time() - start), 0))
+        logger.logger.info('Cause sender closed, {}'.format(self.stats))
@@ -0,0 +1,418 @@
+from collections import deque
+from collections.abc import MutableMapping
+from typing import Dict, List
+
+import networkx as nx
+import numpy as np
+
+_MISSING = object()
+
+
+class AttrTable:
+    """按列存储的属性表，每个属性一列，行号为节点（或边）的编号，没有该属性的行取值为 _MISSING"""
+    def __init__(self):
+        self.size = 0
+        self.columns: Dict[str, list] = {}
+
+    def append_row(self):
+        self.size += 1
+        for column in self.columns.values():
+            column.append(_MISSING)
+
+    def column(self, key) -> list:
+        column = self.columns.get(key)
+        if column is None:
+            column = [_MISSING] * self.size
+            self.columns[key] = column
+        return column
+
+    def values(self, key, default=None) -> list:
+        column = self.columns.get(key)
+        if column is None:
+            return [default] * self.size
+        return [default if value is _MISSING else value for value in column]
+
+    def copy(self) -> 'AttrTable':
+        table = AttrTable()
+        table.size = self.size
+        table.columns = {key: list(column) for key, column in self.columns.items()}
+        return table
+
+
+class AttrView(MutableMapping):
+    """单个节点（或边）的属性视图，接口与 networkx 的属性字典相同"""
+    __slots__ = ('_table', '_columns', '_idx')
+
+    def __init__(self, table: AttrTable, idx: int):
+        self._table = table
+        self._columns = table.columns
+        self._idx = idx
+
+    def __getitem__(self, key):
+        column = self._columns.get(key)
+        if column is None or column[self._idx] is _MISSING:
+            raise KeyError(key)
+        return column[self._idx]
+
+    def __setitem__(self, key, value):
+        self._table.column(key)[self._idx] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self._columns[key][self._idx] = _MISSING
+
+    def __iter__(self):
+        for key, column in self._columns.items():
+            if column[self._idx] is not _MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        column = self._columns.get(key)
+        return column is not None and column[self._idx] is not _MISSING
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def get(self, key, default=None):
+        column = self._columns.get(key)
+        if column is None:
+            return default
+        value = column[self._idx]
+        return default if value is _MISSING else value
+
+
+class NodeView:
+    def __init__(self, graph: 'CompactDiGraph'):
+        self._graph = graph
+
+    def __iter__(self):
+        graph = self._graph
+        return (graph.node_ids[i] for i in graph.alive_node_idxes())
+
+    def __len__(self):
+        return len(self._graph.node_index)
+
+    def __contains__(self, node_id):
+        return node_id in self._graph.node_index
+
+    def __getitem__(self, node_id) -> AttrView:
+        return AttrView(self._graph.node_attrs, self._graph.node_index[node_id])
+
+    def __repr__(self):
+        return 'NodeView({})'.format(tuple(self))
+
+    def items(self):
+        graph = self._graph
+        return ((graph.node_ids[i], AttrView(graph.node_attrs, i)) for i in graph.alive_node_idxes())
+
+
+class EdgeView:
+    def __init__(self, graph: 'CompactDiGraph'):
+        self._graph = graph
+
+    def __iter__(self):
+        graph = self._graph
+        node_ids = graph.node_ids
+        return ((node_ids[graph.edge_src[e]], node_ids[graph.edge_dst[e]]) for e in graph.alive_edge_idxes())
+
+    def __len__(self):
+        return len(self._graph.edge_index)
+
+    def __contains__(self, edge):
+        return self._graph.get_edge_idx(edge[0], edge[1]) is not None
+
+    def __getitem__(self, edge) -> AttrView:
+        e = self._graph.get_edge_idx(edge[0], edge[1])
+        if e is None:
+            raise KeyError(edge)
+        return AttrView(self._graph.edge_attrs, e)
+
+    def __repr__(self):
+        return 'EdgeView({})'.format(list(self))
+
+
+class CompactDiGraph:
+    """
+    整数索引的紧凑有向图，提供 CausalGraph、RuleEngine.add_rule_meta 和根因推导策略所用的 networkx DiGraph 接口子集。
+    - 节点按加入顺序编号，边以起点、终点编号数组存储；
+    - 节点属性和边属性按列存储，不为每个节点和每条边创建属性字典；
+    - 邻接关系在首次查询时构建为 CSR 格式，图修改后重新构建；
+    - 各节点关联的边编号列表在首次删除节点时构建，删除节点只访问其关联的边；
+    - 前驱、后继的顺序与 networkx 相同，即边的加入顺序。
+    """
+    def __init__(self):
+        self.node_ids: list = []
+        self.node_index: dict = {}
+        self.node_alive: List[bool] = []
+        self.node_attrs = AttrTable()
+
+        self.edge_src: List[int] = []
+        self.edge_dst: List[int] = []
+        self.edge_attrs = AttrTable()
+        self.edge_index: Dict[int, int] = {}
+        self.edge_alive: List[bool] = []
+        self._removed = False
+        # 各节点关联（作为起点或终点）的边编号，None 表示还未构建
+        self._incident_edges = None
+
+        self._succ_csr = None
+        self._pred_csr = None
+        self.nodes = NodeView(self)
+        self.edges = EdgeView(self)
+
+    def __contains__(self, node_id):
+        return node_id in self.node_index
+
+    def __len__(self):
+        return len(self.node_index)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def alive_node_idxes(self):
+        if not self._removed:
+            return range(len(self.node_ids))
+        return (i for i, alive in enumerate(self.node_alive) if alive)
+
+    def alive_edge_idxes(self):
+        if not self._removed:
+            return range(len(self.edge_src))
+        return (e for e, alive in enumerate(self.edge_alive) if alive)
+
+    @staticmethod
+    def _edge_key(src, dst):
+        return (src << 32) | dst
+
+    def node_attr_values(self, key, default=None) -> list:
+        """按节点编号返回某个属性的整列取值，没有该属性的节点取 default"""
+        return self.node_attrs.values(key, default)
+
+    def edge_idx_items(self):
+        """遍历边，返回 (起点编号, 终点编号, 边属性视图)"""
+        for e in list(self.alive_edge_idxes()):
+            yield self.edge_src[e], self.edge_dst[e], AttrView(self.edge_attrs, e)
+
+    def get_edge_idx(self, from_id, to_id):
+        src = self.node_index.get(from_id)
+        dst = self.node_index.get(to_id)
+        if src is None or dst is None:
+            return None
+        return self.edge_index.get(self._edge_key(src, dst))
+
+    def _add_node_idx(self, node_id) -> int:
+        idx = self.node_index.get(node_id)
+        if idx is not None:
+            return idx
+        idx = len(self.node_ids)
+        self.node_ids.append(node_id)
+        self.node_index[node_id] = idx
+        self.node_alive.append(True)
+        self.node_attrs.append_row()
+        self._succ_csr = self._pred_csr = None
+        return idx
+
+    def add_node(self, node_id, **attrs):
+        idx = self._add_node_idx(node_id)
+        for key, value in attrs.items():
+            self.node_attrs.column(key)[idx] = value
+
+    def add_edge(self, from_id, to_id, **attrs):
+        src = self.node_index.get(from_id)
+        if src is None:
+            src = self._add_node_idx(from_id)
+        dst = self.node_index.get(to_id)
+        if dst is None:
+            dst = self._add_node_idx(to_id)
+        key = self._edge_key(src, dst)
+        e = self.edge_index.get(key)
+        if e is None:
+            e = len(self.edge_src)
+            self.edge_index[key] = e
+            self.edge_src.append(src)
+            self.edge_dst.append(dst)
+            self.edge_attrs.append_row()
+            self.edge_alive.append(True)
+            self._succ_csr = self._pred_csr = None
+            if self._incident_edges is not None:
+                self._add_incident_edge(src, dst, e)
+        for key, value in attrs.items():
+            self.edge_attrs.column(key)[e] = value
+
+    def _add_incident_edge(self, src, dst, e):
+        incident_edges = self._incident_edges
+        while len(incident_edges) < len(self.node_ids):
+            incident_edges.append([])
+        incident_edges[src].append(e)
+        if dst != src:
+            incident_edges[dst].append(e)
+
+    def incident_edges(self) -> List[List[int]]:
+        if self._incident_edges is None:
+            self._incident_edges = []
+            for e in self.alive_edge_idxes():
+                self._add_incident_edge(self.edge_src[e], self.edge_dst[e], e)
+            while len(self._incident_edges) < len(self.node_ids):
+                self._incident_edges.append([])
+        return self._incident_edges
+
+    def remove_node(self, node_id):
+        idx = self.node_index.pop(node_id)
+        self.node_alive[idx] = False
+        incident_edges = self.incident_edges()
+        if idx < len(incident_edges):
+            for e in incident_edges[idx]:
+                if self.edge_alive[e]:
+                    self.edge_alive[e] = False
+                    del self.edge_index[self._edge_key(self.edge_src[e], self.edge_dst[e])]
+            incident_edges[idx] = []
+        self._removed = True
+        self._succ_csr = self._pred_csr = None
+
+    def _build_csr(self, rows, cols):
+        edge_idxes = np.fromiter(self.alive_edge_idxes(), dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)[edge_idxes]
+        cols = np.asarray(cols, dtype=np.int64)[edge_idxes]
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.node_ids)), out=indptr[1:])
+        return indptr.tolist(), cols[order].tolist()
+
+    def succ_csr(self):
+        if self._succ_csr is None:
+            self._succ_csr = self._build_csr(self.edge_src, self.edge_dst)
+        return self._succ_csr
+
+    def pred_csr(self):
+        if self._pred_csr is None:
+            self._pred_csr = self._build_csr(self.edge_dst, self.edge_src)
+        return self._pred_csr
+
+    def successor_idxes(self, idx) -> List[int]:
+        indptr, indices = self.succ_csr()
+        return indices[indptr[idx]:indptr[idx + 1]]
+
+    def predecessor_idxes(self, idx) -> List[int]:
+        indptr, indices = self.pred_csr()
+        return indices[indptr[idx]:indptr[idx + 1]]
+
+    def successors(self, node_id):
+        node_ids = self.node_ids
+        return iter([node_ids[j] for j in self.successor_idxes(self.node_index[node_id])])
+
+    def predecessors(self, node_id):
+        node_ids = self.node_ids
+        return iter([node_ids[j] for j in self.predecessor_idxes(self.node_index[node_id])])
+
+    def in_degree(self, node_id):
+        return len(self.predecessor_idxes(self.node_index[node_id]))
+
+    def out_degree(self, node_id):
+        return len(self.successor_idxes(self.node_index[node_id]))
+
+    def copy(self) -> 'CompactDiGraph':
+        graph = CompactDiGraph()
+        graph.node_ids = list(self.node_ids)
+        graph.node_index = dict(self.node_index)
+        graph.node_alive = list(self.node_alive)
+        graph.node_attrs = self.node_attrs.copy()
+        graph.edge_src = list(self.edge_src)
+        graph.edge_dst = list(self.edge_dst)
+        graph.edge_attrs = self.edge_attrs.copy()
+        graph.edge_index = dict(self.edge_index)
+        graph.edge_alive = list(self.edge_alive)
+        graph._removed = self._removed
+        graph._succ_csr = self._succ_csr
+        graph._pred_csr = self._pred_csr
+        return graph
+
+    def subgraph(self, node_ids) -> 'CompactDiGraph':
+        """返回节点导出子图，节点和边的顺序与原图相同，属性值与原图共享同一个对象"""
+        idxes = sorted(self.node_index[node_id] for node_id in node_ids if node_id in self.node_index)
+        idx_set = set(idxes)
+        graph = CompactDiGraph()
+        for i in idxes:
+            graph.add_node(self.node_ids[i], **AttrView(self.node_attrs, i))
+        for e in self.alive_edge_idxes():
+            if self.edge_src[e] in idx_set and self.edge_dst[e] in idx_set:
+                graph.add_edge(self.node_ids[self.edge_src[e]], self.node_ids[self.edge_dst[e]],
+                               **AttrView(self.edge_attrs, e))
+        return graph
+
+    def to_networkx(self) -> nx.DiGraph:
+        """导出为 networkx DiGraph，仅用于调试"""
+        graph = nx.DiGraph()
+        for node_id, node_attrs in self.nodes.items():
+            graph.add_node(node_id, **node_attrs)
+        for edge in self.edges:
+            graph.add_edge(*edge, **self.edges[edge])
+        return graph
+
+
+def ancestors(graph, node_id) -> set:
+    if isinstance(graph, nx.DiGraph):
+        return nx.ancestors(graph, node_id)
+    start = graph.node_index[node_id]
+    seen = {start}
+    queue = deque([start])
+    while queue:
+        for j in graph.predecessor_idxes(queue.popleft()):
+            if j not in seen:
+                seen.add(j)
+                queue.append(j)
+    seen.discard(start)
+    return {graph.node_ids[j] for j in seen}
+
+
+def topological_sort(graph) -> list:
+    """拓扑排序，图中存在环时抛出 networkx.NetworkXUnfeasible"""
+    if isinstance(graph, nx.DiGraph):
+        return list(nx.topological_sort(graph))
+    idxes = list(graph.alive_node_idxes())
+    in_degree = {i: len(graph.predecessor_idxes(i)) for i in idxes}
+    queue = deque(i for i in idxes if in_degree[i] == 0)
+    res = []
+    while queue:
+        i = queue.popleft()
+        res.append(graph.node_ids[i])
+        for j in graph.successor_idxes(i):
+            in_degree[j] -= 1
+            if in_degree[j] == 0:
+                queue.append(j)
+    if len(res) != len(idxes):
+        raise nx.NetworkXUnfeasible('Graph contains a cycle.')
+    return res
+
+
+def is_directed_acyclic_graph(graph) -> bool:
+    if isinstance(graph, nx.DiGraph):
+        return nx.is_directed_acyclic_graph(graph)
+    try:
+        topological_sort(graph)
+    except nx.NetworkXUnfeasible:
+        return False
+    return True
+
+
+def shortest_path(graph, source_id, target_id) -> list:
+    """无权最短路径，不存在时抛出 networkx.NetworkXNoPath"""
+    if isinstance(graph, nx.DiGraph):
+        return nx.shortest_path(graph, source_id, target_id)
+    source, target = graph.node_index[source_id], graph.node_index[target_id]
+    parents = {source: None}
+    queue = deque([source])
+    while queue:
+        i = queue.popleft()
+        if i == target:
+            path = []
+            while i is not None:
+                path.append(graph.node_ids[i])
+                i = parents[i]
+            return path[::-1]
+        for j in graph.successor_idxes(i):
+            if j not in parents:
+                parents[j] = i
+                queue.append(j)
+    raise nx.NetworkXNoPath('No path between {} and {}.'.format(source_id, target_id))
@@ -14,9 +14,33 @@ class InferConfig:
             'topo_depth': 10,
             'root_topk': 3,
             'infer_policy': 'dfs',
+            'rw_mode': 'walk',
             'evt_valid_duration': 120,
             'evt_future_duration': 60,
             'evt_aging_duration': 600,
+            'infer_deadline': 0,
+            'cross_host_max_hops': 5,
+            'cross_host_time_budget': 30,
+            'cross_host_workers': 4,
+            'infer_workers': 1,
+            'incident_window': 0,
+            'result_cache_ttl': 0,
+            'snapshot_path': '',
+            'snapshot_interval': 30,
+            'partition_count': 1,
+            'partition_index': 0,
+            'single_flight': True,
+            'prescreen_metrics': False,
+            'prescreen_min_abnormal_score': 0,
+            'prescreen_batch_size': 50,
+            'prescreen_summary_step': 0,
+            'hist_prefetch': True,
+            'prefetch_workers': 4,
+            'prefetch_safe_lag': 15,
+            'prefetch_max_metrics': 200,
+            'warm_skeleton': True,
+            'warm_interval': 10,
+            'warm_topo_num': 3,
         }
 
         self.log_conf = {
@@ -36,24 +60,39 @@ class InferConfig:
                 'topic_id': '',
                 'group_id': 'abn-kpi-inference',
                 'consumer_to': 1,
+                'max_records': 500,
+                'queue_size': 10000,
             },
             'abnormal_metric_topic': {
                 'topic_id': '',
                 'group_id': 'abn-metric-inference',
                 'consumer_to': 1,
+                'max_records': 500,
+                'queue_size': 10000,
+                'seek_by_time': False,
+                'seek_workers': 4,
             },
             'inference_topic': {
                 'topic_id': '',
-            }
+                'linger_ms': 10,
+                'batch_size': 16384,
+                'compression_type': 'gzip',
+                'max_outstanding': 1000,
+                'send_timeout': 10,
+            },
+            'json_codec': 'json',
+            'stats_interval': 60,
         }
 
         self.arango_conf = {
             'url': '',
             'db_name': '',
+            'batch_size': 1000,
         }
 
         self.prometheus_conf = {
             'base_url': '',
+            'instant_api': '/api/v1/query',
             'range_api': '',
             'sample_duration': 600,
             'step': 5,
@@ -1,44 +1,75 @@
-from typing import List
+from typing import List, Optional, Tuple
 
 from spider.collector import DataCollector, DataRecord
+from spider.collector.prometheus_collector import generate_query_sql
 from spider.conf.observe_meta import RelationType, EntityType, ObserveMetaMgt
 from spider.exceptions import MetadataException
 from spider.util import logger
+from spider.util.entity import MACHINE_ID_NAME
+from spider.util.entity import concate_entity_id
+from spider.util.entity import escape_entity_id
 
+from cause_inference.arangodb import DEFAULT_BATCH_SIZE
 from cause_inference.arangodb import query_cross_host_edges_detail
+from cause_inference.arangodb import query_entity_by_key
 from cause_inference.arangodb import query_recent_topo_ts
 from cause_inference.arangodb import query_subgraph
 from cause_inference.arangodb import query_topo_entities
 from cause_inference.config import infer_config
 from cause_inference.exceptions import InferenceException
 from cause_inference.model import HostTopo, TopoNode, TopoEdge
+from cause_inference.single_flight import SingleFlight, freeze_key
+
+# 批量汇总查询中，用于区分各个指标查询结果的标签
+SUMMARY_QUERY_LABEL = 'infer_query_idx'
+DEFAULT_SUMMARY_BATCH_SIZE = 50
 
 
 class ArangodbMgt:
-    def __init__(self, db, topo_depth):
+    def __init__(self, db, topo_depth, batch_size=DEFAULT_BATCH_SIZE):
         self.db = db
         self.topo_depth = topo_depth
+        self.batch_size = batch_size
 
         self.topo_edge_types = [
             RelationType.BELONGS_TO.value,
             RelationType.RUNS_ON.value
         ]
 
-    def query_host_topo(self, machine_id, ts_sec) -> HostTopo:
+    @staticmethod
+    def get_host_entity_key(machine_id) -> str:
+        host_meta = ObserveMetaMgt().get_observe_meta(EntityType.HOST.value)
+        if host_meta is None:
+            return ''
+        labels = {MACHINE_ID_NAME: machine_id}
+        return escape_entity_id(concate_entity_id(EntityType.HOST.value, labels, host_meta.keys))
+
+    def query_host_entity(self, machine_id, ts_sec) -> TopoNode:
+        host_key = self.get_host_entity_key(machine_id)
+        if host_key:
+            host_entity = query_entity_by_key(self.db, ts_sec, host_key)
+            if host_entity is not None and host_entity.entity_type == EntityType.HOST.value \
+                    and host_entity.machine_id == machine_id:
+                return host_entity
+
+        # 无法通过主键定位主机时，退化为按属性过滤查询
         query_options = {
             'type': EntityType.HOST.value,
             'machine_id': machine_id
         }
-        host_entities = query_topo_entities(self.db, ts_sec, query_options=query_options)
+        host_entities = query_topo_entities(self.db, ts_sec, query_options=query_options, batch_size=self.batch_size)
         if len(host_entities) == 0:
             raise InferenceException('Can not find machine {} satisfied.'.format(machine_id))
         if len(host_entities) > 1:
             raise InferenceException('Multiple hosts with the same machine id {} found.'.format(machine_id))
+        return host_entities[0]
 
-        host_entity = host_entities[0]
+    def query_host_topo(self, machine_id, ts_sec) -> HostTopo:
+        host_entity = self.query_host_entity(machine_id, ts_sec)
         nodes, edges = query_subgraph(self.db, ts_sec, host_entity.entity_id, self.topo_edge_types,
                                       depth=self.topo_depth,
-                                      query_options={'machine_id': machine_id})
+                                      query_options={'machine_id': machine_id},
+                                      batch_size=self.batch_size)
         nodes.setdefault(host_entity.id, host_entity)
         for edge in edges.values():
             edge.from_node = nodes.get(edge.from_id)
@@ -47,12 +78,15 @@ class ArangodbMgt:
         return HostTopo(machine_id, nodes, edges)
 
     def query_entity_by_id(self, entity_id, ts_sec) -> TopoNode:
-        entities = query_topo_entities(self.db, ts_sec, query_options={'_key': entity_id})
-        if len(entities) == 0:
+        entity = query_entity_by_key(self.db, ts_sec, entity_id)
+        if entity is None:
             raise InferenceException('Can not find entity {} satisfied.'.format(entity_id))
-        if len(entities) > 1:
-            raise InferenceException('Multiple entities with the same entity id {} found.'.format(entity_id))
-        return entities[0]
+        return entity
+
+    def query_all_machine_ids(self, ts_sec) -> List[str]:
+        host_entities = query_topo_entities(self.db, ts_sec, query_options={'type': EntityType.HOST.value},
+                                            batch_size=self.batch_size)
+        return [host_entity.machine_id for host_entity in host_entities if host_entity.machine_id]
 
     def query_recent_topo_ts(self, ts_sec) -> int:
         recent_ts = query_recent_topo_ts(self.db, ts_sec)
@@ -61,7 +95,7 @@ class ArangodbMgt:
         return recent_ts
 
     def query_cross_host_edges_detail(self, edge_type, ts_sec) -> List[TopoEdge]:
-        return query_cross_host_edges_detail(self.db, edge_type, ts_sec)
+        return query_cross_host_edges_detail(self.db, edge_type, ts_sec, batch_size=self.batch_size)
 
 
 class PromMgt:
@@ -70,16 +104,20 @@ class PromMgt:
         self.sample_duration = sample_duration
         self.sample_step = sample_step
         self.obsv_meta_mgt = obsv_meta_mgt
+        # 配置后，优先使用未来周期等待期间预取的历史数据，见 cause_inference.prefetch.HistPrefetcher
+        self.hist_prefetcher = None
 
     def query_metric_hist_data(self, metric_id, metric_labels, end_ts) -> list:
-        start_ts = end_ts - self.sample_duration
         try:
             query_options = self.obsv_meta_mgt.get_entity_keys_of_metric(metric_id, metric_labels)
         except MetadataException as ex:
             logger.logger.debug(ex)
             return self.fill_empty_hist_data()
-        records = self.collector.get_range_data(metric_id, start_ts, end_ts, query_options=query_options,
-                                                step=self.sample_step)
+        records = None
+        if self.hist_prefetcher is not None:
+            records = self.hist_prefetcher.get_records(metric_id, query_options, end_ts)
+        if records is None:
+            records = self.query_hist_records(metric_id, query_options, end_ts - self.sample_duration, end_ts)
         if len(records) == 0:
             logger.logger.warning('No history data of the metric {}'.format(metric_id))
             return self.fill_empty_hist_data()
@@ -87,6 +125,59 @@ class PromMgt:
         hist_data = self.fill_hist_data(records, end_ts)
         return hist_data
 
+    def query_hist_records(self, metric_id, query_options: dict, start_ts, end_ts) -> List[DataRecord]:
+        return self.collector.get_range_data(metric_id, start_ts, end_ts, query_options=query_options,
+                                             step=self.sample_step)
+
+    def query_metric_summaries(self, metrics: List[Tuple[str, dict]], end_ts, batch_size=DEFAULT_SUMMARY_BATCH_SIZE,
+                               step=0) -> List[Optional[float]]:
+        """
+        通过一次即时查询，批量获取多个指标在历史数据时间窗口内的低精度汇总值，用于在查询完整历史数据前预筛选指标。
+        每个指标的汇总值为：时间窗口内的标准差，采样点数少于按历史数据的采样步长应有的点数时再加 1 。
+        step 为 0 时直接在原始采样点上计算，不使用子查询，采集周期大于历史数据的采样步长时采样点数总是不足，
+        取值不变的指标不会被跳过；step 大于 0 时按该步长通过子查询重新采样后计算，步长越大查询代价越低。
+        汇总值为 0 表示历史数据完整且取值不变；为 None 表示没有历史数据；
+        一批查询没有任何结果时，无法区分查询失败和没有数据，该批指标的汇总值为 nan 。
+        各指标的查询通过 label_replace 添加序号标签后以 or 连接。
+        """
+        summaries: List[Optional[float]] = [None] * len(metrics)
+        exprs = []
+        for idx, (metric_id, metric_labels) in enumerate(metrics):
+            try:
+                query_options = self.obsv_meta_mgt.get_entity_keys_of_metric(metric_id, metric_labels)
+            except MetadataException as ex:
+                logger.logger.debug(ex)
+                continue
+            exprs.append((idx, self.gen_summary_expr(idx, generate_query_sql(metric_id, query_options), step)))
+
+        batch_size = max(batch_size or DEFAULT_SUMMARY_BATCH_SIZE, 1)
+        for i in range(0, len(exprs), batch_size):
+            batch = exprs[i:i + batch_size]
+            records = self.collector.get_instant_data(' or '.join(expr for _, expr in batch), end_ts)
+            if not records:
+                for idx, _ in batch:
+                    summaries[idx] = float('nan')
+                continue
+            for record in records:
+                idx = next((int(label.value) for label in record.labels if label.name == SUMMARY_QUERY_LABEL), None)
+                if idx is None or idx >= len(summaries):
+                    continue
+                value = float(record.metric_value)
+                # 查询条件匹配多个时间序列时，取最大值
+                summaries[idx] = value if summaries[idx] is None else max(summaries[idx], value)
+        return summaries
+
+    def gen_summary_expr(self, idx, selector: str, step=0) -> str:
+        if step and step > 0:
+            sample_num = self.sample_duration // step
+            window = '[{}s:{}s]'.format(self.sample_duration, step)
+        else:
+            sample_num = self.sample_duration // self.sample_step
+            window = '[{}s]'.format(self.sample_duration)
+        expr = 'stddev_over_time({sel}{win}) + (count_over_time({sel}{win}) < bool {num})'.format(
+            sel=selector, win=window, num=sample_num)
+        return 'label_replace({}, "{}", "{}", "", "")'.format(expr, SUMMARY_QUERY_LABEL, idx)
+
     def fill_hist_data(self, records: List[DataRecord], end_ts: float) -> list:
         sample_num = self.sample_duration // self.sample_step
         start_ts = end_ts - self.sample_duration
@@ -110,3 +201,40 @@ class PromMgt:
     def fill_empty_hist_data(self):
         sample_num = self.sample_duration // self.sample_step
         return [0.0] * sample_num
+
+
+class SingleFlightArangodbMgt(ArangodbMgt):
+    """并发的相同拓扑查询只向 arangodb 发起一次，共享查询结果"""
+    def __init__(self, db, topo_depth, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(db, topo_depth, batch_size)
+        self.flight = SingleFlight('arangodb')
+
+    def query_host_entity(self, machine_id, ts_sec) -> TopoNode:
+        return self.flight.do(('host_entity', machine_id, ts_sec), super().query_host_entity, machine_id, ts_sec)
+
+    def query_host_topo(self, machine_id, ts_sec) -> HostTopo:
+        return self.flight.do(('host_topo', machine_id, ts_sec), super().query_host_topo, machine_id, ts_sec)
+
+    def query_entity_by_id(self, entity_id, ts_sec) -> TopoNode:
+        return self.flight.do(('entity', entity_id, ts_sec), super().query_entity_by_id, entity_id, ts_sec)
+
+    def query_all_machine_ids(self, ts_sec) -> List[str]:
+        return list(self.flight.do(('machine_ids', ts_sec), super().query_all_machine_ids, ts_sec))
+
+    def query_recent_topo_ts(self, ts_sec) -> int:
+        return self.flight.do(('recent_topo_ts', ts_sec), super().query_recent_topo_ts, ts_sec)
+
+    def query_cross_host_edges_detail(self, edge_type, ts_sec) -> List[TopoEdge]:
+        return list(self.flight.do(('cross_host_edges', edge_type, ts_sec), super().query_cross_host_edges_detail,
+                                   edge_type, ts_sec))
+
+
+class SingleFlightPromMgt(PromMgt):
+    """并发的相同指标历史数据查询只向 prometheus 发起一次，共享查询结果"""
+    def __init__(self, collector: DataCollector, sample_duration, sample_step, obsv_meta_mgt: ObserveMetaMgt):
+        super().__init__(collector, sample_duration, sample_step, obsv_meta_mgt)
+        self.flight = SingleFlight('prometheus')
+
+    def query_metric_hist_data(self, metric_id, metric_labels, end_ts) -> list:
+        key = (metric_id, freeze_key(metric_labels), end_ts)
+        return list(self.flight.do(key, super().query_metric_hist_data, metric_id, metric_labels, end_ts))
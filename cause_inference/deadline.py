@@ -0,0 +1,21 @@
+import time
+
+from cause_inference.exceptions import DeadlineExceededException
+
+
+class Deadline:
+    def __init__(self, budget=None):
+        # budget 为空或不大于 0 时，表示不限制时间
+        self.expire_at = time.time() + budget if budget and budget > 0 else None
+
+    def remaining(self) -> float:
+        if self.expire_at is None:
+            return float('inf')
+        return max(0.0, self.expire_at - time.time())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str):
+        if self.expired():
+            raise DeadlineExceededException('Deadline exceeded before {}.'.format(stage))
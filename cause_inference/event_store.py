@@ -0,0 +1,60 @@
+import threading
+from bisect import bisect_left, bisect_right
+from typing import List
+
+from cause_inference.model import AbnormalEvent
+
+
+class AbnEvtStore:
+    """
+    按时间戳有序存储的异常事件集合。
+    - 时间窗口查询通过二分查找定位，复杂度为 O(log n + k)；
+    - 老化从头部批量移除，均摊复杂度为 O(1)。
+    """
+    def __init__(self):
+        # 有序数组的有效部分为 [_head, len)，老化时只移动 _head，超过一半时再整体压缩
+        self._ts: List[int] = []
+        self._evts: List[AbnormalEvent] = []
+        self._head = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._evts) - self._head
+
+    def add(self, evt: AbnormalEvent):
+        with self._lock:
+            if not self._ts or evt.timestamp >= self._ts[-1]:
+                self._ts.append(evt.timestamp)
+                self._evts.append(evt)
+            else:
+                pos = bisect_right(self._ts, evt.timestamp, lo=self._head)
+                self._ts.insert(pos, evt.timestamp)
+                self._evts.insert(pos, evt)
+
+    def extend(self, evts: List[AbnormalEvent]):
+        with self._lock:
+            for evt in evts:
+                self.add(evt)
+
+    def query(self, start_ts, end_ts) -> List[AbnormalEvent]:
+        """查询时间戳在 (start_ts, end_ts] 范围内的事件"""
+        with self._lock:
+            lo = bisect_right(self._ts, start_ts, lo=self._head)
+            hi = bisect_right(self._ts, end_ts, lo=lo)
+            return self._evts[lo:hi]
+
+    def get_all(self) -> List[AbnormalEvent]:
+        """按时间戳顺序返回所有未老化的事件"""
+        with self._lock:
+            return self._evts[self._head:]
+
+    def clear_before(self, ts):
+        """老化时间戳小于 ts 的事件"""
+        with self._lock:
+            self._head = bisect_left(self._ts, ts, lo=self._head)
+            if self._head > len(self._ts) // 2:
+                del self._ts[:self._head]
+                del self._evts[:self._head]
+                self._head = 0
+
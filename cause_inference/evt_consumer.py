@@ -0,0 +1,247 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from typing import Dict, List
+
+from kafka import ConsumerRebalanceListener
+from kafka import KafkaConsumer
+from kafka import TopicPartition
+from kafka.errors import KafkaError
+
+from spider.util import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_MAX_RECORDS = 500
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_STATS_INTERVAL = 60
+DEFAULT_SEEK_WORKERS = 4
+
+
+def get_json_decoder(codec: str):
+    if codec == 'orjson':
+        if orjson is not None:
+            return orjson.loads
+        logger.logger.warning('JSON codec orjson is not installed, use json instead.')
+    return json.loads
+
+
+class TopicStats:
+    def __init__(self, topic_name):
+        self.topic_name = topic_name
+        self.consumed = 0
+        self.decode_errors = 0
+        # 各分区的消费延迟，即分区高水位与已消费位置之间的消息数
+        self.partition_lag = {}
+        self._lock = threading.Lock()
+        self._last_report_ts = time.time()
+        self._last_report_consumed = 0
+
+    def record(self, consumed, decode_errors):
+        with self._lock:
+            self.consumed += consumed
+            self.decode_errors += decode_errors
+
+    def update_lag(self, partition, lag):
+        with self._lock:
+            self.partition_lag[partition] = lag
+
+    @property
+    def lag(self):
+        with self._lock:
+            return sum(self.partition_lag.values())
+
+    def report(self):
+        with self._lock:
+            now = time.time()
+            throughput = (self.consumed - self._last_report_consumed) / max(now - self._last_report_ts, 1e-6)
+            self._last_report_ts = now
+            self._last_report_consumed = self.consumed
+            lag = sum(self.partition_lag.values())
+        logger.logger.info('Topic {}: consumed={}, decode_errors={}, lag={}, throughput={:.1f} msg/s.'.format(
+            self.topic_name, self.consumed, self.decode_errors, lag, throughput))
+
+
+class EvtConsumeThread(threading.Thread):
+    """
+    使用独立线程批量拉取 kafka 消息，解码后放入有界队列，队列满时阻塞拉取。
+    """
+    def __init__(self, consumer: KafkaConsumer, topic_name, consumer_to, max_records=DEFAULT_MAX_RECORDS,
+                 queue_size=DEFAULT_QUEUE_SIZE, codec='json', stats_interval=DEFAULT_STATS_INTERVAL):
+        super().__init__()
+        self.consumer = consumer
+        self.consumer_to = consumer_to
+        self.max_records = max_records
+        self.queue = Queue(maxsize=queue_size)
+        self.decode = get_json_decoder(codec)
+        self.stats = TopicStats(topic_name)
+        self.stats_interval = stats_interval
+        # 各分区已处理完成的下一条消息的位移，用于状态快照
+        self.delivered_offsets: Dict[int, int] = {}
+        self._offsets_lock = threading.Lock()
+        # 最近一次取出、还未确认处理完成的消息的分区和位移，只由处理线程访问
+        self._unacked = None
+
+    def run(self):
+        last_report_ts = time.time()
+        while True:
+            self.poll_once()
+            if self.stats_interval and time.time() - last_report_ts >= self.stats_interval:
+                self.stats.report()
+                last_report_ts = time.time()
+
+    def poll_once(self):
+        records = self.consumer.poll(timeout_ms=self.consumer_to * 1000, max_records=self.max_records)
+        for tp, msgs in records.items():
+            decode_errors = 0
+            for msg in msgs:
+                try:
+                    data = self.decode(msg.value)
+                except (ValueError, TypeError) as ex:
+                    logger.logger.warning(ex)
+                    decode_errors += 1
+                    continue
+                self.queue.put((tp.partition, msg.offset, data))
+            self.stats.record(len(msgs) - decode_errors, decode_errors)
+            if msgs:
+                self.update_lag(tp, msgs[-1].offset)
+
+    def update_lag(self, tp, last_offset):
+        highwater = self.consumer.highwater(tp)
+        if highwater is not None:
+            self.stats.update_lag(tp.partition, max(highwater - last_offset - 1, 0))
+
+    def get(self):
+        """获取一条解码后的消息，等待消费超时时间后仍没有消息时返回 None"""
+        return self.wait(self.consumer_to)
+
+    def wait(self, timeout=None):
+        """
+        获取一条解码后的消息，等待 timeout 秒后仍没有消息时返回 None，timeout 为 None 时一直阻塞。
+        处理方处理完消息后需要调用 ack() 确认，确认后的位移才会记录到状态快照中。
+        """
+        try:
+            partition, offset, data = self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+        self._unacked = (partition, offset)
+        return data
+
+    def ack(self):
+        """确认最近一次取出的消息已处理完成"""
+        if self._unacked is None:
+            return
+        partition, offset = self._unacked
+        self._unacked = None
+        with self._offsets_lock:
+            self.delivered_offsets[partition] = offset + 1
+
+    def get_delivered_offsets(self) -> Dict[int, int]:
+        with self._offsets_lock:
+            return dict(self.delivered_offsets)
+
+
+class OffsetRestoreListener(ConsumerRebalanceListener):
+    """分区分配给消费者后，将分区位移恢复到状态快照中保存的位置，每个分区只恢复一次"""
+    def __init__(self, consumer: KafkaConsumer, offsets: Dict[int, int]):
+        self.consumer = consumer
+        self.offsets = dict(offsets)
+
+    def on_partitions_revoked(self, revoked):
+        pass
+
+    def on_partitions_assigned(self, assigned):
+        for tp in assigned:
+            offset = self.offsets.pop(tp.partition, None)
+            if offset is None:
+                continue
+            logger.logger.info('Restore offset of topic {} partition {} to {}.'.format(tp.topic, tp.partition, offset))
+            self.consumer.seek(tp, offset)
+
+
+class TimeSeekReader:
+    """
+    按时间查找 kafka 位移，直接读取各分区在时间窗口内的消息，各分区并行读取。
+    读取耗时只与时间窗口内的消息量相关，与积压的消息量无关。
+    每个分区使用一个独立的、不加入消费者组的消费者，避免多线程共享同一个消费者。
+    """
+    def __init__(self, consumer_factory, topic, consumer_to, max_records=DEFAULT_MAX_RECORDS,
+                 workers=DEFAULT_SEEK_WORKERS, codec='json'):
+        self.consumer_factory = consumer_factory
+        self.topic = topic
+        self.consumer_to = consumer_to
+        self.max_records = max_records
+        self.workers = workers
+        self.decode = get_json_decoder(codec)
+        self.consumers = {}
+
+    def get_consumer(self, partition) -> KafkaConsumer:
+        consumer = self.consumers.get(partition)
+        if consumer is None:
+            consumer = self.consumer_factory()
+            consumer.assign([TopicPartition(self.topic, partition)])
+            self.consumers[partition] = consumer
+        return consumer
+
+    def read_window(self, start_ts, end_ts) -> List[dict]:
+        """
+        读取时间戳在 (start_ts, end_ts] 范围内的消息，时间戳单位：毫秒。
+        读取失败的分区只记录日志并返回已读取的消息，不影响其它分区和调用方。
+        """
+        try:
+            if not self.consumers:
+                self.get_consumer(0)
+            partitions = next(iter(self.consumers.values())).partitions_for_topic(self.topic) or set()
+            consumers = [(partition, self.get_consumer(partition)) for partition in sorted(partitions)]
+        except KafkaError as ex:
+            logger.logger.warning('Failed to get partitions of topic {}, because {}'.format(self.topic, ex))
+            return []
+
+        res = []
+        with ThreadPoolExecutor(max_workers=max(min(self.workers, len(consumers)), 1)) as executor:
+            for part_res in executor.map(lambda item: self.read_partition(item[0], item[1], start_ts, end_ts),
+                                         consumers):
+                res.extend(part_res)
+        return res
+
+    def read_partition(self, partition, consumer: KafkaConsumer, start_ts, end_ts) -> List[dict]:
+        res = []
+        try:
+            self._read_partition(partition, consumer, start_ts, end_ts, res)
+        except KafkaError as ex:
+            logger.logger.warning('Failed to read partition {} of topic {} by time, {} messages read, '
+                                  'because {}'.format(partition, self.topic, len(res), ex))
+        return res
+
+    def _read_partition(self, partition, consumer: KafkaConsumer, start_ts, end_ts, res: List[dict]):
+        tp = TopicPartition(self.topic, partition)
+        start_offset = consumer.offsets_for_times({tp: start_ts + 1}).get(tp)
+        if start_offset is None:
+            return
+        end_offset = consumer.end_offsets([tp]).get(tp)
+        consumer.seek(tp, start_offset.offset)
+
+        while consumer.position(tp) < end_offset:
+            records = consumer.poll(timeout_ms=self.consumer_to * 1000, max_records=self.max_records)
+            if not records:
+                return
+            for msg in records.get(tp, []):
+                try:
+                    data = self.decode(msg.value)
+                except (ValueError, TypeError) as ex:
+                    logger.logger.warning(ex)
+                    continue
+                evt_ts = data.get('Timestamp') if isinstance(data, dict) else None
+                if not isinstance(evt_ts, (int, float)):
+                    logger.logger.warning('Invalid timestamp {} of the message at offset {} in partition {}.'.format(
+                        evt_ts, msg.offset, partition))
+                    continue
+                if evt_ts > end_ts:
+                    return
+                if evt_ts > start_ts:
+                    res.append(data)
@@ -12,3 +12,11 @@ class DataParseException(InferenceException):
 
 class NoKpiEventException(InferenceException):
     pass
+
+
+class DeadlineExceededException(InferenceException):
+    pass
+
+
+class ConfigException(InferenceException):
+    pass
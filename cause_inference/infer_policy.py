@@ -1,11 +1,14 @@
-import random
 from abc import ABC
 from abc import abstractmethod
 from typing import List
 
 import networkx as nx
+import numpy as np
+from scipy import sparse
 
 from spider.util import logger
+from cause_inference.compact_graph import CompactDiGraph
+from cause_inference.compact_graph import ancestors, is_directed_acyclic_graph, shortest_path, topological_sort
 from cause_inference.model import Cause, MetricNode, MetricNodeId
 from cause_inference.model import is_virtual_metric
 from cause_inference.exceptions import InferenceException
@@ -13,96 +16,138 @@ from cause_inference.exceptions import InferenceException
 
 class InferPolicy(ABC):
     @abstractmethod
-    def infer(self, cause_graph: nx.DiGraph, target_node_id, top_k: int) -> List[Cause]:
+    def infer(self, cause_graph: CompactDiGraph, target_node_id, top_k: int) -> List[Cause]:
         pass
 
 
 class RandomWalkPolicy(InferPolicy):
-    def __init__(self, rou=0.05, random_walk_round=10000, window_size=1000):
+    """
+    基于一阶随机游走的根因推导。转移概率矩阵以稀疏 CSR 格式存储，每个节点只向其前驱、后继和自身转移：
+    - 前向（前驱节点）转移概率正比于前驱节点的 abnormal_score；
+    - 后向（后继节点）转移概率正比于后继节点的 abnormal_score 乘以 rou；
+    - 自向转移概率正比于 max(0, 自身 abnormal_score - 前驱节点最大 abnormal_score)；
+    - 没有任何转移的节点只向自身转移。
+    mode 为 'walk' 时，多个游走者并行游走，以访问频率作为根因得分；
+    mode 为 'stationary' 时，通过幂迭代计算平稳分布作为根因得分，结果确定。
+    """
+    def __init__(self, rou=0.05, random_walk_round=10000, window_size=1000, walkers=10, mode='walk',
+                 max_iter=10000, tol=1e-10):
         self.rou = rou
         self.random_walk_round = random_walk_round
         if self.random_walk_round <= 0:
             raise InferenceException('The walk round of random walk algorithm can not be less than zero')
         self.window_size = window_size
-        self.transfer_matrix = {}
+        self.walkers = max(min(walkers, random_walk_round), 1)
+        if mode not in ('walk', 'stationary'):
+            raise InferenceException('Unsupported random walk mode {}'.format(mode))
+        self.mode = mode
+        self.max_iter = max_iter
+        self.tol = tol
+        self.transfer_matrix: sparse.csr_matrix = None
+
+    def infer(self, cause_graph: CompactDiGraph, target_node_id, top_k: int) -> List[Cause]:
+        if target_node_id not in cause_graph.nodes:
+            return []
 
-    def infer(self, cause_graph: nx.DiGraph, target_node_id, top_k: int) -> List[Cause]:
         # 计算转移概率矩阵
-        self.transfer_matrix.clear()
-        for node_id in cause_graph.nodes:
-            self.calc_transfer_probs(node_id, cause_graph)
+        node_ids = list(cause_graph.nodes)
+        node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.transfer_matrix = self.calc_transfer_matrix(cause_graph, node_ids, node_index)
 
-        walk_nums = self.one_order_random_walk(target_node_id)
-        cause_res = list(walk_nums.items())
-        cause_res = sorted(cause_res, key=lambda k: k[1], reverse=True)
-        cause_res = cause_res[:top_k]
+        start = node_index.get(target_node_id)
+        if self.mode == 'stationary':
+            scores = self.stationary_distribution(start)
+        else:
+            scores = self.random_walk(start) / self.random_walk_round
 
         res = []
-        for item in cause_res:
-            node_id = item[0]
-            score = item[1]
-            try:
-                uni_score = score / self.random_walk_round
-            except ZeroDivisionError as ex:
-                raise InferenceException(ex) from ex
-            cause = Cause(node_id[1], node_id[0], uni_score)
-            res.append(cause)
-
+        for i in np.argsort(-scores, kind='stable')[:top_k]:
+            if scores[i] <= 0:
+                break
+            node_id = node_ids[i]
+            path = self.get_cause_path(cause_graph, node_id, target_node_id)
+            res.append(Cause(node_id.metric_id, cause_graph.nodes[node_id].get('entity_id'), float(scores[i]), path))
         return res
 
-    def calc_transfer_probs(self, src_node_id, cause_graph: nx.DiGraph):
-        probs = self.transfer_matrix.setdefault(src_node_id, {})
-
-        # 计算前向转移概率
-        max_corr = 0
-        for node_id in cause_graph.pred:
-            corr = abs(cause_graph.nodes[node_id].get('abnormal_score', 0))
-            max_corr = max(max_corr, corr)
-            probs.setdefault(node_id, corr)
-
-        # 计算后向转移概率
-        for node_id in cause_graph.succ:
-            corr = abs(cause_graph.nodes[node_id].get('abnormal_score', 0))
-            probs.setdefault(node_id, corr * self.rou)
-
-        # 计算自向转移概率
-        corr = max(0, abs(cause_graph.nodes[src_node_id].get('abnormal_score', 0)) - max_corr)
-        probs.setdefault(src_node_id, corr)
+    @staticmethod
+    def get_cause_path(cause_graph: CompactDiGraph, cause_node_id, target_node_id) -> List[MetricNode]:
+        try:
+            node_ids = shortest_path(cause_graph, cause_node_id, target_node_id)
+        except nx.NetworkXNoPath:
+            node_ids = [cause_node_id]
+        return [MetricNode(node_id, cause_graph.nodes[node_id]) for node_id in node_ids]
+
+    def calc_transfer_matrix(self, cause_graph: CompactDiGraph, node_ids, node_index) -> sparse.csr_matrix:
+        node_num = len(node_ids)
+        abn_scores = np.array([abs(cause_graph.nodes[node_id].get('abnormal_score', 0)) for node_id in node_ids],
+                              dtype=float)
+        edges = np.array([(node_index.get(f), node_index.get(t)) for f, t in cause_graph.edges],
+                         dtype=np.int64).reshape(-1, 2)
+        src, dst = edges[:, 0], edges[:, 1]
+
+        # 前向转移：节点 dst 转移到其前驱节点 src
+        fwd_rows, fwd_cols, fwd_data = dst, src, abn_scores[src]
+        # 后向转移：节点 src 转移到其后继节点 dst，若 dst 同时是 src 的前驱，则只保留前向转移
+        edge_keys = src * node_num + dst
+        bwd_mask = ~np.isin(dst * node_num + src, edge_keys)
+        bwd_rows, bwd_cols, bwd_data = src[bwd_mask], dst[bwd_mask], abn_scores[dst[bwd_mask]] * self.rou
+        # 自向转移：自身异常得分超过前驱节点最大异常得分的部分
+        max_pred_score = np.zeros(node_num)
+        np.maximum.at(max_pred_score, dst, abn_scores[src])
+        self_mask = ~np.isin(np.arange(node_num) * (node_num + 1), edge_keys)
+        self_rows = np.arange(node_num)[self_mask]
+        self_data = np.maximum(0, abn_scores - max_pred_score)[self_mask]
+
+        rows = np.concatenate([fwd_rows, bwd_rows, self_rows])
+        cols = np.concatenate([fwd_cols, bwd_cols, self_rows])
+        data = np.concatenate([fwd_data, bwd_data, self_data])
+        matrix = sparse.csr_matrix((data, (rows, cols)), shape=(node_num, node_num))
+        matrix.eliminate_zeros()
+
+        # 自身及相邻节点的异常得分均为 0 的节点没有任何转移，为其添加自环，游走到该节点后停留在原地
+        row_sums = np.asarray(matrix.sum(axis=1)).ravel()
+        zero_rows = np.flatnonzero(row_sums == 0)
+        if len(zero_rows) > 0:
+            matrix = sparse.csr_matrix(matrix + sparse.csr_matrix(
+                (np.ones(len(zero_rows)), (zero_rows, zero_rows)), shape=(node_num, node_num)))
+            row_sums[zero_rows] = 1.0
 
         # 正则化
-        total = sum(probs.values())
-        for node_id, corr in probs.items():
-            try:
-                probs[node_id] = corr / total
-            except ZeroDivisionError as ex:
-                raise InferenceException('Sum of transition probability can not be zero') from ex
-
-    def one_order_random_walk(self, start_node_id):
-        walk_nums = {}
-        rwr = self.random_walk_round
-        curr_node_id = start_node_id
-        round_ = 0
-        while round_ < rwr:
-            next_node_id = self.get_next_walk_node(curr_node_id)
-            num = walk_nums.setdefault(next_node_id, 0)
-            walk_nums.update({next_node_id: num + 1})
-            round_ += 1
-            curr_node_id = next_node_id
-
+        return sparse.csr_matrix(sparse.diags(1 / row_sums) @ matrix)
+
+    def random_walk(self, start) -> np.ndarray:
+        matrix = self.transfer_matrix
+        # 每行的累积概率拼接为一个单调递增的数组，采样时在当前节点所在行的区间内二分查找
+        cum_probs = np.cumsum(matrix.data)
+        row_begin = np.concatenate([[0.0], cum_probs])[matrix.indptr[:-1]]
+        row_end = cum_probs[matrix.indptr[1:] - 1]
+
+        steps = -(-self.random_walk_round // self.walkers)
+        rng = np.random.default_rng()
+        walk_nums = np.zeros(matrix.shape[0], dtype=np.int64)
+        curr = np.full(self.walkers, start, dtype=np.int64)
+        for step in range(steps):
+            # 最后一步只使用部分游走者，使总步数等于 random_walk_round
+            if step == steps - 1:
+                curr = curr[:self.random_walk_round - step * self.walkers]
+            targets = row_begin[curr] + rng.random(len(curr)) * (row_end[curr] - row_begin[curr])
+            pos = np.searchsorted(cum_probs, targets, side='right')
+            pos = np.clip(pos, matrix.indptr[curr], matrix.indptr[curr + 1] - 1)
+            curr = matrix.indices[pos]
+            walk_nums += np.bincount(curr, minlength=len(walk_nums))
         return walk_nums
 
-    def get_next_walk_node(self, curr_node_id):
-        # 随机选择
-        probs = self.transfer_matrix.get(curr_node_id)
-        prob = random.random()
-        next_node_id = curr_node_id
-        for node_id, node_prob in probs.items():
-            if prob < node_prob:
-                next_node_id = node_id
-                break
-            prob -= node_prob
-
-        return next_node_id
+    def stationary_distribution(self, start) -> np.ndarray:
+        # 使用惰性转移 (I + P) / 2 进行幂迭代，平稳分布不变，且避免周期性导致不收敛
+        matrix_t = self.transfer_matrix.T.tocsr()
+        probs = np.zeros(matrix_t.shape[0])
+        probs[start] = 1.0
+        for _ in range(self.max_iter):
+            next_probs = 0.5 * probs + 0.5 * (matrix_t @ probs)
+            if np.abs(next_probs - probs).sum() < self.tol:
+                return next_probs
+            probs = next_probs
+        return probs
 
 
 class DfsPolicy(InferPolicy):
@@ -127,7 +172,7 @@ class DfsPolicy(InferPolicy):
         return total_score
 
     @staticmethod
-    def get_all_paths_to_abn_node(abn_node_id, cause_graph: nx.DiGraph) -> List[MetricNode]:
+    def get_all_paths_to_abn_node(abn_node_id, cause_graph: CompactDiGraph) -> List[MetricNode]:
         paths = []
         path = []
         node_selected = set()
@@ -193,7 +238,7 @@ class DfsPolicy(InferPolicy):
             res.append(cause)
         return res
 
-    def infer(self, cause_graph: nx.DiGraph, target_node_id, top_k: int) -> List[Cause]:
+    def infer(self, cause_graph: CompactDiGraph, target_node_id, top_k: int) -> List[Cause]:
         if target_node_id not in cause_graph.nodes:
             return []
 
@@ -208,6 +253,202 @@ class DfsPolicy(InferPolicy):
         return self.parse_causes(top_paths)
 
 
+class DpPolicy(DfsPolicy):
+    """
+    与 DfsPolicy 的路径得分（路径上除目标节点外非虚拟节点 corr_score 的均值）和 top-k 输出相同，
+    但不枚举所有路径，而是在目标节点的祖先子图上进行动态规划：
+    对每个节点和路径上非虚拟节点的个数 c，只保留得分之和最大（相差在舍入误差范围内的都保留）的到目标节点的路径，
+    每个根因候选节点最终按 calc_path_score 计算的得分选择一条路径，得分相同时按 DfsPolicy 的路径枚举顺序选择，
+    与 DfsPolicy 按相同的浮点数求和顺序比较。
+    top_k <= 0 时，返回每个根因候选节点的最优路径。子图中存在环时，退化为 DfsPolicy 的路径枚举。
+    """
+    # 得分之和的比较容差，只用于保留舍入误差导致的近似相等的路径，最终按精确的路径得分选择
+    TIE_TOL = 1e-9
+
+    def infer(self, cause_graph: CompactDiGraph, target_node_id, top_k: int) -> List[Cause]:
+        if target_node_id not in cause_graph.nodes:
+            return []
+
+        sub_graph = cause_graph.subgraph(ancestors(cause_graph, target_node_id) | {target_node_id})
+        if not is_directed_acyclic_graph(sub_graph):
+            logger.logger.warning('Circle exist in cause graph, please check.')
+            return super().infer(cause_graph, target_node_id, top_k)
+
+        states = self.calc_best_path_states(cause_graph, sub_graph, target_node_id)
+        candidates = []
+        for node_id in sub_graph.nodes:
+            if sub_graph.in_degree(node_id) > 0:
+                continue
+            candidates.append(self.select_best_path(cause_graph, states, node_id))
+
+        candidates.sort(key=lambda item: (item[0], item[1]))
+        scored_paths = [{'score': -score, 'path': path} for score, _, path in candidates]
+        if top_k > 0:
+            scored_paths = self.get_top_paths(scored_paths, top_k)
+        return self.parse_causes(scored_paths)
+
+    @staticmethod
+    def calc_best_path_states(cause_graph: CompactDiGraph, sub_graph: CompactDiGraph, target_node_id) -> dict:
+        """
+        states[node_id][c] = (得分之和, [(后继节点, 后继节点的状态 c, 该节点在后继节点前驱中的序号), ...])，
+        表示从 node_id 到目标节点、非虚拟节点个数为 c 的路径中得分之和的最大值，以及得分之和与最大值相差不超过
+        TIE_TOL 的各条路径的下一步。
+        """
+        # 各节点在其后继节点的前驱中的序号，即 DfsPolicy 的路径枚举顺序
+        pred_idxes = {}
+        states = {target_node_id: {0: (0.0, [])}}
+        for node_id in reversed(topological_sort(sub_graph)):
+            if node_id == target_node_id:
+                continue
+            is_valid = not is_virtual_node(node_id)
+            score = DfsPolicy.get_node_cause_score(cause_graph.nodes[node_id]) if is_valid else 0.0
+            steps_by_count = {}
+            for succ_node_id in sub_graph.successors(node_id):
+                succ_pred_idxes = pred_idxes.get(succ_node_id)
+                if succ_pred_idxes is None:
+                    succ_pred_idxes = {pred: i for i, pred in enumerate(cause_graph.predecessors(succ_node_id))}
+                    pred_idxes[succ_node_id] = succ_pred_idxes
+                pred_idx = succ_pred_idxes.get(node_id)
+                for succ_c, succ_state in states[succ_node_id].items():
+                    steps_by_count.setdefault(succ_c + int(is_valid), []).append(
+                        (succ_state[0] + score, succ_node_id, succ_c, pred_idx))
+
+            node_states = {}
+            for c, steps in steps_by_count.items():
+                best_total = max(step[0] for step in steps)
+                node_states[c] = (best_total, [step[1:] for step in steps
+                                               if step[0] >= best_total - DpPolicy.TIE_TOL])
+            states[node_id] = node_states
+        return states
+
+    @staticmethod
+    def select_best_path(cause_graph: CompactDiGraph, states, node_id) -> tuple:
+        """返回根因候选节点的最优路径 (-路径得分, 路径在 DfsPolicy 枚举顺序中的位置, 路径)"""
+        node_states = states[node_id]
+        means = {c: state[0] / c if c > 0 else 0.0 for c, state in node_states.items()}
+        best_mean = max(means.values())
+        best = None
+        for c, mean in means.items():
+            if mean < best_mean - DpPolicy.TIE_TOL:
+                continue
+            for key, node_ids in DpPolicy.iter_paths(states, node_id, c):
+                path = [MetricNode(path_node_id, cause_graph.nodes[path_node_id]) for path_node_id in node_ids]
+                item = (-DfsPolicy.calc_path_score(path), key, path)
+                if best is None or item[:2] < best[:2]:
+                    best = item
+        return best
+
+    @staticmethod
+    def iter_paths(states, node_id, c):
+        """
+        遍历状态 states[node_id][c] 保留的路径，返回 (路径在 DfsPolicy 枚举顺序中的位置, 路径上的节点)。
+        位置为从目标节点开始各节点在前驱中的序号。
+        """
+        steps = states[node_id][c][1]
+        if not steps:
+            yield (), [node_id]
+            return
+        for succ_node_id, succ_c, pred_idx in steps:
+            for key, node_ids in DpPolicy.iter_paths(states, succ_node_id, succ_c):
+                yield key + (pred_idx,), [node_id] + node_ids
+
+
+class PprPolicy(InferPolicy):
+    """
+    基于个性化 PageRank 的根因推导，以异常KPI节点为重启节点，在指标因果图上沿前驱方向（原因方向）游走：
+    - 转移到各前驱节点的概率正比于前驱节点的 corr_score（没有时使用 abnormal_score），
+      虚拟指标节点使用其前驱节点的最大权重；
+    - 以 1 - alpha 的概率重启到异常KPI节点，没有前驱的节点总是重启。
+    使用稀疏矩阵幂迭代计算收敛得分，得分结果确定。根因路径从根因节点出发，
+    每一步选择能到达异常KPI节点、且得分最高的后继节点。
+    """
+    def __init__(self, alpha=0.85, max_iter=100, tol=1e-8):
+        self.alpha = alpha
+        self.max_iter = max_iter
+        self.tol = tol
+
+    @staticmethod
+    def get_node_weight(node_attrs: dict):
+        score = node_attrs.get('corr_score')
+        if score is None:
+            score = node_attrs.get('abnormal_score', 0)
+        return abs(score)
+
+    def infer(self, cause_graph: CompactDiGraph, target_node_id, top_k: int) -> List[Cause]:
+        if target_node_id not in cause_graph.nodes:
+            return []
+
+        node_ids = list(cause_graph.nodes)
+        node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        scores = self.personalized_pagerank(cause_graph, node_ids, node_index, node_index.get(target_node_id))
+
+        # 得分为正的节点都是从异常KPI节点沿前驱方向可达的节点
+        scored_paths = []
+        for i in np.argsort(-scores, kind='stable'):
+            node_id = node_ids[i]
+            if scores[i] <= 0:
+                break
+            if node_id == target_node_id or is_virtual_node(node_id):
+                continue
+            scored_paths.append({
+                'score': float(scores[i]),
+                'path': [MetricNode(node_id, cause_graph.nodes[node_id])],
+            })
+        if top_k > 0:
+            scored_paths = DfsPolicy.get_top_paths(scored_paths, top_k)
+        # 只为选中的根因重建路径
+        for scored_path in scored_paths:
+            scored_path['path'] = self.get_cause_path(cause_graph, scored_path['path'][0].node_id, target_node_id,
+                                                      scores, node_index)
+        return DfsPolicy.parse_causes(scored_paths)
+
+    def calc_transfer_matrix(self, cause_graph: CompactDiGraph, node_ids, node_index) -> sparse.csr_matrix:
+        weights = np.array([self.get_node_weight(cause_graph.nodes[node_id]) for node_id in node_ids], dtype=float)
+        for node_id in node_ids:
+            if is_virtual_node(node_id):
+                weights[node_index.get(node_id)] = max(
+                    (weights[node_index.get(pred_id)] for pred_id in cause_graph.predecessors(node_id)), default=0)
+
+        # 矩阵元素 (i, j) 表示从节点 j 转移到其前驱节点 i 的概率
+        edges = np.array([(node_index.get(f), node_index.get(t)) for f, t in cause_graph.edges],
+                         dtype=np.int64).reshape(-1, 2)
+        node_num = len(node_ids)
+        matrix = sparse.csr_matrix((weights[edges[:, 0]], (edges[:, 0], edges[:, 1])), shape=(node_num, node_num))
+        col_sums = np.asarray(matrix.sum(axis=0)).ravel()
+        col_scale = np.divide(1.0, col_sums, out=np.zeros(node_num), where=col_sums > 0)
+        return sparse.csr_matrix(matrix @ sparse.diags(col_scale))
+
+    def personalized_pagerank(self, cause_graph: CompactDiGraph, node_ids, node_index, start) -> np.ndarray:
+        matrix = self.calc_transfer_matrix(cause_graph, node_ids, node_index)
+        restart = np.zeros(len(node_ids))
+        restart[start] = 1.0
+        scores = restart.copy()
+        for _ in range(self.max_iter):
+            walked = self.alpha * (matrix @ scores)
+            # 没有可转移前驱的节点上的概率全部重启
+            next_scores = walked + (1 - walked.sum()) * restart
+            if np.abs(next_scores - scores).sum() < self.tol:
+                return next_scores
+            scores = next_scores
+        return scores
+
+    @staticmethod
+    def get_cause_path(cause_graph: CompactDiGraph, cause_node_id, target_node_id, scores, node_index)\
+            -> List[MetricNode]:
+        path = [MetricNode(cause_node_id, cause_graph.nodes[cause_node_id])]
+        visited = {cause_node_id}
+        node_id = cause_node_id
+        while node_id != target_node_id:
+            succ_ids = [succ_id for succ_id in cause_graph.successors(node_id)
+                        if succ_id not in visited and scores[node_index.get(succ_id)] > 0]
+            if not succ_ids:
+                break
+            node_id = max(succ_ids, key=lambda succ_id: scores[node_index.get(succ_id)])
+            visited.add(node_id)
+            path.append(MetricNode(node_id, cause_graph.nodes[node_id]))
+        return path
+
+
 def is_virtual_node(node_id: MetricNodeId) -> bool:
     return is_virtual_metric(node_id.metric_id)
 
@@ -217,4 +458,8 @@ def get_infer_policy(policy: str, **options) -> InferPolicy:
         return DfsPolicy()
     if policy == 'rw':
         return RandomWalkPolicy(**options)
+    if policy == 'dp':
+        return DpPolicy()
+    if policy == 'ppr':
+        return PprPolicy(**options)
     raise InferenceException('Unsupported infer policy {}'.format(policy))
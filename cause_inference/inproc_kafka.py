@@ -0,0 +1,268 @@
+"""
+进程内的 kafka 替身，实现根因定位服务用到的 KafkaConsumer / KafkaProducer 接口子集，用于在本地、单进程内运行和验证
+多实例分区部署等场景，不依赖 kafka 服务。kafka 服务器地址配置为 inproc 时使用。
+
+- 每个 topic 包含固定数量的分区，消息按 key 的哈希值（无 key 时轮询）写入分区；
+- 同一消费者组内的消费者按分区序号轮流分配分区，有消费者加入或退出时重新分配并通知 ConsumerRebalanceListener ；
+- 消费者组的已提交位移保存在 broker 中，poll 时自动提交。
+"""
+import functools
+import itertools
+import threading
+import time
+import zlib
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+from kafka import TopicPartition
+from kafka.structs import OffsetAndTimestamp
+
+INPROC_SERVER = 'inproc'
+DEFAULT_PARTITIONS = 1
+
+InprocRecord = namedtuple('InprocRecord', ['topic', 'partition', 'offset', 'timestamp', 'key', 'value'])
+
+
+def is_inproc_server(servers) -> bool:
+    if isinstance(servers, (list, tuple)):
+        return INPROC_SERVER in servers
+    return servers == INPROC_SERVER
+
+
+class InprocBroker:
+    def __init__(self, default_partitions=DEFAULT_PARTITIONS):
+        self.default_partitions = default_partitions
+        self.topics: Dict[str, List[List[InprocRecord]]] = {}
+        # (消费者组, topic) -> 组内消费者列表
+        self.groups: Dict[tuple, list] = {}
+        # (消费者组, 分区) -> 已提交位移
+        self.committed: Dict[tuple, int] = {}
+        self.generation = 0
+        self._round_robin = itertools.count()
+        self.cond = threading.Condition()
+
+    def create_topic(self, topic, partitions=None):
+        with self.cond:
+            return self._get_partitions(topic, partitions)
+
+    def _get_partitions(self, topic, partitions=None) -> List[List[InprocRecord]]:
+        if topic not in self.topics:
+            self.topics[topic] = [[] for _ in range(partitions or self.default_partitions)]
+        return self.topics.get(topic)
+
+    def append(self, topic, value, key=None, partition=None, timestamp_ms=None) -> InprocRecord:
+        with self.cond:
+            partitions = self._get_partitions(topic)
+            if partition is None:
+                if key is not None:
+                    partition = zlib.crc32(key) % len(partitions)
+                else:
+                    partition = next(self._round_robin) % len(partitions)
+            records = partitions[partition]
+            timestamp = timestamp_ms if timestamp_ms is not None else int(time.time() * 1000)
+            record = InprocRecord(topic, partition, len(records), timestamp, key, value)
+            records.append(record)
+            self.cond.notify_all()
+            return record
+
+    def join(self, group_id, topic, consumer):
+        with self.cond:
+            members = self.groups.setdefault((group_id, topic), [])
+            if consumer not in members:
+                members.append(consumer)
+            self.generation += 1
+
+    def leave(self, group_id, topic, consumer):
+        with self.cond:
+            members = self.groups.get((group_id, topic), [])
+            if consumer in members:
+                members.remove(consumer)
+            self.generation += 1
+
+    def assignment(self, group_id, topic, consumer) -> List[int]:
+        with self.cond:
+            members = self.groups.get((group_id, topic), [])
+            if consumer not in members:
+                return []
+            idx = members.index(consumer)
+            partition_num = len(self._get_partitions(topic))
+            return [p for p in range(partition_num) if p % len(members) == idx]
+
+
+inproc_broker = InprocBroker()
+
+
+class InprocConsumer:
+    def __init__(self, *topics, group_id=None, broker: InprocBroker = None, **configs):
+        self.broker = broker or inproc_broker
+        self.group_id = group_id
+        self.enable_auto_commit = configs.get('enable_auto_commit', True)
+        self.positions: Dict[TopicPartition, int] = {}
+        self.topics: List[str] = []
+        self.listener = None
+        self._generation = -1
+        self._closed = False
+        if topics:
+            self.subscribe(list(topics))
+
+    def subscribe(self, topics=(), listener=None):
+        self.topics = list(topics)
+        self.listener = listener
+        for topic in self.topics:
+            self.broker.join(self.group_id, topic, self)
+
+    def assign(self, partitions: List[TopicPartition]):
+        self.topics = []
+        for tp in partitions:
+            self.positions.setdefault(tp, 0)
+
+    def close(self):
+        for topic in self.topics:
+            self.broker.leave(self.group_id, topic, self)
+        self._closed = True
+
+    def _rebalance_if_needed(self):
+        if not self.topics or self._generation == self.broker.generation:
+            return
+        self._generation = self.broker.generation
+        assigned = []
+        for topic in self.topics:
+            for partition in self.broker.assignment(self.group_id, topic, self):
+                assigned.append(TopicPartition(topic, partition))
+        revoked = [tp for tp in self.positions if tp not in assigned]
+        if revoked and self.listener is not None:
+            self.listener.on_partitions_revoked(revoked)
+        positions = {}
+        for tp in assigned:
+            positions[tp] = self.positions.get(tp, self.broker.committed.get((self.group_id, tp), 0))
+        self.positions = positions
+        if self.listener is not None:
+            self.listener.on_partitions_assigned(assigned)
+
+    def poll(self, timeout_ms=0, max_records=None) -> Dict[TopicPartition, List[InprocRecord]]:
+        deadline = time.time() + timeout_ms / 1000
+        with self.broker.cond:
+            while True:
+                self._rebalance_if_needed()
+                res = self._fetch(max_records)
+                remaining = deadline - time.time()
+                if res or remaining <= 0 or self._closed:
+                    return res
+                self.broker.cond.wait(remaining)
+
+    def _fetch(self, max_records) -> Dict[TopicPartition, List[InprocRecord]]:
+        res = {}
+        left = max_records or float('inf')
+        for tp, position in self.positions.items():
+            if left <= 0:
+                break
+            records = self.broker.topics.get(tp.topic, [])
+            if tp.partition >= len(records):
+                continue
+            msgs = records[tp.partition][position:position + int(min(left, len(records[tp.partition])))]
+            if not msgs:
+                continue
+            res[tp] = msgs
+            left -= len(msgs)
+            self.positions[tp] = position + len(msgs)
+            if self.enable_auto_commit and self.group_id is not None:
+                self.broker.committed[(self.group_id, tp)] = self.positions.get(tp)
+        return res
+
+    def __iter__(self):
+        while not self._closed:
+            for msgs in self.poll(timeout_ms=1000).values():
+                for msg in msgs:
+                    yield msg
+
+    def seek(self, tp: TopicPartition, offset):
+        self.positions[tp] = offset
+
+    def position(self, tp: TopicPartition) -> int:
+        return self.positions.get(tp, 0)
+
+    def highwater(self, tp: TopicPartition) -> Optional[int]:
+        with self.broker.cond:
+            partitions = self.broker.topics.get(tp.topic, [])
+            return len(partitions[tp.partition]) if tp.partition < len(partitions) else None
+
+    def partitions_for_topic(self, topic) -> set:
+        with self.broker.cond:
+            return set(range(len(self.broker.topics.get(topic, []))))
+
+    def end_offsets(self, partitions: List[TopicPartition]) -> Dict[TopicPartition, int]:
+        return {tp: self.highwater(tp) or 0 for tp in partitions}
+
+    def offsets_for_times(self, timestamps: Dict[TopicPartition, int]) -> Dict[TopicPartition, OffsetAndTimestamp]:
+        res = {}
+        with self.broker.cond:
+            for tp, ts in timestamps.items():
+                partitions = self.broker.topics.get(tp.topic, [])
+                records = partitions[tp.partition] if tp.partition < len(partitions) else []
+                record = next((r for r in records if r.timestamp >= ts), None)
+                res[tp] = OffsetAndTimestamp(record.offset, record.timestamp, None) if record else None
+        return res
+
+
+class InprocFuture:
+    def __init__(self):
+        self.value = None
+        self.exception = None
+        self._callbacks = []
+        self._errbacks = []
+        self._done = False
+
+    def success(self, value):
+        self.value = value
+        self._done = True
+        for callback in self._callbacks:
+            callback(value)
+
+    def failure(self, exception):
+        self.exception = exception
+        self._done = True
+        for errback in self._errbacks:
+            errback(exception)
+
+    def add_callback(self, callback, *args):
+        callback = functools.partial(callback, *args)
+        if self._done and self.exception is None:
+            callback(self.value)
+        else:
+            self._callbacks.append(callback)
+        return self
+
+    def add_errback(self, errback, *args):
+        errback = functools.partial(errback, *args)
+        if self._done and self.exception is not None:
+            errback(self.exception)
+        else:
+            self._errbacks.append(errback)
+        return self
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class InprocProducer:
+    def __init__(self, broker: InprocBroker = None, **configs):
+        self.broker = broker or inproc_broker
+        self.configs = configs
+
+    def send(self, topic, value=None, key=None, partition=None, timestamp_ms=None) -> InprocFuture:
+        future = InprocFuture()
+        try:
+            record = self.broker.append(topic, value, key=key, partition=partition, timestamp_ms=timestamp_ms)
+        except Exception as ex:
+            future.failure(ex)
+            return future
+        future.success(record)
+        return future
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
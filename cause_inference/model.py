@@ -1,14 +1,13 @@
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Dict
-
-import networkx as nx
+from typing import List, Dict, Optional
 
 from spider.exceptions import MetadataException
 from spider.conf.observe_meta import ObserveMetaMgt
 from spider.util import logger
 from spider.util.entity import concate_entity_id
 from spider.util.entity import escape_entity_id
+from cause_inference.compact_graph import CompactDiGraph
 
 
 class VirtualMetricCategory(Enum):
@@ -26,18 +25,16 @@ virtual_metric_id_map = {
 }
 
 
+_virtual_categories = frozenset(v.value for v in VirtualMetricCategory.__members__.values())
+_virtual_metric_ids = frozenset(virtual_metric_id_map.values())
+
+
 def is_virtual_category(cate_type: str) -> bool:
-    for v in VirtualMetricCategory.__members__.values():
-        if v.value == cate_type:
-            return True
-    return False
+    return cate_type in _virtual_categories
 
 
 def is_virtual_metric(metric_id: str) -> bool:
-    for virtual_metric_id in virtual_metric_id_map.values():
-        if metric_id == virtual_metric_id:
-            return True
-    return False
+    return metric_id in _virtual_metric_ids
 
 
 class AnomalyTrend(Enum):
@@ -53,14 +50,29 @@ class MetricCategoryDetail:
     trend: AnomalyTrend
 
 
-@dataclass
 class TopoNode:
-    id: str
-    entity_id: str
-    entity_type: str
-    machine_id: str
-    timestamp: int
-    raw_data: dict = field(default_factory=dict)
+    __slots__ = ('id', 'entity_id', 'entity_type', 'machine_id', 'timestamp', 'raw_data')
+
+    def __init__(self, id, entity_id, entity_type, machine_id, timestamp, raw_data=None):
+        self.id = id
+        self.entity_id = entity_id
+        self.entity_type = entity_type
+        self.machine_id = machine_id
+        self.timestamp = timestamp
+        self.raw_data = raw_data or {}
+
+    def __repr__(self):
+        return 'TopoNode(id={}, entity_type={}, machine_id={}, timestamp={})'.format(
+            self.id,
+            self.entity_type,
+            self.machine_id,
+            self.timestamp,
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, TopoNode):
+            return NotImplemented
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
 
 
 @dataclass
@@ -73,11 +85,85 @@ class TopoEdge:
     to_node: TopoNode = None
 
 
+class TopoIndex:
+    """
+    拓扑索引，推理规则通过该索引按类型关联观测实例和关系，而不是遍历所有实例对：
+    - 观测实例按 machine_id 以及 (machine_id, entity_type) 分组；
+    - 关系按类型以及 (类型, 目的实例ID) 分组，只保留两端实例都存在的关系。
+    各分组内保持原拓扑中的顺序。
+    """
+    def __init__(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]):
+        self.node_maps: List[Dict[str, TopoNode]] = [topo_nodes]
+        self.nodes_by_machine: Dict[str, List[TopoNode]] = {}
+        self.nodes_by_machine_type: Dict[tuple, List[TopoNode]] = {}
+        for node in topo_nodes.values():
+            self.nodes_by_machine.setdefault(node.machine_id, []).append(node)
+            self.nodes_by_machine_type.setdefault((node.machine_id, node.entity_type), []).append(node)
+
+        self.edges_by_type: Dict[str, List[tuple]] = {}
+        self.edges_by_type_to: Dict[tuple, List[tuple]] = {}
+        self.add_edges(topo_edges)
+
+    @classmethod
+    def merge(cls, topo_indexes: List['TopoIndex'], topo_edges: Dict[str, TopoEdge]) -> 'TopoIndex':
+        """合并多个拓扑的观测实例索引，不重新遍历观测实例，关系只索引 topo_edges"""
+        merged = cls({}, {})
+        merged.node_maps = [node_map for topo_index in topo_indexes for node_map in topo_index.node_maps]
+        for topo_index in topo_indexes:
+            merged._merge_groups(merged.nodes_by_machine, topo_index.nodes_by_machine)
+            merged._merge_groups(merged.nodes_by_machine_type, topo_index.nodes_by_machine_type)
+        merged.add_edges(topo_edges)
+        return merged
+
+    @staticmethod
+    def _merge_groups(groups: Dict[object, List[TopoNode]], other_groups: Dict[object, List[TopoNode]]):
+        for key, nodes in other_groups.items():
+            group = groups.get(key)
+            if group is None:
+                groups[key] = nodes
+                continue
+            node_ids = {node.id for node in group}
+            groups[key] = group + [node for node in nodes if node.id not in node_ids]
+
+    def get_node(self, node_id) -> Optional[TopoNode]:
+        for node_map in self.node_maps:
+            node = node_map.get(node_id)
+            if node is not None:
+                return node
+        return None
+
+    def add_edges(self, topo_edges: Dict[str, TopoEdge]):
+        for edge in topo_edges.values():
+            f_node, t_node = self.get_node(edge.from_id), self.get_node(edge.to_id)
+            if not f_node or not t_node:
+                continue
+            item = (edge, f_node, t_node)
+            self.edges_by_type.setdefault(edge.type, []).append(item)
+            self.edges_by_type_to.setdefault((edge.type, edge.to_id), []).append(item)
+
+    def get_nodes(self, machine_id, entity_type) -> List[TopoNode]:
+        return self.nodes_by_machine_type.get((machine_id, entity_type), [])
+
+    def get_edges(self, edge_type) -> List[tuple]:
+        """返回 (关系, 源实例, 目的实例) 列表"""
+        return self.edges_by_type.get(edge_type, [])
+
+    def get_edges_to(self, edge_type, to_id) -> List[tuple]:
+        return self.edges_by_type_to.get((edge_type, to_id), [])
+
+
 @dataclass
 class HostTopo:
     machine_id: str
     nodes: Dict[str, TopoNode]
     edges: Dict[str, TopoEdge]
+    _topo_index: Optional[TopoIndex] = field(default=None, init=False, repr=False, compare=False)
+
+    def get_topo_index(self) -> TopoIndex:
+        """主机拓扑的索引，首次使用时构建"""
+        if self._topo_index is None:
+            self._topo_index = TopoIndex(self.nodes, self.edges)
+        return self._topo_index
 
 
 @dataclass(frozen=True)
@@ -146,6 +232,13 @@ class AbnormalEvent:
         return res
 
 
+def group_abn_evts_by_entity(abn_evts: List[AbnormalEvent]) -> Dict[str, List[AbnormalEvent]]:
+    res = {}
+    for abn_evt in abn_evts:
+        res.setdefault(abn_evt.abnormal_entity_id, []).append(abn_evt)
+    return res
+
+
 class Cause:
     def __init__(self, metric_id, entity_id, cause_score, path: List[MetricNode] = None):
         self.metric_id = metric_id
@@ -172,24 +265,40 @@ class CauseTNode:
 
 
 class CauseTree:
+    """
+    根因树，以异常KPI节点为根，根因路径上的节点逐层挂载到已有节点下。
+    支持多个根节点，用于多个异常KPI共享同一棵根因树的场景。
+    """
     def __init__(self, root_node: CauseTNode = None):
         self.root_node = root_node
+        self.root_nodes: List[CauseTNode] = [root_node] if root_node else []
         self.all_node_map: Dict[MetricNodeId, CauseTNode] = {}
 
-    def append_all_causes(self, causes: List[Cause]) -> List[MetricNode]:
+    def add_root(self, node: MetricNode) -> bool:
+        """添加根节点，节点已在树中时返回 False"""
+        if node.node_id in self.all_node_map:
+            return False
+        tnode = CauseTNode(node)
+        self.all_node_map.setdefault(node.node_id, tnode)
+        self.root_nodes.append(tnode)
+        if not self.root_node:
+            self.root_node = tnode
+        return True
+
+    def append_all_causes(self, causes: List[Cause], as_root=False) -> List[MetricNode]:
         newly_cause_nodes = []
         for cause in causes:
-            newly_cause_nodes.extend(self.append_cause(cause))
+            newly_cause_nodes.extend(self.append_cause(cause, as_root))
         return newly_cause_nodes
 
-    def append_cause(self, cause: Cause) -> List[MetricNode]:
+    def append_cause(self, cause: Cause, as_root=False) -> List[MetricNode]:
+        """as_root 为 True 时，根因路径的终点不在树中则作为新的根节点，否则只挂载到已有节点下"""
         newly_cause_nodes = []
         path = cause.path
         tgt_node = path[len(path) - 1]
-        if not self.root_node:
-            self.root_node = CauseTNode(tgt_node)
-            self.all_node_map.setdefault(tgt_node.node_id, self.root_node)
-            newly_cause_nodes.append(tgt_node)
+        if not self.root_node or as_root:
+            if self.add_root(tgt_node):
+                newly_cause_nodes.append(tgt_node)
         mounted_tnode = self.all_node_map.get(tgt_node.node_id)
         if not mounted_tnode:
             return []
@@ -209,8 +318,8 @@ class CauseTree:
 
         return newly_cause_nodes
 
-    def to_cause_graph(self) -> nx.DiGraph:
-        cause_graph = nx.DiGraph()
+    def to_cause_graph(self) -> CompactDiGraph:
+        cause_graph = CompactDiGraph()
         for node_id, tnode in self.all_node_map.items():
             cause_graph.add_node(node_id, **tnode.data.node_attrs)
         for node_id, tnode in self.all_node_map.items():
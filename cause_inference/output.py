@@ -69,13 +69,18 @@ def format_desc_info(abn_kpi, cause_metrics):
 
 
 def gen_cause_msg(abn_kpi: AbnormalEvent, cause_res: dict) -> dict:
+    resource = dict(cause_res)
+    partial = resource.pop('partial', False)
+    cached = resource.pop('cached', False)
     cause_msg = {
         'Timestamp': abn_kpi.timestamp,
         'event_id': abn_kpi.event_id,
         'Attributes': {
-            'event_id': abn_kpi.event_id
+            'event_id': abn_kpi.event_id,
+            'partial': partial,
+            'cached': cached,
         },
-        'Resource': cause_res,
+        'Resource': resource,
         'keywords': gen_keywords(cause_res),
         'SeverityText': 'WARN',
         'SeverityNumber': 13,
@@ -0,0 +1,52 @@
+import zlib
+from typing import Callable, List
+
+from spider.util.entity import MACHINE_ID_NAME
+
+from cause_inference.exceptions import ConfigException
+from cause_inference.model import AbnormalEvent
+
+
+class MachinePartition:
+    """
+    多实例分区部署时，按 machine_id 的哈希值将主机划分给各个实例，每个实例只缓存属于自己的主机上的异常指标事件。
+    没有 machine_id 的事件无法确定所属主机，由所有实例缓存。
+    """
+    def __init__(self, count=1, index=0):
+        if not isinstance(count, int) or count < 1:
+            raise ConfigException('Invalid partition_count {}, it should be a positive integer.'.format(count))
+        if not isinstance(index, int) or not 0 <= index < count:
+            raise ConfigException('Invalid partition_index {}, it should be in range [0, {}).'.format(index, count))
+        self.count = count
+        self.index = index
+
+    def is_partitioned(self) -> bool:
+        return self.count > 1
+
+    def get_group_id(self, group_id) -> str:
+        """分区部署时，各实例都需要收到全部异常指标事件再按主机过滤，因此每个实例使用独立的消费者组"""
+        if not self.is_partitioned():
+            return group_id
+        return '{}-{}'.format(group_id, self.index)
+
+    def owns(self, machine_id) -> bool:
+        if not machine_id or self.count <= 1:
+            return True
+        # 使用稳定的哈希函数，保证各实例的划分结果一致
+        return zlib.crc32(machine_id.encode()) % self.count == self.index
+
+    def owns_evt(self, evt: AbnormalEvent) -> bool:
+        return self.owns(evt.metric_labels.get(MACHINE_ID_NAME))
+
+
+class ForeignEvtLoader:
+    """读取不属于本实例的主机上的异常指标事件，用于根因定位涉及其它实例的主机时补充事件"""
+    def __init__(self, partition: MachinePartition, read_evts: Callable[[], List[AbnormalEvent]]):
+        self.partition = partition
+        self.read_evts = read_evts
+
+    def need_load(self, machine_id) -> bool:
+        return not self.partition.owns(machine_id)
+
+    def load(self) -> List[AbnormalEvent]:
+        return [evt for evt in self.read_evts() if not self.partition.owns_evt(evt)]
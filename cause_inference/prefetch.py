@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from spider.collector import DataRecord
+from spider.exceptions import MetadataException
+from spider.util import logger
+from spider.util.entity import MACHINE_ID_NAME
+
+from cause_inference.config import infer_config
+from cause_inference.db_mgt import PromMgt
+from cause_inference.model import AbnormalEvent
+
+DEFAULT_PREFETCH_WORKERS = 4
+DEFAULT_SAFE_LAG = 15
+DEFAULT_MAX_METRICS = 200
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def get_hist_end_ts(abn_kpi: AbnormalEvent) -> int:
+    """根因定位时，指标历史数据时间窗口的结束时间，单位：秒"""
+    return abn_kpi.timestamp // 1000 + infer_config.infer_conf.get('evt_future_duration')
+
+
+class _HistEntry:
+    """
+    单个指标在一个历史数据时间窗口内的查询结果，可以分多次查询：先查询到当前时间为止的头部，窗口结束后再补充尾部。
+    各次查询的采样时间点都对齐到 start_ts + k * step ，与一次查询整个窗口得到的采样时间点相同。
+    """
+    def __init__(self, metric_db_mgt: PromMgt, metric_id, query_options: dict, end_ts):
+        self.metric_db_mgt = metric_db_mgt
+        self.metric_id = metric_id
+        self.query_options = query_options
+        self.start_ts = end_ts - metric_db_mgt.sample_duration
+        self.end_ts = end_ts
+        # 已查询的最后一个采样时间点，None 表示还未查询到任何数据
+        self.fetched_until = None
+        # 按时间序列分组保存查询结果，保持查询返回的时间序列顺序
+        self.series: Dict[tuple, List[DataRecord]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fetch(self, until) -> List[DataRecord]:
+        """查询截至 until 还未查询的数据，返回目前已查询的全部数据"""
+        with self.lock:
+            step = self.metric_db_mgt.sample_step
+            start = self.start_ts if self.fetched_until is None else self.fetched_until + step
+            if start <= until:
+                records = self.metric_db_mgt.query_hist_records(self.metric_id, self.query_options, start, until)
+                # 查询失败和没有数据无法区分，头部没有数据时不记录进度，之后重新查询整个窗口
+                if records or self.fetched_until is not None:
+                    self.merge(records)
+                    self.fetched_until = until
+            return [record for records in self.series.values() for record in records]
+
+    def merge(self, records: List[DataRecord]):
+        for record in records:
+            series_key = tuple((label.name, label.value) for label in record.labels)
+            self.series.setdefault(series_key, []).append(record)
+
+
+class HistPrefetcher:
+    """
+    异常KPI等待未来周期期间，预先查询指标的历史数据：
+    - KPI 事件到达时，查询 KPI 以及可能相关的主机（KPI 及其推荐指标所在的主机）上已知的异常指标截至当前时间的历史数据；
+    - 未来周期结束时，补充查询剩余的尾部数据，并查询等待期间新到达的异常指标的历史数据；
+    - 根因定位计算相关性时，优先使用预取的结果，未预取的指标仍按原方式查询。
+    查询结果按 (指标ID, 查询条件, 时间窗口结束时间) 缓存，老化后删除。
+    """
+    def __init__(self, metric_db_mgt: PromMgt, workers=DEFAULT_PREFETCH_WORKERS, safe_lag=DEFAULT_SAFE_LAG,
+                 max_metrics=DEFAULT_MAX_METRICS, aging_duration=600, max_entries=DEFAULT_MAX_ENTRIES):
+        self.metric_db_mgt = metric_db_mgt
+        # 预取时只查询到当前时间减去 safe_lag 为止，避免最近的采样点还未写入 prometheus
+        self.safe_lag = safe_lag
+        self.max_metrics = max_metrics
+        self.aging_duration = aging_duration
+        self.max_entries = max_entries
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='hist-prefetch')
+        self._entries: Dict[tuple, _HistEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_entry_key(metric_id, query_options: dict, end_ts) -> tuple:
+        return metric_id, frozenset(query_options.items()), end_ts
+
+    def prefetch(self, abn_kpi: AbnormalEvent, metric_evts: List[AbnormalEvent]):
+        """异常KPI到达时调用，只查询到当前时间为止的数据"""
+        end_ts = get_hist_end_ts(abn_kpi)
+        step = self.metric_db_mgt.sample_step
+        start_ts = end_ts - self.metric_db_mgt.sample_duration
+        num = int((time.time() - self.safe_lag - start_ts) // step)
+        if num < 0:
+            return
+        self.submit(abn_kpi, metric_evts, end_ts, min(start_ts + num * step, end_ts))
+
+    def top_up(self, abn_kpi: AbnormalEvent, metric_evts: List[AbnormalEvent]):
+        """未来周期结束时调用，补充查询到时间窗口结束为止的数据"""
+        end_ts = get_hist_end_ts(abn_kpi)
+        self.submit(abn_kpi, metric_evts, end_ts, end_ts)
+
+    def submit(self, abn_kpi: AbnormalEvent, metric_evts: List[AbnormalEvent], end_ts, until):
+        self.clear_aging_entries(time.time())
+        metrics = self.select_metrics(abn_kpi, metric_evts)
+        for metric_id, metric_labels in metrics:
+            try:
+                query_options = self.metric_db_mgt.obsv_meta_mgt.get_entity_keys_of_metric(metric_id, metric_labels)
+            except MetadataException as ex:
+                logger.logger.debug(ex)
+                continue
+            entry = self.get_or_create_entry(metric_id, query_options, end_ts)
+            self.executor.submit(self.fetch_quietly, entry, until)
+        logger.logger.debug('Prefetch history data of {} metrics until {}, event_id={}.'.format(
+            len(metrics), until, abn_kpi.event_id))
+
+    def select_metrics(self, abn_kpi: AbnormalEvent, metric_evts: List[AbnormalEvent]) -> List[Tuple[str, dict]]:
+        machine_ids = {abn_kpi.metric_labels.get(MACHINE_ID_NAME)}
+        for evt in metric_evts:
+            if abn_kpi.event_id and evt.event_id == abn_kpi.event_id:
+                machine_ids.add(evt.metric_labels.get(MACHINE_ID_NAME))
+        machine_ids.discard(None)
+
+        res = [(abn_kpi.abnormal_metric_id, abn_kpi.metric_labels)]
+        unique = {(abn_kpi.abnormal_metric_id, abn_kpi.abnormal_entity_id)}
+        for evt in metric_evts:
+            if len(res) >= self.max_metrics:
+                break
+            if evt.metric_labels.get(MACHINE_ID_NAME) not in machine_ids:
+                continue
+            if (evt.abnormal_metric_id, evt.abnormal_entity_id) in unique:
+                continue
+            unique.add((evt.abnormal_metric_id, evt.abnormal_entity_id))
+            res.append((evt.abnormal_metric_id, evt.metric_labels))
+        return res
+
+    def get_or_create_entry(self, metric_id, query_options: dict, end_ts) -> _HistEntry:
+        key = self.get_entry_key(metric_id, query_options, end_ts)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _HistEntry(self.metric_db_mgt, metric_id, query_options, end_ts)
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return entry
+
+    @staticmethod
+    def fetch_quietly(entry: _HistEntry, until):
+        try:
+            entry.fetch(until)
+        except Exception as ex:
+            logger.logger.debug('Failed to prefetch history data of the metric {}, because {}'.format(
+                entry.metric_id, ex))
+
+    def get_records(self, metric_id, query_options: dict, end_ts) -> Optional[List[DataRecord]]:
+        """获取预取的历史数据，并补充还未查询的尾部，未预取时返回 None"""
+        with self._lock:
+            entry = self._entries.get(self.get_entry_key(metric_id, query_options, end_ts))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry.fetch(end_ts)
+
+    def clear_aging_entries(self, cur_ts):
+        with self._lock:
+            aging_keys = [key for key, entry in self._entries.items() if entry.end_ts + self.aging_duration < cur_ts]
+            for key in aging_keys:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
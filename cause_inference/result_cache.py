@@ -0,0 +1,87 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from spider.util import logger
+
+from cause_inference.model import AbnormalEvent
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_REPORT_INTERVAL = 60
+
+
+class InferResultCache:
+    """
+    根因定位结果缓存。同一实体上的同一KPI在事件持续期间会反复告警，若拓扑图时间点和有效的异常指标集合都相同，
+    则直接复用上一次的根因定位结果，不再重新定位。
+    缓存键为 (异常实体ID, 异常KPI指标ID, 拓扑图时间点, 有效异常指标集合)，直接保存集合本身，哈希冲突时不会误用其它结果。
+    缓存在 ttl 秒后过期，ttl 为 0 表示不缓存。部分结果（超时）不缓存。
+    命中数和未命中数按 report_interval 周期输出到日志中，服务中与各 topic 的消费统计信息使用相同的周期。
+    """
+    def __init__(self, ttl=0, max_entries=DEFAULT_MAX_ENTRIES, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.report_interval = report_interval
+        self.hits = 0
+        self.misses = 0
+        # 缓存键 -> (过期时间, 根因定位结果)
+        self._entries: Dict[tuple, tuple] = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_report_ts = time.time()
+
+    def enabled(self) -> bool:
+        return bool(self.ttl) and self.ttl > 0
+
+    @staticmethod
+    def gen_key(abn_kpi: AbnormalEvent, abn_metrics: List[AbnormalEvent], topo_ts) -> tuple:
+        abn_metric_set = frozenset((evt.abnormal_entity_id, evt.abnormal_metric_id) for evt in abn_metrics)
+        return abn_kpi.abnormal_entity_id, abn_kpi.abnormal_metric_id, topo_ts, abn_metric_set
+
+    def get(self, key) -> Optional[dict]:
+        cur_ts = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < cur_ts:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._report_if_needed()
+        return copy.deepcopy(entry[1]) if entry is not None else None
+
+    def put(self, key, res: dict):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, copy.deepcopy(res))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _report_if_needed(self):
+        if not self.report_interval or time.time() - self._last_report_ts < self.report_interval:
+            return
+        self._last_report_ts = time.time()
+        stats = self.stats()
+        total = stats.get('hits') + stats.get('misses')
+        hit_rate = stats.get('hits') / total if total else 0.0
+        logger.logger.info('Inference result cache: entries={}, hits={}, misses={}, hit_rate={:.1%}.'.format(
+            stats.get('entries'), stats.get('hits'), stats.get('misses'), hit_rate))
+
+
+def reuse_infer_result(res: dict, abn_kpi: AbnormalEvent) -> dict:
+    """复用缓存的根因定位结果，更新为新的异常KPI事件的时间戳，并标记为缓存结果"""
+    if not res:
+        return res
+    res.get('abnormal_kpi', {})['timestamp'] = abn_kpi.timestamp
+    res['cached'] = True
+    return res
+
+
+result_cache = InferResultCache()
@@ -2,14 +2,13 @@ import os
 from abc import ABCMeta
 from abc import abstractmethod
 from typing import List, Dict, Tuple
-from itertools import permutations
 
 import yaml
 
 from spider.util import logger
 from spider.conf.observe_meta import EntityType, RelationType
 from cause_inference.model import MetricCategoryDetail
-from cause_inference.model import TopoNode, TopoEdge
+from cause_inference.model import TopoNode, TopoEdge, TopoIndex
 from cause_inference.model import virtual_metric_id_map, is_virtual_category
 from cause_inference.trend import parse_trend
 
@@ -18,6 +17,13 @@ METRIC_CATEGORY_ALL = 'ALL'
 METRIC_CATEGORY_OTHER = 'OTHER'
 
 QEMU_PROC_NAME = 'qemu-kvm'
+PROC_COMM_LABEL = 'comm'
+
+# 推理规则中引用的观测实体标签，拓扑查询时需要保留
+RULE_REFERENCED_LABELS = [PROC_COMM_LABEL]
+
+# 每个 RuleMeta 缓存的因果关系模板的最大个数，超过后清空
+MAX_RELATION_TEMPLATES = 1024
 
 
 class MetricCategoryPair:
@@ -26,14 +32,34 @@ class MetricCategoryPair:
         self.to_ = to_
 
 
+def compile_metric_categories(categories: Dict[str, MetricCategoryDetail]) -> Dict[str, List[str]]:
+    """将指标分类编译为 指标 -> 所属分类列表 的映射，一个指标可以属于多个分类"""
+    metric_index: Dict[str, List[str]] = {}
+    for cate_type, cate_detail in categories.items():
+        for metric in cate_detail.metrics or []:
+            cate_types = metric_index.setdefault(metric, [])
+            if cate_type not in cate_types:
+                cate_types.append(cate_type)
+    return metric_index
+
+
 class RuleMeta:
     def __init__(self, from_type: str, to_type: str, from_categories: Dict[str, MetricCategoryDetail] = None,
-                 to_categories: Dict[str, MetricCategoryDetail] = None, metric_range: List[MetricCategoryPair] = None):
+                 to_categories: Dict[str, MetricCategoryDetail] = None, metric_range: List[MetricCategoryPair] = None,
+                 from_metric_index: Dict[str, List[str]] = None, to_metric_index: Dict[str, List[str]] = None):
         self.from_type = from_type
         self.to_type = to_type
         self.from_categories = from_categories or {}
         self.to_categories = to_categories or {}
         self.category_pairs: List[MetricCategoryPair] = metric_range or []
+        if from_metric_index is None:
+            from_metric_index = compile_metric_categories(self.from_categories)
+        if to_metric_index is None:
+            to_metric_index = compile_metric_categories(self.to_categories)
+        self.from_metric_index = from_metric_index
+        self.to_metric_index = to_metric_index
+        # (frozenset(from_metrics), frozenset(to_metrics)) -> 因果关系模板
+        self._relation_templates: Dict[tuple, list] = {}
 
     @staticmethod
     def aggregate_metric_from_groups(category_type, metric_groups) -> List[dict]:
@@ -54,22 +80,20 @@ class RuleMeta:
         return res
 
     @staticmethod
-    def _group_metric_by_category(metrics: list, categories: Dict[str, MetricCategoryDetail]) -> Dict[str, list]:
-        parts = {}
-        parted_metrics = set()
-        for cate_type, cate_detail in categories.items():
-            part = []
-            for metric in metrics:
-                if metric in cate_detail.metrics:
-                    part.append(metric)
-                    parted_metrics.add(metric)
-            if len(part) > 0:
-                parts.setdefault(cate_type, part)
-
+    def _group_metric_by_category(metrics: list, categories: Dict[str, MetricCategoryDetail],
+                                  metric_index: Dict[str, List[str]]) -> Dict[str, list]:
+        grouped = {}
         other_part = []
         for metric in metrics:
-            if metric not in parted_metrics:
+            cate_types = metric_index.get(metric)
+            if not cate_types:
                 other_part.append(metric)
+                continue
+            for cate_type in cate_types:
+                grouped.setdefault(cate_type, []).append(metric)
+
+        # 分组顺序与指标分类的定义顺序相同
+        parts = {cate_type: grouped[cate_type] for cate_type in categories if cate_type in grouped}
         if len(other_part) > 0:
             parts.setdefault(METRIC_CATEGORY_OTHER, other_part)
 
@@ -84,21 +108,69 @@ class RuleMeta:
             example:
             [({'cate_type': 'PROC_IO_LOAD', 'trend': DataTrend.RISE, 'metrics': ['m1', 'm2']},
             {'cate_type': 'DISK_IO_LOAD', 'trend': DataTrend.RISE, 'metrics': ['m3', 'm4']})]
+        返回值会被调用方修改，因此每次返回缓存模板的副本。
         """
-        causal_relations = []
-
-        from_groups = self._group_metric_by_category(real_from_metrics, self.from_categories)
-        to_groups = self._group_metric_by_category(real_to_metrics, self.to_categories)
-        for cate_pair in self.category_pairs:
+        key = (frozenset(real_from_metrics), frozenset(real_to_metrics))
+        template = self._relation_templates.get(key)
+        if template is None:
+            template = self._build_relation_template(sorted(key[0]), sorted(key[1]))
+            if len(self._relation_templates) >= MAX_RELATION_TEMPLATES:
+                self._relation_templates.clear()
+            self._relation_templates[key] = template
+        return self._instantiate_relation_template(template, real_from_metrics, real_to_metrics)
+
+    def _build_relation_template(self, from_metrics: list, to_metrics: list) -> list:
+        """
+        构建与指标输入顺序无关的因果关系模板，每个因果关系附带排序键 (分类对序号, 源分组排序键, 目的分组排序键)。
+        OTHER 分类中的指标各自成组、且依次相邻，其排序键为 (第一个 OTHER 分组的序号, 指标)，
+        实例化时再按指标在输入中的位置排序，使结果与不使用缓存时相同。
+        """
+        template = []
+        from_groups = self._group_metric_by_category(from_metrics, self.from_categories, self.from_metric_index)
+        to_groups = self._group_metric_by_category(to_metrics, self.to_categories, self.to_metric_index)
+        for pair_idx, cate_pair in enumerate(self.category_pairs):
             all_from_metrics = self.aggregate_metric_from_groups(cate_pair.from_, from_groups)
             all_to_metrics = self.aggregate_metric_from_groups(cate_pair.to_, to_groups)
-            for from_metrics in all_from_metrics:
-                for to_metrics in all_to_metrics:
-                    causal_relations.append((from_metrics, to_metrics))
+            from_ranks = self._get_group_ranks(all_from_metrics)
+            to_ranks = self._get_group_ranks(all_to_metrics)
+            for from_group, from_rank in zip(all_from_metrics, from_ranks):
+                for to_group, to_rank in zip(all_to_metrics, to_ranks):
+                    template.append(((pair_idx, from_rank, to_rank), from_group, to_group))
 
-        self.add_trend_info(causal_relations)
+        self.add_trend_info([(from_group, to_group) for _, from_group, to_group in template])
 
-        return causal_relations
+        return template
+
+    @staticmethod
+    def _get_group_ranks(metric_groups: List[dict]) -> List[tuple]:
+        other_idx = None
+        ranks = []
+        for idx, metric_group in enumerate(metric_groups):
+            if metric_group.get('cate_type') != METRIC_CATEGORY_OTHER:
+                ranks.append((idx, None))
+                continue
+            if other_idx is None:
+                other_idx = idx
+            ranks.append((other_idx, metric_group.get('metrics')[0]))
+        return ranks
+
+    @staticmethod
+    def _instantiate_relation_template(template: list, real_from_metrics: list, real_to_metrics: list)\
+            -> List[Tuple[dict, dict]]:
+        from_pos = {metric: i for i, metric in enumerate(real_from_metrics)}
+        to_pos = {metric: i for i, metric in enumerate(real_to_metrics)}
+
+        def sort_key(item):
+            pair_idx, (from_idx, from_metric), (to_idx, to_metric) = item[0]
+            return pair_idx, from_idx, from_pos.get(from_metric, -1), to_idx, to_pos.get(to_metric, -1)
+
+        def copy_group(metric_group: dict, pos: dict) -> dict:
+            metric_group = dict(metric_group)
+            metric_group['metrics'] = sorted(metric_group.get('metrics'), key=lambda metric: pos.get(metric, -1))
+            return metric_group
+
+        return [(copy_group(from_group, from_pos), copy_group(to_group, to_pos))
+                for _, from_group, to_group in sorted(template, key=sort_key)]
 
     def add_trend_info(self, causal_relations: List[Tuple[dict, dict]]):
         for f_relation, t_relation in causal_relations:
@@ -116,52 +188,28 @@ def get_causal_relation(f_node: TopoNode, t_node: TopoNode) -> Tuple[str, str]:
 
 class Rule(metaclass=ABCMeta):
     @abstractmethod
-    def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+    def rule_parsing(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         pass
 
 
 # 规则：如果一个 tcp_link 观测实例 A 和一个 sli 观测实例 B 属于同一个 process 观测实例 C，则建立 A 到 B 的因果关系。
 class SliRule(Rule):
-    def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+    def rule_parsing(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
-        tcp_bt_p = []
-        sli_bt_p = []
-        for _, edge in topo_edges.items():
-            if edge.type != RelationType.BELONGS_TO.value:
-                continue
-
-            f_node = topo_nodes.get(edge.from_id)
-            t_node = topo_nodes.get(edge.to_id)
-            if not f_node or not t_node:
-                continue
-            if t_node.entity_type != EntityType.PROCESS.value:
+        for _, f_node, t_node in topo_index.get_edges(RelationType.BELONGS_TO.value):
+            if f_node.entity_type != EntityType.TCP_LINK.value or t_node.entity_type != EntityType.PROCESS.value:
                 continue
-
-            if f_node.entity_type == EntityType.TCP_LINK.value:
-                tcp_bt_p.append(edge)
-            elif f_node.entity_type == EntityType.SLI.value:
-                sli_bt_p.append(edge)
-
-        for edge1 in tcp_bt_p:
-            for edge2 in sli_bt_p:
-                if edge1.to_id == edge2.to_id:
-                    causal_relations.append(get_causal_relation(topo_nodes.get(edge1.from_id),
-                                                                topo_nodes.get(edge2.from_id)))
+            for _, sli_node, _ in topo_index.get_edges_to(RelationType.BELONGS_TO.value, t_node.id):
+                if sli_node.entity_type == EntityType.SLI.value:
+                    causal_relations.append(get_causal_relation(f_node, sli_node))
 
         return causal_relations
 
 
 class BelongsToRule(Rule):
-    def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+    def rule_parsing(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
-        for _, edge in topo_edges.items():
-            if edge.type != RelationType.BELONGS_TO.value:
-                continue
-            f_node = topo_nodes.get(edge.from_id)
-            t_node = topo_nodes.get(edge.to_id)
-            if not f_node or not t_node:
-                continue
-
+        for _, f_node, t_node in topo_index.get_edges(RelationType.BELONGS_TO.value):
             if f_node.entity_type == EntityType.SLI.value and t_node.entity_type == EntityType.PROCESS.value:
                 # 规则：建立 process 到 sli 的因果关系
                 causal_relations.append(get_causal_relation(t_node, f_node))
@@ -173,76 +221,62 @@ class BelongsToRule(Rule):
 
 # 规则：如果观测实例 A 到观测实例 B 存在 runs_on 关系，则建立 B 到 A 的因果关系。
 class RunsOnRule(Rule):
-    def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+    def rule_parsing(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
-        for _, edge in topo_edges.items():
-            if edge.type != RelationType.RUNS_ON.value:
-                continue
-            f_node, t_node = topo_nodes.get(edge.from_id), topo_nodes.get(edge.to_id)
-            if not f_node or not t_node:
-                continue
+        for _, f_node, t_node in topo_index.get_edges(RelationType.RUNS_ON.value):
             causal_relations.append(get_causal_relation(t_node, f_node))
         return causal_relations
 
 
 class HostRule(Rule):
+    # 同一主机上建立因果关系的实体类型：from_type -> to_type 列表
+    RULE_TYPES = {
+        EntityType.PROCESS.value: [EntityType.DISK.value],
+        EntityType.BLOCK.value: [EntityType.PROCESS.value],
+        EntityType.CPU.value: [EntityType.PROCESS.value],
+        EntityType.NETCARD.value: [EntityType.TCP_LINK.value],
+    }
+
     @staticmethod
     def check_rule_type(f_node_type: str, t_node_type: str) -> bool:
-        if (f_node_type, t_node_type) == (EntityType.PROCESS.value, EntityType.DISK.value):
-            return True
-        if (f_node_type, t_node_type) == (EntityType.BLOCK.value, EntityType.PROCESS.value):
-            return True
-        if (f_node_type, t_node_type) == (EntityType.CPU.value, EntityType.PROCESS.value):
-            return True
-        if (f_node_type, t_node_type) == (EntityType.NETCARD.value, EntityType.TCP_LINK.value):
-            return True
-        return False
+        return t_node_type in HostRule.RULE_TYPES.get(f_node_type, [])
 
-    def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+    def rule_parsing(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
-
-        host_nodes_map: Dict[str, List[TopoNode]] = {}
-        for node in topo_nodes.values():
-            val = host_nodes_map.setdefault(node.machine_id, [])
-            val.append(node)
-
-        for host_nodes in host_nodes_map.values():
-            for f_node, t_node in permutations(host_nodes, 2):
-                if not self.check_rule_type(f_node.entity_type, t_node.entity_type):
-                    continue
-                causal_relations.append(get_causal_relation(f_node, t_node))
+        for machine_id, host_nodes in topo_index.nodes_by_machine.items():
+            for f_node in host_nodes:
+                for to_type in self.RULE_TYPES.get(f_node.entity_type, []):
+                    for t_node in topo_index.get_nodes(machine_id, to_type):
+                        causal_relations.append(get_causal_relation(f_node, t_node))
 
         return causal_relations
 
 
 class CrossHostRule(Rule):
     @staticmethod
-    def parse_runs_on_rule(f_node: TopoNode, t_node: TopoNode, node_m_t_map: dict) -> List[Tuple[str, str]]:
+    def parse_runs_on_rule(f_node: TopoNode, t_node: TopoNode, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
         if (f_node.entity_type, t_node.entity_type) != (EntityType.HOST.value, EntityType.PROCESS.value):
             return []
 
-        f_disk_nodes = node_m_t_map.get((f_node.machine_id, EntityType.DISK.value), [])
-        for node in f_disk_nodes:
+        for node in topo_index.get_nodes(f_node.machine_id, EntityType.DISK.value):
             causal_relations.append(get_causal_relation(node, t_node))
 
-        f_block_nodes = node_m_t_map.get((f_node.machine_id, EntityType.BLOCK.value), [])
-        for node in f_block_nodes:
+        for node in topo_index.get_nodes(f_node.machine_id, EntityType.BLOCK.value):
             causal_relations.append(get_causal_relation(t_node, node))
 
         return causal_relations
 
     @staticmethod
-    def parse_store_in_rule(f_node: TopoNode, t_node: TopoNode, node_m_t_map: dict) -> List[Tuple[str, str]]:
+    def parse_store_in_rule(f_node: TopoNode, t_node: TopoNode, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
         if (f_node.entity_type, t_node.entity_type) != (EntityType.HOST.value, EntityType.HOST.value):
             return []
 
-        f_proc_nodes = node_m_t_map.get((f_node.machine_id, EntityType.PROCESS.value), [])
-        t_disk_nodes = node_m_t_map.get((t_node.machine_id, EntityType.DISK.value), [])
-        t_block_nodes = node_m_t_map.get((t_node.machine_id, EntityType.BLOCK.value), [])
-        for proc_node in f_proc_nodes:
-            if proc_node.raw_data.get('comm') != QEMU_PROC_NAME:
+        t_disk_nodes = topo_index.get_nodes(t_node.machine_id, EntityType.DISK.value)
+        t_block_nodes = topo_index.get_nodes(t_node.machine_id, EntityType.BLOCK.value)
+        for proc_node in topo_index.get_nodes(f_node.machine_id, EntityType.PROCESS.value):
+            if proc_node.raw_data.get(PROC_COMM_LABEL) != QEMU_PROC_NAME:
                 continue
             for disk_node in t_disk_nodes:
                 causal_relations.append(get_causal_relation(proc_node, disk_node))
@@ -251,26 +285,14 @@ class CrossHostRule(Rule):
 
         return causal_relations
 
-    def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+    def rule_parsing(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
-
-        node_m_t_map = {}
-        for node in topo_nodes.values():
-            key = (node.machine_id, node.entity_type)
-            val = node_m_t_map.setdefault(key, [])
-            val.append(node)
-
-        for edge in topo_edges.values():
-            f_node = topo_nodes.get(edge.from_id)
-            t_node = topo_nodes.get(edge.to_id)
-            if not f_node or not t_node:
-                continue
-            if f_node.machine_id == t_node.machine_id:
-                continue
-            if edge.type == RelationType.RUNS_ON.value:
-                causal_relations.extend(self.parse_runs_on_rule(f_node, t_node, node_m_t_map))
-            if edge.type == RelationType.STORE_IN.value:
-                causal_relations.extend(self.parse_store_in_rule(f_node, t_node, node_m_t_map))
+        for _, f_node, t_node in topo_index.get_edges(RelationType.RUNS_ON.value):
+            if f_node.machine_id != t_node.machine_id:
+                causal_relations.extend(self.parse_runs_on_rule(f_node, t_node, topo_index))
+        for _, f_node, t_node in topo_index.get_edges(RelationType.STORE_IN.value):
+            if f_node.machine_id != t_node.machine_id:
+                causal_relations.extend(self.parse_store_in_rule(f_node, t_node, topo_index))
 
         return causal_relations
 
@@ -280,8 +302,11 @@ class RuleEngine:
         self.rules: List[Rule] = []
         self.cross_rules: List[Rule] = []
         self.metric_categories: Dict[str, Dict[str, MetricCategoryDetail]] = {}
+        # 加载时编译的 指标 -> 所属分类列表 映射，按实体类型区分
+        self.metric_category_index: Dict[str, Dict[str, List[str]]] = {}
         self.rule_metas: Dict[tuple, RuleMeta] = {}
         self.cross_rule_metas: Dict[tuple, RuleMeta] = {}
+        self.default_rule_metas: Dict[tuple, RuleMeta] = {}
 
     def add_rule(self, rule: Rule):
         self.rules.append(rule)
@@ -290,16 +315,22 @@ class RuleEngine:
         self.cross_rules.append(rule)
 
     def rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge]) -> List[Tuple[str, str]]:
+        return self.rule_parsing_by_index(TopoIndex(topo_nodes, topo_edges))
+
+    def rule_parsing_by_index(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
         for rule in self.rules:
-            causal_relations.extend(rule.rule_parsing(topo_nodes, topo_edges))
+            causal_relations.extend(rule.rule_parsing(topo_index))
         return causal_relations
 
     def cross_rule_parsing(self, topo_nodes: Dict[str, TopoNode], topo_edges: Dict[str, TopoEdge])\
             -> List[Tuple[str, str]]:
+        return self.cross_rule_parsing_by_index(TopoIndex(topo_nodes, topo_edges))
+
+    def cross_rule_parsing_by_index(self, topo_index: TopoIndex) -> List[Tuple[str, str]]:
         causal_relations = []
         for rule in self.cross_rules:
-            causal_relations.extend(rule.rule_parsing(topo_nodes, topo_edges))
+            causal_relations.extend(rule.rule_parsing(topo_index))
         return causal_relations
 
     def load_rule_meta_from_yaml(self, rule_path: str) -> bool:
@@ -314,28 +345,43 @@ class RuleEngine:
         return True
 
     def create_default_rule_meta(self, from_type, to_type):
+        return self.create_rule_meta(from_type, to_type, [MetricCategoryPair(METRIC_CATEGORY_ALL, METRIC_CATEGORY_ALL)])
+
+    def get_default_rule_meta(self, from_type, to_type):
+        # 默认规则在所有同类型的实体关系之间共享，从而共享其因果关系模板缓存
+        rule_meta = self.default_rule_metas.get((from_type, to_type))
+        if rule_meta is None:
+            rule_meta = self.create_default_rule_meta(from_type, to_type)
+            self.default_rule_metas[(from_type, to_type)] = rule_meta
+        return rule_meta
+
+    def create_rule_meta(self, from_type, to_type, metric_range: List[MetricCategoryPair]) -> RuleMeta:
         return RuleMeta(
             from_type,
             to_type,
             self.metric_categories.get(from_type),
             self.metric_categories.get(to_type),
-            [MetricCategoryPair(METRIC_CATEGORY_ALL, METRIC_CATEGORY_ALL)]
+            metric_range,
+            self.metric_category_index.get(from_type, {}),
+            self.metric_category_index.get(to_type, {})
         )
 
     def add_rule_meta(self, causal_graph):
         entity_cause_graph = causal_graph.entity_cause_graph
-        for edge in entity_cause_graph.edges:
-            from_type = entity_cause_graph.nodes[edge[0]].get('entity_type')
-            from_machine_id = entity_cause_graph.nodes[edge[0]].get('machine_id')
-            to_type = entity_cause_graph.nodes[edge[1]].get('entity_type')
-            to_machine_id = entity_cause_graph.nodes[edge[1]].get('machine_id')
+        entity_types = entity_cause_graph.node_attr_values('entity_type')
+        machine_ids = entity_cause_graph.node_attr_values('machine_id')
+        for from_idx, to_idx, edge_attrs in entity_cause_graph.edge_idx_items():
+            if 'rule_meta' in edge_attrs:
+                continue
+            from_type, from_machine_id = entity_types[from_idx], machine_ids[from_idx]
+            to_type, to_machine_id = entity_types[to_idx], machine_ids[to_idx]
             if from_machine_id == to_machine_id:
                 rule_meta = self.rule_metas.get((from_type, to_type))
             else:
                 rule_meta = self.cross_rule_metas.get((from_type, to_type))
             if not rule_meta:
-                rule_meta = self.create_default_rule_meta(from_type, to_type)
-            entity_cause_graph.edges[edge]["rule_meta"] = rule_meta
+                rule_meta = self.get_default_rule_meta(from_type, to_type)
+            edge_attrs["rule_meta"] = rule_meta
 
     def load_rule_meta_from_dict(self, data: dict):
         self.load_metric_categories(data.get('metric_categories', {}))
@@ -357,6 +403,9 @@ class RuleEngine:
                                                    parse_trend(category.get('trend')))
                 category_dict.setdefault(cate_type, cate_detail)
             self.metric_categories.setdefault(entity_type, category_dict)
+            self.metric_category_index.setdefault(entity_type,
+                                                  compile_metric_categories(self.metric_categories.get(entity_type)))
+        self.default_rule_metas.clear()
 
     def _load_infer_rules(self, infer_rules: list) -> dict:
         rule_metas = {}
@@ -368,8 +417,7 @@ class RuleEngine:
                 from_category = item.get('from')
                 to_category = item.get('to')
                 saved_metric_range.append(MetricCategoryPair(from_category, to_category))
-            saved_rule_meta = RuleMeta(from_entity_type, to_entity_type, self.metric_categories.get(from_entity_type),
-                                       self.metric_categories.get(to_entity_type), saved_metric_range)
+            saved_rule_meta = self.create_rule_meta(from_entity_type, to_entity_type, saved_metric_range)
             rule_metas.setdefault((from_entity_type, to_entity_type), saved_rule_meta)
         return rule_metas
 
@@ -0,0 +1,82 @@
+import threading
+import time
+from typing import Dict
+
+from spider.util import logger
+
+DEFAULT_REPORT_INTERVAL = 60
+
+
+def freeze_key(value):
+    """将调用参数转换为可哈希的键，字典按键排序"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_key(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(freeze_key(v) for v in value)
+    return value
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求：相同键的请求正在执行时，后到的请求不再发起调用，而是等待并共享正在执行的调用的结果（或异常）。
+    调用完成后立即移除，不缓存结果。
+    """
+    def __init__(self, name, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.name = name
+        self.report_interval = report_interval
+        # 实际发起的调用数，以及被合并、未实际发起的调用数
+        self.calls = 0
+        self.deduplicated = 0
+        self._in_flight: Dict[object, _Call] = {}
+        self._lock = threading.Lock()
+        self._last_report_ts = time.time()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.deduplicated += 1
+        self._report_if_needed()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'calls': self.calls, 'deduplicated': self.deduplicated}
+
+    def _report_if_needed(self):
+        if not self.report_interval or time.time() - self._last_report_ts < self.report_interval:
+            return
+        self._last_report_ts = time.time()
+        stats = self.stats()
+        logger.logger.info('Single flight {}: calls={}, deduplicated={}.'.format(
+            self.name, stats.get('calls'), stats.get('deduplicated')))
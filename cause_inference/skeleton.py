@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from spider.util import logger
+from cause_inference.model import HostTopo
+from cause_inference.causal_graph import CausalGraph
+from cause_inference.compact_graph import CompactDiGraph
+from cause_inference.rule_parser import rule_engine
+from cause_inference.exceptions import InferenceException
+from cause_inference.arangodb import get_entity_fields
+
+
+class HostSkeleton:
+    """
+    单个主机在某个拓扑时间点上的因果骨架，只依赖拓扑信息，与异常指标无关。
+    包括：主机拓扑、实体因果关系、已标注 rule_meta 的实体因果图。
+    """
+    def __init__(self, host_topo: HostTopo, causal_relations: List[tuple], entity_cause_graph: CompactDiGraph):
+        self.host_topo = host_topo
+        self.causal_relations = causal_relations
+        self.entity_cause_graph = entity_cause_graph
+
+    def new_causal_graph(self) -> CausalGraph:
+        causal_graph = CausalGraph()
+        causal_graph.entity_cause_graph = self.entity_cause_graph.copy()
+        return causal_graph
+
+
+def build_host_skeleton(host_topo: HostTopo) -> HostSkeleton:
+    causal_relations = rule_engine.rule_parsing_by_index(host_topo.get_topo_index())
+    causal_graph = CausalGraph()
+    causal_graph.init_entity_cause_graph(causal_relations, host_topo.nodes)
+    rule_engine.add_rule_meta(causal_graph)
+    return HostSkeleton(host_topo, causal_relations, causal_graph.entity_cause_graph)
+
+
+def get_meta_version() -> Tuple[str, ...]:
+    """
+    因果骨架中的拓扑节点只包含查询时根据观测元数据投影的字段，以投影字段作为元数据版本。
+    元数据更新（例如服务启动后才收到观测元数据）后，之前预热的因果骨架不再命中，由预热线程按新的元数据重新构建。
+    """
+    return tuple(get_entity_fields())
+
+
+class SkeletonCache:
+    def __init__(self, max_topo_num=3):
+        self.max_topo_num = max_topo_num
+        self._skeletons: Dict[Tuple[int, Tuple[str, ...]], Dict[str, HostSkeleton]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, machine_id, topo_ts) -> HostSkeleton:
+        key = (topo_ts, get_meta_version())
+        with self._lock:
+            return self._skeletons.get(key, {}).get(machine_id)
+
+    def has_topo(self, topo_ts) -> bool:
+        key = (topo_ts, get_meta_version())
+        with self._lock:
+            return key in self._skeletons
+
+    def put(self, topo_ts, skeletons: Dict[str, HostSkeleton], meta_version=None):
+        key = (topo_ts, meta_version or get_meta_version())
+        with self._lock:
+            self._skeletons[key] = skeletons
+            self._skeletons.move_to_end(key)
+            while len(self._skeletons) > self.max_topo_num:
+                self._skeletons.popitem(last=False)
+
+
+class SkeletonWarmThread(threading.Thread):
+    def __init__(self, topo_db_mgt, cache: SkeletonCache, interval):
+        super().__init__()
+        self.topo_db_mgt = topo_db_mgt
+        self.cache = cache
+        self.interval = interval
+
+    def run(self):
+        while True:
+            try:
+                topo_ts = self.topo_db_mgt.query_recent_topo_ts(int(time.time()))
+            except InferenceException as ex:
+                logger.logger.debug(ex)
+                topo_ts = None
+            if topo_ts is not None and not self.cache.has_topo(topo_ts):
+                self.warm(topo_ts)
+            time.sleep(self.interval)
+
+    def warm(self, topo_ts):
+        start = time.time()
+        # 在查询拓扑之前获取元数据版本，预热期间元数据更新时，本次结果按旧版本缓存，不会被新版本的查询命中
+        meta_version = get_meta_version()
+        try:
+            machine_ids = self.topo_db_mgt.query_all_machine_ids(topo_ts)
+        except InferenceException as ex:
+            logger.logger.warning(ex)
+            return
+
+        skeletons = {}
+        for machine_id in machine_ids:
+            try:
+                host_topo = self.topo_db_mgt.query_host_topo(machine_id, topo_ts)
+            except InferenceException as ex:
+                logger.logger.debug(ex)
+                continue
+            skeletons[machine_id] = build_host_skeleton(host_topo)
+        self.cache.put(topo_ts, skeletons, meta_version)
+        logger.logger.info('Causal skeletons of {} hosts warmed, topo timestamp={}, cost {:.3f}s.'.format(
+            len(skeletons), topo_ts, time.time() - start))
+
+
+skeleton_cache = SkeletonCache()
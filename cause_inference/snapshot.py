@@ -0,0 +1,138 @@
+import gzip
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from spider.conf.observe_meta import ObserveMetaMgt
+from spider.util import logger
+
+from cause_inference.model import AbnormalEvent
+
+SNAPSHOT_VERSION = 1
+DEFAULT_SNAPSHOT_INTERVAL = 30
+
+
+def evt_to_dict(evt: AbnormalEvent) -> dict:
+    return {
+        'timestamp': evt.timestamp,
+        'abnormal_metric_id': evt.abnormal_metric_id,
+        'abnormal_score': evt.abnormal_score,
+        'metric_labels': evt.metric_labels,
+        'abnormal_entity_id': evt.abnormal_entity_id,
+        'desc': evt.desc,
+        'event_id': evt.event_id,
+    }
+
+
+def evt_from_dict(data: dict) -> AbnormalEvent:
+    return AbnormalEvent(**data)
+
+
+class ObsvMetaRecorder:
+    """
+    记录已应用到 ObserveMetaMgt 的原始元数据消息，用于状态快照。
+    同一观测类型、同一元数据表、同一版本的消息只保留最后一条，按首次到达的顺序重放即可恢复 ObserveMetaMgt 的状态。
+    """
+    def __init__(self, observe_meta_mgt: ObserveMetaMgt):
+        self.observe_meta_mgt = observe_meta_mgt
+        self._raw_metadata: Dict[tuple, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add_observe_meta_from_dict(self, metadata: dict):
+        key = (metadata.get('entity_name'), metadata.get('meta_name'), metadata.get('version'))
+        with self._lock:
+            self._raw_metadata[key] = dict(metadata)
+        self.observe_meta_mgt.add_observe_meta_from_dict(metadata)
+
+    def get_all(self) -> List[dict]:
+        with self._lock:
+            return [dict(metadata) for metadata in self._raw_metadata.values()]
+
+    def restore(self, all_metadata: List[dict]):
+        for metadata in all_metadata:
+            self.add_observe_meta_from_dict(dict(metadata))
+        logger.logger.info('Restore {} observe metadata from snapshot.'.format(len(all_metadata)))
+
+
+def save_snapshot(path, state: dict):
+    """原子地写入状态快照：先写入同目录下的临时文件并刷盘，再重命名覆盖原文件"""
+    dir_path = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    tmp_path = '{}.tmp'.format(path)
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as file:
+        json.dump(state, file, separators=(',', ':'))
+    with open(tmp_path, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path) -> Optional[dict]:
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            state = json.load(file)
+    except (IOError, ValueError) as ex:
+        logger.logger.warning('Unable to load state snapshot {}, because {}'.format(path, ex))
+        return None
+    if not isinstance(state, dict) or state.get('version') != SNAPSHOT_VERSION:
+        logger.logger.warning('Unsupported state snapshot {}, ignore it.'.format(path))
+        return None
+    return state
+
+
+def get_snapshot_offsets(state: dict, topic_id) -> Dict[int, int]:
+    """获取快照中指定 topic 各分区的位移，topic 与快照中的不一致时返回空字典"""
+    topic_offsets = state.get('offsets', {}).get(topic_id, {})
+    return {int(partition): offset for partition, offset in topic_offsets.items()}
+
+
+class SnapshotThread(threading.Thread):
+    """
+    周期性地保存状态快照，包括：异常事件窗口、等待中的异常KPI、原始观测元数据，以及各 topic 已交给处理方的消息位移。
+    服务重启时加载快照恢复上述状态，并从快照中的位移继续消费，无需等待元数据和异常事件重新积累。
+    位移在消息处理完成后才确认，并与事件窗口、等待中的异常KPI在同一把锁下读取，快照中的位移与状态一致。
+    """
+    def __init__(self, path, interval, abn_evt_mgt, obsv_meta_recorder: ObsvMetaRecorder):
+        super().__init__()
+        self.path = path
+        self.interval = interval or DEFAULT_SNAPSHOT_INTERVAL
+        self.abn_evt_mgt = abn_evt_mgt
+        self.obsv_meta_recorder = obsv_meta_recorder
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except Exception as ex:
+                logger.logger.warning('Failed to save state snapshot, because {}'.format(ex))
+
+    def collect_offsets(self) -> Dict[str, Dict[int, int]]:
+        offsets = {}
+        for consumer in (self.abn_evt_mgt.kpi_consumer, self.abn_evt_mgt.metric_consumer):
+            if consumer is not None:
+                offsets[consumer.stats.topic_name] = consumer.get_delivered_offsets()
+        return offsets
+
+    def save(self):
+        start = time.time()
+        with self.abn_evt_mgt.state_lock:
+            offsets = self.collect_offsets()
+            abn_evts = self.abn_evt_mgt.evt_store.get_all()
+            pending_kpis = self.abn_evt_mgt.get_pending_kpis()
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'timestamp': int(start * 1000),
+            'offsets': offsets,
+            'metadata': self.obsv_meta_recorder.get_all(),
+            'abnormal_events': [evt_to_dict(evt) for evt in abn_evts],
+            'pending_kpis': [evt_to_dict(evt) for evt in pending_kpis],
+        }
+        save_snapshot(self.path, state)
+        logger.logger.debug('State snapshot saved, events={}, cost {:.3f}s.'.format(
+            len(state.get('abnormal_events')), time.time() - start))
@@ -4,6 +4,7 @@ from pyArango.collection import Collection
 from pyArango.connection import Connection
 from pyArango.database import Database
 from pyArango.document import Document
+from pyArango.theExceptions import CreationError
 from pyArango.theExceptions import UpdateError
 
 from spider.util import logger
@@ -120,6 +121,18 @@ class ArangoObserveEntityDaoImpl(ArangoBaseDaoImpl, ObserveEntityDao):
 class ArangoRelationDaoImpl(ArangoBaseDaoImpl, RelationDao):
     def __init__(self, db_conf):
         ArangoBaseDaoImpl.__init__(self, db_conf)
+        self._indexed_colls = set()
+
+    def _ensure_timestamp_index(self, coll: Collection):
+        # 边集合按时间戳查询，需要建立索引，避免全表扫描
+        if coll.name in self._indexed_colls:
+            return
+        try:
+            coll.ensurePersistentIndex(['timestamp'], sparse=False)
+        except CreationError as ex:
+            logger.logger.warning(ex)
+            return
+        self._indexed_colls.add(coll.name)
 
     def add_all(self, ts_sec, relations: List[Relation]) -> bool:
         if not relations:
@@ -138,6 +151,7 @@ class ArangoRelationDaoImpl(ArangoBaseDaoImpl, RelationDao):
             if not self.db.hasCollection(coll_name):
                 self.db.createCollection(className='Edges', name=coll_name)
             coll: Collection = self.db.collections[coll_name]
+            self._ensure_timestamp_index(coll)
 
             try:
                 count = coll.bulkSave(edges, onDuplicate='ignore')
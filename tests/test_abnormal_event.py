@@ -0,0 +1,60 @@
+"""
+异常事件窗口测试：积压消费时按异常KPI的时间老化异常指标事件。
+"""
+import json
+import time
+
+from cause_inference.abnormal_event import AbnEvtMgt
+from cause_inference.evt_consumer import EvtConsumeThread
+from cause_inference.inproc_kafka import InprocBroker, InprocConsumer, InprocProducer
+from cause_inference.model import AbnormalEvent
+
+METRIC_TOPIC = 'gala_anteater_metric'
+METRIC_GROUP_ID = 'abn-metric-inference'
+CONSUMER_TO = 0.05
+VALID_DURATION = 120
+FUTURE_DURATION = 60
+AGING_DURATION = 600
+
+
+def gen_metric_evt(ts):
+    return {
+        'Timestamp': ts,
+        'Attributes': {'entity_id': 'proc_1', 'event_id': str(ts)},
+        'Resource': {'metric': 'gala_gopher_proc_utime_jiffies', 'labels': {}, 'score': 1.0},
+    }
+
+
+def new_abn_evt_mgt(metric_ts_list) -> AbnEvtMgt:
+    broker = InprocBroker()
+    broker.create_topic(METRIC_TOPIC, 1)
+    producer = InprocProducer(broker=broker)
+    for ts in metric_ts_list:
+        producer.send(METRIC_TOPIC, json.dumps(gen_metric_evt(ts)).encode(), timestamp_ms=ts)
+    consume_thread = EvtConsumeThread(InprocConsumer(METRIC_TOPIC, group_id=METRIC_GROUP_ID, broker=broker),
+                                      METRIC_TOPIC, CONSUMER_TO, stats_interval=0)
+    consume_thread.poll_once()
+    return AbnEvtMgt(None, consume_thread, VALID_DURATION, FUTURE_DURATION, AGING_DURATION)
+
+
+def test_backlog_metric_evts_aged_by_pending_kpi():
+    # 积压了一小时前的异常指标事件，对应的异常KPI还在等待根因定位
+    kpi_ts = int(time.time() * 1000) - 3600 * 1000
+    aged_ts = kpi_ts - (AGING_DURATION + 1) * 1000
+    valid_ts = kpi_ts - VALID_DURATION * 1000 // 2
+    abn_evt_mgt = new_abn_evt_mgt([aged_ts, valid_ts, kpi_ts])
+    abn_evt_mgt.schedule_kpi(AbnormalEvent(kpi_ts, 'gala_gopher_sli_rtt_nsec', event_id='kpi'))
+
+    abn_evt_mgt.consume_metric_evts()
+
+    assert [evt.timestamp for evt in abn_evt_mgt.evt_store.get_all()] == [valid_ts, kpi_ts]
+    assert [evt.timestamp for evt in abn_evt_mgt.filter_valid_evts(kpi_ts)] == [valid_ts, kpi_ts]
+
+
+def test_metric_evts_kept_before_any_kpi():
+    old_ts = int(time.time() * 1000) - 3600 * 1000
+    abn_evt_mgt = new_abn_evt_mgt([old_ts])
+
+    abn_evt_mgt.consume_metric_evts()
+
+    assert [evt.timestamp for evt in abn_evt_mgt.evt_store.get_all()] == [old_ts]
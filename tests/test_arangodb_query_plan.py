@@ -0,0 +1,163 @@
+"""
+根因定位查询的执行计划回归测试：记录 cause_inference.arangodb 生成的 AQL ，通过 explain 替身按 gala-spider 存储侧建立的索引
+生成执行计划，检查查询使用主键索引和边索引，不退化为全表扫描。
+"""
+import re
+
+import pytest
+
+from cause_inference import arangodb
+
+_ENTITY_COLL = 'ObserveEntities_1700000000'
+_EDGE_COLL = 'runs_on'
+_TS = 1700000000
+
+# 存储侧建立的索引：所有集合都有主键索引，边集合还有 _from/_to 上的边索引，以及 timestamp 上的持久化索引
+_PRIMARY_FIELDS = {'_key', '_id'}
+_EDGE_FIELDS = {'_from', '_to'}
+_PERSISTENT_FIELDS = {'timestamp'}
+
+_FOR_TRAVERSAL = re.compile(r'^FOR\s+\w+(\s*,\s*\w+)*\s+IN\s+\S+\.\.\S+\s+(ANY|OUTBOUND|INBOUND)\s+\S+', re.I)
+_FOR_COLLECTION = re.compile(r'^FOR\s+(\w+)\s+IN\s+(\S+)', re.I)
+_FILTER_EQ = re.compile(r'^FILTER\s+(\w+)\.(\w+)\s*==', re.I)
+
+
+class ExplainStandIn:
+    """
+    explain 替身，模拟 ArangoDB 优化器对本模块查询形态的选择：
+    - 路径遍历生成 TraversalNode ，使用边索引；
+    - 集合遍历之后紧跟的等值过滤命中索引字段时生成 IndexNode ，否则生成 EnumerateCollectionNode（全表扫描）；
+    - DOCUMENT() 通过主键索引直接读取文档，生成 CalculationNode 。
+    """
+    def __init__(self, edge_colls):
+        self.edge_colls = set(edge_colls)
+
+    def get_index_type(self, coll, attr):
+        if attr in _PRIMARY_FIELDS:
+            return 'primary'
+        if coll in self.edge_colls and attr in _EDGE_FIELDS:
+            return 'edge'
+        if coll in self.edge_colls and attr in _PERSISTENT_FIELDS:
+            return 'persistent'
+        return None
+
+    def explain(self, query, bind_vars):
+        lines = [line.strip() for line in query.strip().splitlines() if line.strip()]
+        nodes = []
+        for i, line in enumerate(lines):
+            if _FOR_TRAVERSAL.match(line):
+                nodes.append({'type': 'TraversalNode', 'indexes': {'base': [{'type': 'edge'}]}})
+            elif _FOR_COLLECTION.match(line):
+                match = _FOR_COLLECTION.match(line)
+                var, coll = match.groups()
+                if coll.startswith('@@'):
+                    coll = bind_vars.get(coll[1:])
+                # 过滤条件可能与 FOR 写在同一行
+                filter_str = line[match.end():].strip() or (lines[i + 1] if i + 1 < len(lines) else '')
+                nodes.append(self.explain_collection_loop(var, coll, filter_str))
+            for _ in re.finditer(r'DOCUMENT\(', line, re.I):
+                nodes.append({'type': 'CalculationNode', 'expression': {'type': 'function call', 'name': 'DOCUMENT'}})
+        return {'plan': {'nodes': nodes}}
+
+    def explain_collection_loop(self, var, coll, filter_str):
+        match = _FILTER_EQ.match(filter_str)
+        if match and match.group(1) == var:
+            index_type = self.get_index_type(coll, match.group(2))
+            if index_type is not None:
+                return {'type': 'IndexNode', 'collection': coll,
+                        'indexes': [{'type': index_type, 'fields': [match.group(2)]}]}
+        return {'type': 'EnumerateCollectionNode', 'collection': coll}
+
+
+class FakeDb:
+    """记录执行的 AQL 查询，查询结果为空"""
+    def __init__(self, edge_colls=(_EDGE_COLL,)):
+        self.queries = []
+        self.explain_stand_in = ExplainStandIn(edge_colls)
+
+    def AQLQuery(self, query, bindVars=None, rawResults=False, batchSize=100):
+        self.queries.append((query, bindVars or {}))
+        return []
+
+    def explainAQLQuery(self, query, bindVars=None, allPlans=False):
+        return self.explain_stand_in.explain(query, bindVars or {})
+
+
+def explain_last_query(db: FakeDb) -> list:
+    query, bind_vars = db.queries[-1]
+    return db.explainAQLQuery(query, bindVars=bind_vars).get('plan').get('nodes')
+
+
+def get_node_types(nodes) -> list:
+    return [node.get('type') for node in nodes]
+
+
+def get_index_types(nodes) -> set:
+    index_types = set()
+    for node in nodes:
+        if node.get('type') == 'IndexNode':
+            index_types.update(index.get('type') for index in node.get('indexes'))
+        elif node.get('type') == 'TraversalNode':
+            index_types.update(index.get('type') for index in node.get('indexes').get('base'))
+        elif node.get('type') == 'CalculationNode' and node.get('expression', {}).get('name') == 'DOCUMENT':
+            index_types.add('primary')
+    return index_types
+
+
+def assert_no_full_scan(nodes):
+    assert 'EnumerateCollectionNode' not in get_node_types(nodes)
+
+
+def test_query_entity_by_key_uses_primary_index():
+    db = FakeDb()
+    assert arangodb.query_entity_by_key(db, _TS, 'host_1') is None
+
+    nodes = explain_last_query(db)
+    assert_no_full_scan(nodes)
+    assert get_index_types(nodes) == {'primary'}
+    assert db.queries[-1][1].get('coll') == _ENTITY_COLL
+
+
+def test_query_subgraph_uses_edge_index():
+    db = FakeDb()
+    nodes, edges = arangodb.query_subgraph(db, _TS, 'host_1', [_EDGE_COLL], depth=2,
+                                           query_options={'machine_id': 'm1'})
+    assert not nodes and not edges
+
+    plan_nodes = explain_last_query(db)
+    assert_no_full_scan(plan_nodes)
+    assert get_node_types(plan_nodes) == ['TraversalNode']
+    assert 'edge' in get_index_types(plan_nodes)
+    assert 'prune v.machine_id != @machine_id' in db.queries[-1][0]
+
+
+def test_query_cross_host_edges_detail_uses_indexes():
+    db = FakeDb()
+    assert arangodb.query_cross_host_edges_detail(db, _EDGE_COLL, _TS) == []
+
+    nodes = explain_last_query(db)
+    assert_no_full_scan(nodes)
+    assert get_index_types(nodes) == {'persistent', 'primary'}
+    # 两个端点都通过 DOCUMENT() 按主键读取，不再为每条边执行关联子查询
+    assert get_node_types(nodes).count('CalculationNode') == 2
+
+
+@pytest.mark.parametrize('query_options', [{'machine_id': 'm1'}, {'type': 'host', 'machine_id': 'm1'}])
+def test_explain_stand_in_detects_full_scan(query_options):
+    # 按非索引属性过滤实体集合会全表扫描，保证检查本身有效
+    db = FakeDb()
+    arangodb.query_topo_entities(db, _TS, query_options=query_options)
+
+    nodes = explain_last_query(db)
+    assert get_node_types(nodes) == ['EnumerateCollectionNode']
+    with pytest.raises(AssertionError):
+        assert_no_full_scan(nodes)
+
+
+def test_entity_projection_excludes_metrics_payload():
+    db = FakeDb()
+    arangodb.query_entity_by_key(db, _TS, 'host_1')
+
+    fields = db.queries[-1][1].get('fields')
+    assert {'_id', '_key', 'type', 'machine_id', 'timestamp'} <= set(fields)
+    assert 'metrics' not in fields
@@ -0,0 +1,112 @@
+"""
+根因定位结果异步发送测试：未确认的消息数达到上限时阻塞直到有消息确认，发送失败计数，关闭时发送所有缓存的消息。
+"""
+import json
+import threading
+
+from kafka.errors import KafkaTimeoutError
+
+from cause_inference.cause_sender import CauseSender
+from cause_inference.inproc_kafka import InprocBroker, InprocFuture, InprocProducer
+
+CAUSE_TOPIC = 'gala_cause_inference'
+WAIT_TIMEOUT = 5
+
+
+class BufferedProducer(InprocProducer):
+    """消息先缓存在 producer 中，deliver 或 flush 时才写入 broker 并确认"""
+    def __init__(self, **configs):
+        super().__init__(**configs)
+        self.pending = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def send(self, topic, value=None, key=None, partition=None, timestamp_ms=None) -> InprocFuture:
+        future = InprocFuture()
+        with self.lock:
+            self.pending.append((future, topic, value))
+        return future
+
+    def deliver(self, num=1, error=None):
+        with self.lock:
+            batch, self.pending = self.pending[:num], self.pending[num:]
+        for future, topic, value in batch:
+            if error is not None:
+                future.failure(error)
+            else:
+                future.success(self.broker.append(topic, value))
+
+    def flush(self, timeout=None):
+        self.deliver(len(self.pending))
+
+    def close(self, timeout=None):
+        self.closed = True
+
+
+def new_sender(max_outstanding=2, send_timeout=WAIT_TIMEOUT) -> CauseSender:
+    return CauseSender(BufferedProducer(broker=InprocBroker()), CAUSE_TOPIC, max_outstanding=max_outstanding,
+                       send_timeout=send_timeout)
+
+
+def gen_cause_msg(idx) -> dict:
+    return {'Attributes': {'event_id': 'evt_{}'.format(idx)}}
+
+
+def sent_event_ids(cause_sender: CauseSender) -> list:
+    records = cause_sender.producer.broker.topics.get(CAUSE_TOPIC, [[]])[0]
+    return [json.loads(record.value).get('Attributes').get('event_id') for record in records]
+
+
+def test_send_blocks_until_delivered():
+    cause_sender = new_sender()
+    cause_sender.send(gen_cause_msg(0))
+    cause_sender.send(gen_cause_msg(1))
+
+    send_thread = threading.Thread(target=cause_sender.send, args=(gen_cause_msg(2),))
+    send_thread.start()
+    send_thread.join(0.2)
+    assert send_thread.is_alive()
+    assert cause_sender.stats.submitted == 2
+
+    cause_sender.producer.deliver()
+    send_thread.join(WAIT_TIMEOUT)
+    assert not send_thread.is_alive()
+    assert cause_sender.stats.submitted == 3
+    assert cause_sender.stats.delivered == 1
+
+
+def test_send_dropped_after_timeout():
+    cause_sender = new_sender(max_outstanding=1, send_timeout=0.05)
+    cause_sender.send(gen_cause_msg(0))
+    cause_sender.send(gen_cause_msg(1))
+
+    assert (cause_sender.stats.submitted, cause_sender.stats.dropped) == (1, 1)
+    assert len(cause_sender.producer.pending) == 1
+
+
+def test_failed_sends_counted_and_release_slots():
+    cause_sender = new_sender()
+    cause_sender.send(gen_cause_msg(0))
+    cause_sender.send(gen_cause_msg(1))
+
+    cause_sender.producer.deliver(2, error=KafkaTimeoutError('send timed out'))
+
+    assert (cause_sender.stats.submitted, cause_sender.stats.failed, cause_sender.stats.delivered) == (2, 2, 0)
+    # 失败的消息释放了空位，之后的发送不阻塞
+    cause_sender.send_timeout = 0.05
+    cause_sender.send(gen_cause_msg(2))
+    cause_sender.send(gen_cause_msg(3))
+    assert cause_sender.stats.dropped == 0
+
+
+def test_close_flushes_pending_messages():
+    cause_sender = new_sender(max_outstanding=10)
+    for idx in range(3):
+        cause_sender.send(gen_cause_msg(idx))
+    assert sent_event_ids(cause_sender) == []
+
+    cause_sender.close()
+
+    assert sent_event_ids(cause_sender) == ['evt_0', 'evt_1', 'evt_2']
+    assert cause_sender.stats.delivered == 3
+    assert cause_sender.producer.closed
@@ -0,0 +1,126 @@
+"""
+跨主机根因定位扩展测试：按跳数限制扩展范围，已访问的主机不重复构建，时间预算耗尽后跳过剩余的查询并标记为部分结果。
+"""
+import time
+
+from spider.conf.observe_meta import RelationType
+
+from cause_inference.causal_graph import CausalGraph
+from cause_inference.cause_infer import ClusterCauseLocator
+from cause_inference.deadline import Deadline
+from cause_inference.infer_policy import get_infer_policy
+from cause_inference.model import AbnormalEvent, HostTopo, MetricNode, MetricNodeId, TopoEdge, TopoNode
+
+_TS = 1700000000000
+# m0 - m1 - m2 - m3 - m4 ，另有 m0 - m2
+MACHINE_LINKS = [('m0', 'm1'), ('m1', 'm2'), ('m2', 'm3'), ('m3', 'm4'), ('m0', 'm2')]
+
+
+def proc_node(machine_id) -> TopoNode:
+    return TopoNode('proc_' + machine_id, 'proc_' + machine_id, 'proc', machine_id, _TS)
+
+
+def metric_node(machine_id) -> MetricNode:
+    node_id = MetricNodeId('proc_' + machine_id, 'metric')
+    return MetricNode(node_id, {'corr_score': 0.5, 'machine_id': machine_id, 'entity_id': node_id.entity_n_id})
+
+
+class FakeTopoDbMgt:
+    def __init__(self, query_delay=0.0):
+        self.query_delay = query_delay
+        self.queried = []
+
+    def query_cross_host_edges_detail(self, r_type, ts_sec):
+        if r_type != RelationType.RUNS_ON.value:
+            return []
+        return [TopoEdge('{}_{}'.format(from_id, to_id), r_type, 'proc_' + from_id, 'proc_' + to_id,
+                         proc_node(from_id), proc_node(to_id)) for from_id, to_id in MACHINE_LINKS]
+
+    def query_host_topo(self, machine_id, ts_sec) -> HostTopo:
+        self.queried.append(machine_id)
+        time.sleep(self.query_delay)
+        node = proc_node(machine_id)
+        return HostTopo(machine_id, {node.id: node}, {})
+
+
+class StubClusterCauseLocator(ClusterCauseLocator):
+    """跨主机因果图中只包含邻居主机指标到受影响主机指标的一条边"""
+    def __init__(self, topo_db_mgt, **kwargs):
+        super().__init__(AbnormalEvent(_TS, 'metric', event_id='kpi'), [], topo_db_mgt, None,
+                         get_infer_policy('dfs'), 3, **kwargs)
+        self.built = []
+
+    def construct_cross_host_causal_graph(self, affected_host_topo, neigh_topo, cross_edge) -> CausalGraph:
+        self.built.append(neigh_topo.machine_id)
+        causal_graph = CausalGraph()
+        affected, neigh = metric_node(affected_host_topo.machine_id), metric_node(neigh_topo.machine_id)
+        for node in (affected, neigh):
+            causal_graph.metric_cause_graph.add_node(node.node_id, **node.node_attrs)
+        causal_graph.metric_cause_graph.add_edge(neigh.node_id, affected.node_id)
+        return causal_graph
+
+
+def new_locator(topo_db_mgt=None, **kwargs) -> StubClusterCauseLocator:
+    locator = StubClusterCauseLocator(topo_db_mgt or FakeTopoDbMgt(), workers=1, **kwargs)
+    locator.init_all_cross_host_edges()
+    locator.cause_tree.add_root(metric_node('m0'))
+    return locator
+
+
+def expand_from_m0(locator: StubClusterCauseLocator):
+    locator.expand_cross_host({'m0': [metric_node('m0')]}, 0)
+
+
+def test_expand_stops_at_max_hops():
+    locator = new_locator(max_hops=2)
+
+    expand_from_m0(locator)
+
+    # 第一跳扩展到 m1 、m2 ，第二跳扩展到 m3 ，m4 超过跳数限制
+    assert sorted(locator.built) == ['m1', 'm2', 'm3']
+    assert MetricNodeId('proc_m3', 'metric') in locator.cause_tree.all_node_map
+    assert not locator.partial
+
+
+def test_visited_machines_not_rebuilt():
+    locator = new_locator(max_hops=10)
+
+    expand_from_m0(locator)
+
+    # m2 同时是 m0 和 m1 的邻居，只构建一次
+    assert sorted(locator.built) == ['m1', 'm2', 'm3', 'm4']
+    assert locator.topo_db_mgt.queried.count('m2') == 2
+    assert not locator.partial
+
+
+def test_exhausted_time_budget_marks_partial():
+    locator = new_locator(time_budget=0)
+
+    expand_from_m0(locator)
+
+    assert locator.built == []
+    assert locator.topo_db_mgt.queried == []
+    assert locator.partial
+
+
+def test_expired_deadline_marks_partial():
+    deadline = Deadline(0.01)
+    time.sleep(0.02)
+    locator = new_locator(deadline=deadline)
+
+    expand_from_m0(locator)
+
+    assert locator.topo_db_mgt.queried == []
+    assert locator.partial
+
+
+def test_running_build_skipped_after_budget_expires():
+    locator = new_locator(FakeTopoDbMgt(query_delay=0.1))
+    locator.cross_host_expire_at = time.time() + 0.05
+    cross_edge = locator.filter_cross_host_edges('m0')[0]
+
+    # 查询受影响主机的拓扑期间预算耗尽，不再查询邻居主机的拓扑
+    assert locator.build_cross_host_causal_graph('m0', 'm1', cross_edge) is None
+    assert locator.topo_db_mgt.queried == ['m0']
+    assert locator.built == []
+    assert locator.partial
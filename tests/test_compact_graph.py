@@ -0,0 +1,117 @@
+"""
+紧凑有向图测试：增删节点、子图、复制以及遍历顺序与 networkx DiGraph 一致。
+"""
+import random
+
+import networkx as nx
+import pytest
+
+from cause_inference.compact_graph import CompactDiGraph, ancestors, topological_sort, is_directed_acyclic_graph
+
+
+def build_graphs(node_num, edges):
+    compact, reference = CompactDiGraph(), nx.DiGraph()
+    for graph in (compact, reference):
+        for i in range(node_num):
+            graph.add_node('n{}'.format(i), idx=i)
+        for src, dst in edges:
+            graph.add_edge('n{}'.format(src), 'n{}'.format(dst), weight=src + dst)
+    return compact, reference
+
+
+def random_edges(rng, node_num, edge_num, dag=False):
+    edges = []
+    for _ in range(edge_num):
+        src, dst = rng.randrange(node_num), rng.randrange(node_num)
+        if dag:
+            if src == dst:
+                continue
+            src, dst = min(src, dst), max(src, dst)
+        edges.append((src, dst))
+    return edges
+
+
+def assert_same_graph(compact: CompactDiGraph, reference: nx.DiGraph):
+    assert list(compact.nodes) == list(reference.nodes)
+    # 边按加入顺序遍历，networkx 按起点分组遍历，只比较边集合
+    assert set(compact.edges) == set(reference.edges)
+    assert len(compact.nodes) == len(reference.nodes)
+    assert len(compact.edges) == len(reference.edges)
+    for node_id in reference.nodes:
+        assert dict(compact.nodes[node_id]) == reference.nodes[node_id]
+        assert list(compact.successors(node_id)) == list(reference.successors(node_id))
+        assert list(compact.predecessors(node_id)) == list(reference.predecessors(node_id))
+        assert compact.in_degree(node_id) == reference.in_degree(node_id)
+        assert compact.out_degree(node_id) == reference.out_degree(node_id)
+    for edge in reference.edges:
+        assert dict(compact.edges[edge]) == reference.edges[edge]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_add_and_remove_match_networkx(seed):
+    rng = random.Random(seed)
+    compact, reference = build_graphs(50, random_edges(rng, 50, 150))
+    assert_same_graph(compact, reference)
+
+    for node_id in rng.sample(list(reference.nodes), 15):
+        compact.remove_node(node_id)
+        reference.remove_node(node_id)
+        # 删除过程中穿插查询，检查邻接关系重新构建
+        if rng.random() < 0.3:
+            assert_same_graph(compact, reference)
+    assert_same_graph(compact, reference)
+
+    # 删除后再加入的节点和边
+    for graph in (compact, reference):
+        graph.add_node('n_new', idx=-1)
+        graph.add_edge('n_new', next(iter(reference.nodes)))
+    assert_same_graph(compact, reference)
+    assert ('n0', 'n_missing') not in compact.edges
+
+
+def test_remove_node_with_self_loop():
+    compact, reference = build_graphs(3, [(0, 0), (0, 1), (1, 2)])
+    for graph in (compact, reference):
+        graph.remove_node('n0')
+    assert_same_graph(compact, reference)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_subgraph_and_copy_match_networkx(seed):
+    rng = random.Random(seed)
+    compact, reference = build_graphs(40, random_edges(rng, 40, 120))
+    compact.remove_node('n3')
+    reference.remove_node('n3')
+
+    node_ids = rng.sample(list(reference.nodes), 20)
+    # 与 networkx 的子图视图比较，视图中前驱、后继的顺序与原图相同
+    assert_same_graph(compact.subgraph(node_ids), reference.subgraph(node_ids))
+
+    graph_copy = compact.copy()
+    assert_same_graph(graph_copy, reference)
+    # 修改副本不影响原图
+    graph_copy.remove_node('n0')
+    graph_copy.add_edge('n1', 'n2')
+    graph_copy.nodes['n1']['idx'] = 100
+    assert_same_graph(compact, reference)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_ancestors_and_topological_sort_match_networkx(seed):
+    rng = random.Random(seed)
+    compact, reference = build_graphs(60, random_edges(rng, 60, 150, dag=True))
+    for node_id in rng.sample(list(reference.nodes), 10):
+        compact.remove_node(node_id)
+        reference.remove_node(node_id)
+
+    for node_id in reference.nodes:
+        assert ancestors(compact, node_id) == nx.ancestors(reference, node_id)
+    assert topological_sort(compact) == list(nx.topological_sort(reference))
+    assert is_directed_acyclic_graph(compact)
+
+
+def test_topological_sort_detects_cycle():
+    compact, _ = build_graphs(3, [(0, 1), (1, 2), (2, 0)])
+    assert not is_directed_acyclic_graph(compact)
+    with pytest.raises(nx.NetworkXUnfeasible):
+        topological_sort(compact)
@@ -0,0 +1,115 @@
+"""
+按时间查找位移读取测试：单个分区读取失败或消息缺少时间戳时，返回其它分区和已读取的消息，不中断根因定位主循环。
+"""
+import json
+import time
+
+import pytest
+from kafka.errors import KafkaTimeoutError
+
+from cause_inference.abnormal_event import AbnEvtMgt
+from cause_inference.evt_consumer import EvtConsumeThread, TimeSeekReader
+from cause_inference.inproc_kafka import InprocBroker, InprocConsumer, InprocProducer
+from cause_inference.model import AbnormalEvent
+
+KPI_TOPIC = 'gala_anteater_hybrid_model'
+KPI_GROUP_ID = 'abn-kpi-inference'
+METRIC_TOPIC = 'gala_anteater_metric'
+CONSUMER_TO = 0.05
+VALID_DURATION = 120
+FUTURE_DURATION = 60
+AGING_DURATION = 600
+
+
+def gen_metric_evt(ts, idx):
+    return {
+        'Timestamp': ts,
+        'Attributes': {'entity_id': 'proc_{}'.format(idx), 'event_id': str(idx)},
+        'Resource': {'metric': 'gala_gopher_proc_utime_jiffies', 'labels': {}, 'score': 1.0},
+    }
+
+
+class FlakyConsumer(InprocConsumer):
+    """在指定分区上的指定操作抛出 kafka 超时异常"""
+    def __init__(self, fail_on: dict, **configs):
+        super().__init__(**configs)
+        self.fail_on = fail_on
+        self.polled = 0
+
+    def _check(self, op):
+        partitions = {tp.partition for tp in self.positions}
+        if partitions & self.fail_on.get(op, set()):
+            raise KafkaTimeoutError('{} timed out'.format(op))
+
+    def offsets_for_times(self, timestamps):
+        self._check('offsets_for_times')
+        return super().offsets_for_times(timestamps)
+
+    def end_offsets(self, partitions):
+        self._check('end_offsets')
+        return super().end_offsets(partitions)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        # 第一次拉取成功，之后的拉取超时
+        if self.polled:
+            self._check('poll')
+        self.polled += 1
+        return super().poll(timeout_ms, max_records)
+
+
+@pytest.fixture
+def now_ms():
+    return int(time.time() * 1000)
+
+
+@pytest.fixture
+def broker(now_ms):
+    broker = InprocBroker()
+    broker.create_topic(METRIC_TOPIC, 4)
+    producer = InprocProducer(broker=broker)
+    for partition in range(4):
+        for i in range(2):
+            producer.send(METRIC_TOPIC, json.dumps(gen_metric_evt(now_ms + i, partition * 10 + i)).encode(),
+                          partition=partition, timestamp_ms=now_ms + i)
+    return broker
+
+
+def new_seek_reader(broker, fail_on=None) -> TimeSeekReader:
+    return TimeSeekReader(lambda: FlakyConsumer(fail_on or {}, broker=broker, enable_auto_commit=False),
+                          METRIC_TOPIC, CONSUMER_TO, max_records=1)
+
+
+def read_evt_ids(seek_reader: TimeSeekReader, now_ms) -> list:
+    evts = seek_reader.read_window(now_ms - 1000, now_ms + 1000)
+    return sorted(data.get('Attributes').get('event_id') for data in evts)
+
+
+def test_read_window_skips_failed_partitions(broker, now_ms):
+    seek_reader = new_seek_reader(broker, {'offsets_for_times': {1}, 'end_offsets': {2}, 'poll': {3}})
+
+    # 分区 1 、2 读取失败，分区 3 拉取第二条消息时失败，只返回已读取的第一条
+    assert read_evt_ids(seek_reader, now_ms) == ['0', '1', '30']
+
+
+def test_read_window_skips_messages_without_timestamp(broker, now_ms):
+    producer = InprocProducer(broker=broker)
+    for data in ({'Attributes': {'event_id': 'no_ts'}}, ['not', 'a', 'dict']):
+        producer.send(METRIC_TOPIC, json.dumps(data).encode(), partition=0, timestamp_ms=now_ms + 2)
+    producer.send(METRIC_TOPIC, json.dumps(gen_metric_evt(now_ms + 3, 2)).encode(), partition=0,
+                  timestamp_ms=now_ms + 3)
+
+    assert read_evt_ids(new_seek_reader(broker), now_ms) == ['0', '1', '10', '11', '2', '20', '21', '30', '31']
+
+
+def test_seek_mode_survives_kafka_errors(broker, now_ms):
+    seek_reader = new_seek_reader(broker, {'offsets_for_times': {0, 1, 2, 3}})
+    kpi_consumer = EvtConsumeThread(InprocConsumer(KPI_TOPIC, group_id=KPI_GROUP_ID, broker=broker), KPI_TOPIC,
+                                    CONSUMER_TO, stats_interval=0)
+    abn_evt_mgt = AbnEvtMgt(kpi_consumer, None, VALID_DURATION, FUTURE_DURATION, AGING_DURATION,
+                            metric_seek_reader=seek_reader)
+    abn_evt_mgt.schedule_kpi(AbnormalEvent(now_ms - FUTURE_DURATION * 1000, 'gala_gopher_sli_rtt_nsec',
+                                           event_id='kpi'))
+
+    abn_kpi, metric_evts = abn_evt_mgt.get_abnormal_info()
+    assert abn_kpi.event_id == 'kpi'
+    assert metric_evts == []
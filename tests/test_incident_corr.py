@@ -0,0 +1,50 @@
+"""
+事件级根因定位的相关性计算测试：各异常KPI使用各自的历史数据时间窗口，与预取的时间窗口一致。
+"""
+import pytest
+
+from cause_inference.cause_infer import IncidentCauseLocator
+from cause_inference.infer_policy import get_infer_policy
+from cause_inference.model import AbnormalEvent
+from cause_inference.prefetch import get_hist_end_ts
+
+_TS = 1700000000000
+
+
+class FakeMetricDbMgt:
+    """按时间窗口结束时间返回历史数据，并记录查询的时间窗口"""
+    def __init__(self, data_by_end_ts: dict):
+        self.data_by_end_ts = data_by_end_ts
+        self.queries = []
+
+    def query_metric_hist_data(self, metric_id, metric_labels, end_ts):
+        self.queries.append((metric_id, end_ts))
+        return self.data_by_end_ts.get((metric_id, end_ts))
+
+
+def test_incident_corr_uses_per_kpi_windows():
+    kpi_a = AbnormalEvent(_TS, 'kpi_a', event_id='a')
+    kpi_b = AbnormalEvent(_TS + 30 * 1000, 'kpi_b', event_id='b')
+    kpi_c = AbnormalEvent(_TS + 500, 'kpi_c', event_id='c')
+    end_a, end_b = get_hist_end_ts(kpi_a), get_hist_end_ts(kpi_b)
+    assert end_a != end_b and get_hist_end_ts(kpi_c) == end_a
+    metric_db_mgt = FakeMetricDbMgt({
+        ('kpi_a', end_a): [1, 2, 3, 4],
+        ('kpi_c', end_a): [4, 3, 2, 1],
+        ('kpi_b', end_b): [1, 2, 3, 4],
+        # 指标只在 kpi_a 的时间窗口内与 KPI 相关
+        ('metric', end_a): [2, 4, 6, 8],
+        ('metric', end_b): [1, 3, 1, 3],
+    })
+    locator = IncidentCauseLocator([kpi_a, kpi_b, kpi_c], [], None, metric_db_mgt, get_infer_policy('dfs'), 3)
+
+    end_ts = locator.init_kpi_hist_data()
+    assert end_ts == end_b
+    assert sorted(metric_db_mgt.queries) == sorted([('kpi_a', end_a), ('kpi_b', end_b), ('kpi_c', end_a)])
+
+    metric_db_mgt.queries.clear()
+    hist_data, corr = locator.calc_metric_corr('metric', {}, end_ts)
+    assert corr == pytest.approx(1.0)
+    assert hist_data == [1, 3, 1, 3]
+    # 相同时间窗口只查询一次
+    assert sorted(metric_db_mgt.queries) == sorted([('metric', end_a), ('metric', end_b)])
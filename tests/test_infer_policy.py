@@ -0,0 +1,153 @@
+import random
+
+import pytest
+
+from cause_inference.compact_graph import CompactDiGraph
+from cause_inference.infer_policy import DfsPolicy, DpPolicy, PprPolicy, RandomWalkPolicy
+from cause_inference.model import MetricNodeId
+
+
+def build_graph(node_scores: dict, edges: list) -> CompactDiGraph:
+    graph = CompactDiGraph()
+    for node_id, score in node_scores.items():
+        graph.add_node(node_id, abnormal_score=score, entity_id=node_id.entity_n_id)
+    for from_id, to_id in edges:
+        graph.add_edge(from_id, to_id)
+    return graph
+
+
+NODE_A = MetricNodeId('entity_a', 'metric_a')
+NODE_B = MetricNodeId('entity_b', 'metric_b')
+NODE_C = MetricNodeId('entity_c', 'metric_c')
+NODE_D = MetricNodeId('entity_d', 'metric_d')
+
+
+@pytest.mark.parametrize('mode', ['walk', 'stationary'])
+def test_random_walk_with_zero_score_component(mode):
+    # c -> d 与目标节点不连通，且异常得分均为 0 ，其转移概率行全为 0
+    graph = build_graph({NODE_A: 0.9, NODE_B: 0.5, NODE_C: 0, NODE_D: 0}, [(NODE_B, NODE_A), (NODE_C, NODE_D)])
+
+    causes = RandomWalkPolicy(mode=mode).infer(graph, NODE_A, 3)
+
+    assert [cause.metric_id for cause in causes] == ['metric_b', 'metric_a']
+    assert sum(cause.cause_score for cause in causes) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize('mode', ['walk', 'stationary'])
+def test_random_walk_with_all_zero_scores(mode):
+    graph = build_graph({NODE_A: 0, NODE_B: 0}, [(NODE_B, NODE_A)])
+
+    causes = RandomWalkPolicy(mode=mode).infer(graph, NODE_A, 3)
+
+    # 没有任何转移时游走停留在目标节点
+    assert [cause.metric_id for cause in causes] == ['metric_a']
+
+
+def test_transfer_matrix_rows_are_normalized():
+    graph = build_graph({NODE_A: 0.9, NODE_B: 0.5, NODE_C: 0, NODE_D: 0}, [(NODE_B, NODE_A), (NODE_C, NODE_D)])
+    node_ids = list(graph.nodes)
+    node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+
+    matrix = RandomWalkPolicy().calc_transfer_matrix(graph, node_ids, node_index)
+
+    assert matrix.sum(axis=1).A.ravel() == pytest.approx([1.0] * len(node_ids))
+    assert matrix[node_index.get(NODE_C), node_index.get(NODE_C)] == pytest.approx(1.0)
+
+
+def build_random_dag(rnd: random.Random) -> tuple:
+    node_num = rnd.randint(2, 12)
+    node_ids = []
+    for i in range(node_num):
+        metric_id = 'virtual_metric' if i > 0 and rnd.random() < 0.2 else 'metric_{}'.format(i)
+        node_ids.append(MetricNodeId('entity_{}'.format(i), metric_id))
+    graph = CompactDiGraph()
+    for node_id in node_ids:
+        # 取值容易产生浮点数求和顺序导致的得分近似相等
+        graph.add_node(node_id, corr_score=rnd.choice([0.1, 0.2, 0.3, 0.5, 0.7]),
+                       machine_id='machine_{}'.format(rnd.randint(0, 2)), entity_id=node_id.entity_n_id)
+    for i in range(node_num):
+        for j in range(i + 1, node_num):
+            if rnd.random() < 0.35:
+                graph.add_edge(node_ids[j], node_ids[i])
+    return graph, node_ids[0]
+
+
+def dump_causes(causes) -> list:
+    return [(cause.metric_id, cause.entity_id, cause.cause_score, [node.node_id for node in cause.path])
+            for cause in causes]
+
+
+@pytest.mark.parametrize('top_k', [1, 2, 3, 5])
+def test_dp_policy_matches_dfs_policy(top_k):
+    rnd = random.Random(top_k)
+    for _ in range(500):
+        graph, target_node_id = build_random_dag(rnd)
+
+        expected = DfsPolicy().infer(graph, target_node_id, top_k)
+        actual = DpPolicy().infer(graph, target_node_id, top_k)
+
+        assert dump_causes(actual) == dump_causes(expected)
+
+
+def build_ppr_graph() -> tuple:
+    """
+    b -> a, c -> a, e -> a, d -> b, f -> v -> a ，其中 a 为异常KPI节点，e 的 corr_score 为 0 ，v 为虚拟指标节点
+    """
+    node_ids = {name: MetricNodeId('entity_' + name, 'metric_' + name) for name in 'abcdef'}
+    node_ids['v'] = MetricNodeId('entity_v', 'virtual_metric')
+    scores = {'a': 1.0, 'b': 0.8, 'c': 0.2, 'd': 0.5, 'e': 0.0, 'f': 0.6, 'v': 0.0}
+    graph = CompactDiGraph()
+    for name, node_id in node_ids.items():
+        graph.add_node(node_id, corr_score=scores.get(name), machine_id='machine_' + name,
+                       entity_id=node_id.entity_n_id)
+    for from_name, to_name in [('b', 'a'), ('c', 'a'), ('e', 'a'), ('v', 'a'), ('d', 'b'), ('f', 'v')]:
+        graph.add_edge(node_ids.get(from_name), node_ids.get(to_name))
+    return graph, node_ids
+
+
+def test_ppr_policy_ranking():
+    graph, node_ids = build_ppr_graph()
+
+    causes = PprPolicy().infer(graph, node_ids.get('a'), 0)
+
+    # 从 a 转移到 b 、v 、c 的概率分别为 0.8 、0.6 、0.2 按比例归一化，v 的权重取其前驱 f 的权重，
+    # b 、v 的得分再全部转移到 d 、f ；e 的权重为 0 ，不会被访问到，虚拟节点不作为根因
+    relative = {'b': 0.85 * 0.5, 'd': 0.85 * 0.85 * 0.5, 'f': 0.85 * 0.85 * 0.375, 'c': 0.85 * 0.125}
+    total = 1 + 0.85 * 0.375 + sum(relative.values())
+    assert [cause.metric_id for cause in causes] == ['metric_b', 'metric_d', 'metric_f', 'metric_c']
+    assert [cause.cause_score for cause in causes] == \
+        pytest.approx([relative.get(name) / total for name in 'bdfc'], abs=1e-6)
+
+    assert [cause.metric_id for cause in PprPolicy().infer(graph, node_ids.get('a'), 2)] == ['metric_b', 'metric_d']
+
+
+def test_ppr_policy_cause_paths_reach_kpi():
+    graph, node_ids = build_ppr_graph()
+
+    causes = PprPolicy().infer(graph, node_ids.get('a'), 0)
+
+    paths = {cause.metric_id: [node.node_id for node in cause.path] for cause in causes}
+    assert paths == {
+        'metric_b': [node_ids.get('b'), node_ids.get('a')],
+        'metric_d': [node_ids.get('d'), node_ids.get('b'), node_ids.get('a')],
+        'metric_f': [node_ids.get('f'), node_ids.get('v'), node_ids.get('a')],
+        'metric_c': [node_ids.get('c'), node_ids.get('a')],
+    }
+
+
+def test_ppr_transfer_matrix_with_zero_weight_and_virtual_preds():
+    graph, node_ids = build_ppr_graph()
+    # v 的前驱只有权重为 0 的节点时，v 的权重也为 0
+    graph.nodes[node_ids.get('f')]['corr_score'] = 0.0
+    nodes = list(graph.nodes)
+    node_index = {node_id: i for i, node_id in enumerate(nodes)}
+
+    matrix = PprPolicy().calc_transfer_matrix(graph, nodes, node_index).toarray()
+
+    col_a = matrix[:, node_index.get(node_ids.get('a'))]
+    assert col_a[node_index.get(node_ids.get('b'))] == pytest.approx(0.8)
+    assert col_a[node_index.get(node_ids.get('c'))] == pytest.approx(0.2)
+    assert col_a[node_index.get(node_ids.get('e'))] == 0
+    assert col_a[node_index.get(node_ids.get('v'))] == 0
+    # 前驱权重全为 0 的列全为 0 ，游走到该节点后全部重启
+    assert not matrix[:, node_index.get(node_ids.get('v'))].any()
@@ -0,0 +1,197 @@
+"""
+分区部署测试：在同一个进程内的 kafka 替身上运行两个根因定位实例的事件消费部分。
+"""
+import json
+import time
+
+import pytest
+
+from cause_inference.abnormal_event import AbnEvtMgt
+from cause_inference.evt_consumer import EvtConsumeThread, OffsetRestoreListener, TimeSeekReader
+from cause_inference.exceptions import ConfigException
+from cause_inference.inproc_kafka import InprocBroker, InprocConsumer, InprocProducer
+from cause_inference.partition import MachinePartition
+
+KPI_TOPIC = 'gala_anteater_hybrid_model'
+METRIC_TOPIC = 'gala_anteater_metric'
+KPI_GROUP_ID = 'abn-kpi-inference'
+METRIC_GROUP_ID = 'abn-metric-inference'
+CONSUMER_TO = 0.05
+VALID_DURATION = 120
+FUTURE_DURATION = 60
+AGING_DURATION = 600
+
+MACHINES = ['machine-{}'.format(i) for i in range(12)]
+
+
+def gen_metric_evt(ts, machine_id=None):
+    labels = {'machine_id': machine_id} if machine_id else {}
+    return {
+        'Timestamp': ts,
+        'Attributes': {'entity_id': 'proc_{}'.format(machine_id), 'event_id': '{}_{}'.format(ts, machine_id)},
+        'Resource': {'metric': 'gala_gopher_proc_utime_jiffies', 'labels': labels, 'score': 1.0},
+    }
+
+
+def publish(producer: InprocProducer, topic, data, **kwargs):
+    producer.send(topic, json.dumps(data).encode(), timestamp_ms=data.get('Timestamp'), **kwargs)
+
+
+def new_consume_thread(broker, topic, group_id) -> EvtConsumeThread:
+    consumer = InprocConsumer(topic, group_id=group_id, broker=broker)
+    return EvtConsumeThread(consumer, topic, CONSUMER_TO, stats_interval=0)
+
+
+def drain(consume_thread: EvtConsumeThread):
+    """拉取直到没有新消息"""
+    while True:
+        consumed = consume_thread.stats.consumed
+        consume_thread.poll_once()
+        if consume_thread.stats.consumed == consumed:
+            return
+
+
+class Instance:
+    """一个分区部署实例的事件消费部分"""
+    def __init__(self, broker, partition: MachinePartition):
+        self.partition = partition
+        self.group_id = partition.get_group_id(METRIC_GROUP_ID)
+        self.metric_consumer = new_consume_thread(broker, METRIC_TOPIC, self.group_id)
+        seek_reader = TimeSeekReader(lambda: InprocConsumer(broker=broker, enable_auto_commit=False), METRIC_TOPIC,
+                                     CONSUMER_TO)
+        self.abn_evt_mgt = AbnEvtMgt(None, self.metric_consumer, VALID_DURATION, FUTURE_DURATION, AGING_DURATION,
+                                     partition=partition, foreign_seek_reader=seek_reader)
+
+    def consume(self):
+        drain(self.metric_consumer)
+        self.abn_evt_mgt.consume_metric_evts()
+
+    def stored_machines(self) -> list:
+        return sorted(evt.metric_labels.get('machine_id', '') for evt in self.abn_evt_mgt.evt_store.get_all())
+
+
+@pytest.fixture
+def broker():
+    broker = InprocBroker()
+    broker.create_topic(KPI_TOPIC, 4)
+    broker.create_topic(METRIC_TOPIC, 3)
+    return broker
+
+
+@pytest.fixture
+def now_ms():
+    return int(time.time() * 1000)
+
+
+@pytest.mark.parametrize('count, index', [(2, 2), (2, -1), (0, 0), ('2', 0), (2, None)])
+def test_invalid_partition_config(count, index):
+    with pytest.raises(ConfigException):
+        MachinePartition(count, index)
+
+
+def test_machine_ownership_is_disjoint_and_complete():
+    partitions = [MachinePartition(3, i) for i in range(3)]
+    for machine_id in MACHINES:
+        assert sum(partition.owns(machine_id) for partition in partitions) == 1
+    # 没有 machine_id 时所有实例都缓存
+    assert all(partition.owns('') for partition in partitions)
+    assert MachinePartition().owns(MACHINES[0])
+
+
+def test_metric_group_id_per_instance():
+    assert MachinePartition().get_group_id(METRIC_GROUP_ID) == METRIC_GROUP_ID
+    assert [MachinePartition(2, i).get_group_id(METRIC_GROUP_ID) for i in range(2)] == \
+        ['abn-metric-inference-0', 'abn-metric-inference-1']
+
+
+def test_instances_only_store_owned_hosts(broker, now_ms):
+    producer = InprocProducer(broker=broker)
+    for i, machine_id in enumerate(MACHINES):
+        publish(producer, METRIC_TOPIC, gen_metric_evt(now_ms + i, machine_id))
+    publish(producer, METRIC_TOPIC, gen_metric_evt(now_ms, None))
+
+    instances = [Instance(broker, MachinePartition(2, i)) for i in range(2)]
+    for instance in instances:
+        instance.consume()
+        # 独立的消费者组，每个实例都收到全部事件
+        assert instance.metric_consumer.stats.consumed == len(MACHINES) + 1
+
+    stored = [instance.stored_machines() for instance in instances]
+    for instance, machines in zip(instances, stored):
+        assert '' in machines
+        assert all(instance.partition.owns(machine_id) for machine_id in machines)
+    owned = [set(machines) - {''} for machines in stored]
+    assert owned[0].isdisjoint(owned[1])
+    assert owned[0] | owned[1] == set(MACHINES)
+
+
+def test_foreign_evt_loader_reads_other_hosts_by_time(broker, now_ms):
+    producer = InprocProducer(broker=broker)
+    # 超出有效时间窗口的旧事件不应被读取
+    publish(producer, METRIC_TOPIC, gen_metric_evt(now_ms - (VALID_DURATION + 10) * 1000, MACHINES[0]))
+    for i, machine_id in enumerate(MACHINES):
+        publish(producer, METRIC_TOPIC, gen_metric_evt(now_ms + i, machine_id))
+
+    instance = Instance(broker, MachinePartition(2, 0))
+    instance.consume()
+    loader = instance.abn_evt_mgt.get_foreign_evt_loader(now_ms, now_ms)
+    foreign = sorted(evt.metric_labels.get('machine_id') for evt in loader.load())
+
+    assert foreign == sorted(m for m in MACHINES if not instance.partition.owns(m))
+    assert set(foreign).isdisjoint(instance.stored_machines())
+    assert sorted(set(foreign) | set(instance.stored_machines())) == sorted(MACHINES)
+    assert all(loader.need_load(machine_id) for machine_id in foreign)
+
+
+def test_no_foreign_evt_loader_without_partition(broker, now_ms):
+    instance = Instance(broker, MachinePartition())
+    assert instance.abn_evt_mgt.get_foreign_evt_loader(now_ms, now_ms) is None
+
+
+def test_kpi_group_rebalance_shares_partitions(broker, now_ms):
+    producer = InprocProducer(broker=broker)
+    for i in range(8):
+        publish(producer, KPI_TOPIC, {'Timestamp': now_ms + i, 'i': i}, partition=i % 4)
+
+    first = new_consume_thread(broker, KPI_TOPIC, KPI_GROUP_ID)
+    second = new_consume_thread(broker, KPI_TOPIC, KPI_GROUP_ID)
+    drain(first)
+    drain(second)
+
+    first_parts = set(first.stats.partition_lag)
+    second_parts = set(second.stats.partition_lag)
+    assert first_parts and second_parts and first_parts.isdisjoint(second_parts)
+    assert first.stats.consumed + second.stats.consumed == 8
+
+    # 一个实例退出后，剩余实例接管其分区，从消费者组提交的位移继续消费
+    second.consumer.close()
+    publish(producer, KPI_TOPIC, {'Timestamp': now_ms + 8, 'i': 8}, partition=min(second_parts))
+    drain(first)
+    assert first.stats.consumed + second.stats.consumed == 9
+
+
+def test_offset_restore_listener_after_rebalance(broker, now_ms):
+    producer = InprocProducer(broker=broker)
+    for i in range(8):
+        publish(producer, KPI_TOPIC, {'Timestamp': now_ms + i, 'i': i}, partition=i % 4)
+
+    # 快照中记录了分区 0 已处理到位移 1 ，分区 1 已全部处理
+    consumer = InprocConsumer(group_id='restored', broker=broker)
+    consumer.subscribe([KPI_TOPIC], listener=OffsetRestoreListener(consumer, {0: 1, 1: 2}))
+    consume_thread = EvtConsumeThread(consumer, KPI_TOPIC, CONSUMER_TO, stats_interval=0)
+    drain(consume_thread)
+
+    received = []
+    data = consume_thread.wait(0)
+    while data is not None:
+        received.append(data.get('i'))
+        consume_thread.ack()
+        data = consume_thread.wait(0)
+    assert sorted(received) == [2, 3, 4, 6, 7]
+    assert consume_thread.get_delivered_offsets() == {0: 2, 2: 2, 3: 2}
+
+    # 其它实例加入触发重新分配时，保留的分区不会再次恢复到快照中的位移
+    InprocConsumer(KPI_TOPIC, group_id='restored', broker=broker)
+    consume_thread.poll_once()
+    assert consumer.positions
+    assert all(position == 2 for position in consumer.positions.values())
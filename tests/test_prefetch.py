@@ -0,0 +1,152 @@
+"""
+历史数据预取测试：根因定位优先使用预取的结果并只补充尾部数据，结果与一次查询整个时间窗口相同；按指标数上限和老化时间淘汰。
+"""
+import time
+
+import pytest
+
+from spider.collector import DataRecord
+from spider.collector.data_collector import Label
+
+from cause_inference.db_mgt import PromMgt
+from cause_inference.model import AbnormalEvent
+from cause_inference.prefetch import HistPrefetcher, get_hist_end_ts
+
+SAMPLE_DURATION = 600
+SAMPLE_STEP = 5
+SAFE_LAG = 15
+
+
+class FakeObsvMetaMgt:
+    def get_entity_keys_of_metric(self, metric_id, metric_labels):
+        return {'machine_id': metric_labels.get('machine_id')}
+
+
+class FakeCollector:
+    """每个采样时间点都有数据，取值为时间戳，并记录查询的时间范围"""
+    def __init__(self):
+        self.queries = []
+
+    def get_range_data(self, metric_id, start, end, query_options=None, step=None):
+        self.queries.append((metric_id, start, end))
+        return [DataRecord(metric_id, ts, ts, [Label('machine_id', query_options.get('machine_id'))])
+                for ts in range(int(start), int(end) + 1, step)]
+
+
+def new_prom_mgt() -> PromMgt:
+    return PromMgt(FakeCollector(), SAMPLE_DURATION, SAMPLE_STEP, FakeObsvMetaMgt())
+
+
+def new_prefetcher(prom_mgt: PromMgt, **kwargs) -> HistPrefetcher:
+    # 单个工作线程按提交顺序执行，便于等待已提交的查询完成
+    prefetcher = HistPrefetcher(prom_mgt, workers=1, safe_lag=SAFE_LAG, **kwargs)
+    prom_mgt.hist_prefetcher = prefetcher
+    return prefetcher
+
+
+def wait_prefetched(prefetcher: HistPrefetcher):
+    prefetcher.executor.submit(lambda: None).result()
+
+
+def new_kpi(ts_sec) -> AbnormalEvent:
+    return AbnormalEvent(ts_sec * 1000, 'kpi', metric_labels={'machine_id': 'm1'}, abnormal_entity_id='proc_1',
+                         event_id='kpi')
+
+
+def new_metric_evt(metric_id, machine_id, entity_id='proc_1', event_id='') -> AbnormalEvent:
+    return AbnormalEvent(0, metric_id, metric_labels={'machine_id': machine_id}, abnormal_entity_id=entity_id,
+                         event_id=event_id)
+
+
+@pytest.fixture
+def now_sec():
+    return (int(time.time()) // SAMPLE_STEP) * SAMPLE_STEP
+
+
+def test_prefetch_hit_tops_up_tail(now_sec):
+    prom_mgt = new_prom_mgt()
+    prefetcher = new_prefetcher(prom_mgt)
+    abn_kpi = new_kpi(now_sec)
+    end_ts = get_hist_end_ts(abn_kpi)
+    start_ts = end_ts - SAMPLE_DURATION
+
+    prefetcher.prefetch(abn_kpi, [])
+    wait_prefetched(prefetcher)
+    head_queries = list(prom_mgt.collector.queries)
+    assert len(head_queries) == 1
+    _, head_start, head_until = head_queries[0]
+    assert head_start == start_ts
+    assert head_until <= now_sec - SAFE_LAG and (head_until - start_ts) % SAMPLE_STEP == 0
+
+    hist_data = prom_mgt.query_metric_hist_data('kpi', abn_kpi.metric_labels, end_ts)
+
+    # 命中预取结果，只补充查询尾部数据
+    assert prom_mgt.collector.queries[1:] == [('kpi', head_until + SAMPLE_STEP, end_ts)]
+    assert prefetcher.stats() == {'entries': 1, 'hits': 1, 'misses': 0}
+    prom_mgt.hist_prefetcher = None
+    assert hist_data == prom_mgt.query_metric_hist_data('kpi', abn_kpi.metric_labels, end_ts)
+
+
+def test_top_up_fetches_tail_before_locating(now_sec):
+    prom_mgt = new_prom_mgt()
+    prefetcher = new_prefetcher(prom_mgt)
+    abn_kpi = new_kpi(now_sec)
+    end_ts = get_hist_end_ts(abn_kpi)
+
+    prefetcher.prefetch(abn_kpi, [])
+    prefetcher.top_up(abn_kpi, [])
+    wait_prefetched(prefetcher)
+    query_num = len(prom_mgt.collector.queries)
+    assert prom_mgt.collector.queries[-1][2] == end_ts
+
+    records = prefetcher.get_records('kpi', {'machine_id': 'm1'}, end_ts)
+
+    # 窗口内的数据都已查询，不再发起查询
+    assert len(prom_mgt.collector.queries) == query_num
+    assert [record.timestamp for record in records] == \
+        list(range(end_ts - SAMPLE_DURATION, end_ts + 1, SAMPLE_STEP))
+
+
+def test_missed_metric_queried_directly(now_sec):
+    prom_mgt = new_prom_mgt()
+    prefetcher = new_prefetcher(prom_mgt)
+    end_ts = get_hist_end_ts(new_kpi(now_sec))
+
+    assert prefetcher.get_records('other', {'machine_id': 'm1'}, end_ts) is None
+    prom_mgt.query_metric_hist_data('other', {'machine_id': 'm1'}, end_ts)
+
+    assert prom_mgt.collector.queries == [('other', end_ts - SAMPLE_DURATION, end_ts)]
+    assert prefetcher.stats() == {'entries': 0, 'hits': 0, 'misses': 2}
+
+
+def test_select_metrics_limited_to_related_machines():
+    prefetcher = new_prefetcher(new_prom_mgt(), max_metrics=3)
+    metric_evts = [
+        new_metric_evt('metric_a', 'm1'),
+        new_metric_evt('metric_a', 'm1'),
+        new_metric_evt('metric_b', 'm3'),
+        # 推荐指标所在的主机 m2 也可能相关
+        new_metric_evt('metric_c', 'm2', event_id='kpi'),
+        new_metric_evt('metric_d', 'm1'),
+    ]
+
+    metrics = prefetcher.select_metrics(new_kpi(0), metric_evts)
+
+    # 重复的指标和无关主机上的指标不预取，包括 KPI 在内最多 max_metrics 个指标
+    assert [metric_id for metric_id, _ in metrics] == ['kpi', 'metric_a', 'metric_c']
+
+
+def test_entries_evicted_by_aging_and_max_entries(now_sec):
+    prom_mgt = new_prom_mgt()
+    prefetcher = new_prefetcher(prom_mgt, aging_duration=600, max_entries=2)
+    for i in range(3):
+        prefetcher.get_or_create_entry('metric_{}'.format(i), {'machine_id': 'm1'}, now_sec + i)
+
+    # 超过 max_entries 时淘汰最早的
+    assert prefetcher.get_records('metric_0', {'machine_id': 'm1'}, now_sec) is None
+    assert prefetcher.stats().get('entries') == 2
+
+    prefetcher.clear_aging_entries(now_sec + 1 + 600 + 1)
+    assert prefetcher.stats().get('entries') == 1
+    prefetcher.clear_aging_entries(now_sec + 2 + 600 + 1)
+    assert prefetcher.stats().get('entries') == 0
@@ -0,0 +1,126 @@
+"""
+异常指标预筛选测试：批量汇总查询按序号标签解析结果，一批查询没有结果时汇总值为 nan ，跳过的指标按原因计数。
+"""
+import math
+import re
+
+import pytest
+
+from spider.collector import DataRecord
+from spider.collector.data_collector import Label
+from spider.exceptions import MetadataException
+
+from cause_inference import cause_infer
+from cause_inference.causal_graph import CausalGraph
+from cause_inference.cause_infer import CauseLocator, PrescreenStats
+from cause_inference.config import infer_config
+from cause_inference.db_mgt import SUMMARY_QUERY_LABEL, PromMgt
+from cause_inference.infer_policy import get_infer_policy
+from cause_inference.model import AbnormalEvent
+
+_TS = 1700000000
+SAMPLE_DURATION = 600
+SAMPLE_STEP = 5
+
+
+class FakeObsvMetaMgt:
+    def get_entity_keys_of_metric(self, metric_id, metric_labels):
+        if metric_id == 'unknown_metric':
+            raise MetadataException('No metadata of metric {}'.format(metric_id))
+        return {'machine_id': metric_labels.get('machine_id')}
+
+
+class FakeCollector:
+    """按查询中各指标的序号标签返回汇总值，series_values 中没有的指标没有数据"""
+    def __init__(self, series_values: dict):
+        self.series_values = series_values
+        self.queries = []
+
+    def get_instant_data(self, query, timestamp=None, **kwargs):
+        self.queries.append(query)
+        records = []
+        pattern = r'label_replace\(stddev_over_time\((\w+)\{.*?"' + SUMMARY_QUERY_LABEL + r'", "(\d+)"'
+        for metric_id, idx in re.findall(pattern, query):
+            for value in self.series_values.get(metric_id, []):
+                records.append(DataRecord(metric_id, timestamp, value, [Label(SUMMARY_QUERY_LABEL, idx)]))
+        if records:
+            # 没有序号标签的结果被忽略
+            records.append(DataRecord('other', timestamp, 100.0, []))
+        return records
+
+
+def new_prom_mgt(series_values: dict) -> PromMgt:
+    return PromMgt(FakeCollector(series_values), SAMPLE_DURATION, SAMPLE_STEP, FakeObsvMetaMgt())
+
+
+def test_query_metric_summaries():
+    prom_mgt = new_prom_mgt({'flat_metric': [0.0], 'var_metric': [1.5], 'multi_metric': [0.5, 2.0]})
+    labels = {'machine_id': 'm1'}
+    metrics = [(metric_id, labels) for metric_id in
+               ['flat_metric', 'var_metric', 'unknown_metric', 'missing_metric', 'multi_metric', 'gone_metric']]
+
+    summaries = prom_mgt.query_metric_summaries(metrics, _TS, batch_size=2)
+
+    # 没有元数据的指标不查询，分为 [0, 1] 、[3, 4] 、[5] 三批；最后一批没有任何结果
+    assert len(prom_mgt.collector.queries) == 3
+    assert summaries[:5] == [0.0, 1.5, None, None, 2.0]
+    assert math.isnan(summaries[5])
+
+
+def test_summary_expr_uses_raw_samples_by_default():
+    prom_mgt = new_prom_mgt({})
+
+    expr = prom_mgt.gen_summary_expr(3, 'metric{}')
+
+    assert expr == ('label_replace(stddev_over_time(metric{}[600s]) + (count_over_time(metric{}[600s]) < bool 120), '
+                    '"infer_query_idx", "3", "", "")')
+    assert 'stddev_over_time(metric{}[600s:60s])' in prom_mgt.gen_summary_expr(3, 'metric{}', 60)
+    assert '< bool 10)' in prom_mgt.gen_summary_expr(3, 'metric{}', 60)
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = PrescreenStats()
+    monkeypatch.setattr(cause_infer, 'prescreen_stats', stats)
+    monkeypatch.setitem(infer_config.infer_conf, 'prescreen_metrics', True)
+    monkeypatch.setitem(infer_config.infer_conf, 'prescreen_min_abnormal_score', 0.3)
+    monkeypatch.setitem(infer_config.infer_conf, 'prescreen_batch_size', 3)
+    return stats
+
+
+def build_causal_graph() -> CausalGraph:
+    causal_graph = CausalGraph()
+    causal_graph.entity_cause_graph.add_node('proc_1', entity_id='proc_1', raw_data={'machine_id': 'm1'},
+                                             abnormal_metrics={
+                                                 'low_score_metric': {'abnormal_score': 0.1},
+                                                 'flat_metric': {'abnormal_score': 0.5},
+                                                 'var_metric': {'abnormal_score': -0.5},
+                                                 'missing_metric': {'abnormal_score': 0.5},
+                                             })
+    causal_graph.entity_cause_graph.add_node('proc_2', entity_id='proc_2', raw_data={'machine_id': 'm2'},
+                                             abnormal_metrics={'gone_metric': {'abnormal_score': 0.5}})
+    # 没有标签的实体不预筛选
+    causal_graph.entity_cause_graph.add_node('proc_3', entity_id='proc_3',
+                                             abnormal_metrics={'flat_metric': {'abnormal_score': 0.5}})
+    return causal_graph
+
+
+def test_prescreen_metrics(stats):
+    prom_mgt = new_prom_mgt({'flat_metric': [0.0], 'var_metric': [0.8]})
+    locator = CauseLocator(AbnormalEvent(_TS * 1000, 'kpi', event_id='kpi'), [], None, prom_mgt,
+                           get_infer_policy('dfs'), 3)
+
+    skipped = locator.prescreen_metrics(build_causal_graph(), _TS)
+
+    # gone_metric 单独一批且没有结果，汇总值为 nan ，不跳过
+    assert skipped == {('proc_1', 'low_score_metric'), ('proc_1', 'flat_metric'), ('proc_1', 'missing_metric')}
+    assert (stats.screened, stats.skipped_low_score, stats.skipped_missing, stats.skipped_flat) == (5, 1, 1, 1)
+
+
+def test_prescreen_disabled_for_other_metric_db(stats, monkeypatch):
+    monkeypatch.setitem(infer_config.infer_conf, 'prescreen_metrics', False)
+    locator = CauseLocator(AbnormalEvent(_TS * 1000, 'kpi', event_id='kpi'), [], None, new_prom_mgt({}),
+                           get_infer_policy('dfs'), 3)
+
+    assert locator.prescreen_metrics(build_causal_graph(), _TS) == set()
+    assert stats.screened == 0
@@ -0,0 +1,40 @@
+"""
+根因定位结果缓存测试：缓存键保存有效异常指标集合本身，命中数和未命中数计入统计信息。
+"""
+from cause_inference.model import AbnormalEvent
+from cause_inference.result_cache import InferResultCache
+
+_TS = 1700000000
+
+
+def gen_evt(entity_id, metric_id) -> AbnormalEvent:
+    return AbnormalEvent(_TS * 1000, metric_id, abnormal_entity_id=entity_id)
+
+
+class ColliderStr(str):
+    """哈希值相同但不相等的字符串，用于模拟有效异常指标集合的哈希冲突"""
+    def __hash__(self):
+        return 0
+
+
+def test_cache_key_contains_metric_set():
+    abn_kpi = gen_evt('proc_1', 'gala_gopher_sli_rtt_nsec')
+    metrics = [gen_evt('proc_1', 'gala_gopher_proc_utime_jiffies'), gen_evt('disk_1', 'gala_gopher_disk_r_await')]
+
+    key = InferResultCache.gen_key(abn_kpi, metrics, _TS)
+    assert key[-1] == frozenset({('proc_1', 'gala_gopher_proc_utime_jiffies'), ('disk_1', 'gala_gopher_disk_r_await')})
+    # 与事件顺序无关
+    assert InferResultCache.gen_key(abn_kpi, list(reversed(metrics)), _TS) == key
+
+
+def test_hash_collision_is_a_miss():
+    cache = InferResultCache(ttl=60, report_interval=0)
+    abn_kpi = gen_evt('proc_1', 'gala_gopher_sli_rtt_nsec')
+    key_a = InferResultCache.gen_key(abn_kpi, [gen_evt(ColliderStr('proc_1'), 'metric_a')], _TS)
+    key_b = InferResultCache.gen_key(abn_kpi, [gen_evt(ColliderStr('proc_2'), 'metric_a')], _TS)
+    assert hash(key_a) == hash(key_b) and key_a != key_b
+
+    cache.put(key_a, {'cause_metrics': ['a']})
+    assert cache.get(key_b) is None
+    assert cache.get(key_a) == {'cause_metrics': ['a']}
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1}
@@ -0,0 +1,243 @@
+"""
+推理规则测试：基于拓扑索引的规则解析与逐个遍历观测实例和关系的原始实现输出相同的因果关系；
+缓存的指标因果关系模板与输入顺序无关，返回的分组是副本。
+"""
+import random
+from itertools import permutations
+
+import pytest
+
+from spider.conf.observe_meta import EntityType, RelationType
+
+from cause_inference.cause_infer import ClusterCauseLocator
+from cause_inference.model import AnomalyTrend, HostTopo, MetricCategoryDetail, TopoEdge, TopoNode
+from cause_inference.model import VirtualMetricCategory, virtual_metric_id_map
+from cause_inference.rule_parser import METRIC_CATEGORY_ALL, METRIC_CATEGORY_OTHER, PROC_COMM_LABEL, QEMU_PROC_NAME
+from cause_inference.rule_parser import MetricCategoryPair, RuleMeta, rule_engine
+
+_TS = 1700000000
+HOST_RULE_TYPES = [
+    (EntityType.PROCESS.value, EntityType.DISK.value),
+    (EntityType.BLOCK.value, EntityType.PROCESS.value),
+    (EntityType.CPU.value, EntityType.PROCESS.value),
+    (EntityType.NETCARD.value, EntityType.TCP_LINK.value),
+]
+
+
+def baseline_rule_parsing(topo_nodes: dict, topo_edges: dict) -> list:
+    """原始实现：按 BelongsToRule 、RunsOnRule 、SliRule 、HostRule 的顺序逐个遍历关系和同一主机上的实例对"""
+    belongs_to, runs_on, tcp_bt_p, sli_bt_p = [], [], [], []
+    for edge in topo_edges.values():
+        f_node, t_node = topo_nodes.get(edge.from_id), topo_nodes.get(edge.to_id)
+        if not f_node or not t_node:
+            continue
+        types = (f_node.entity_type, t_node.entity_type)
+        if edge.type == RelationType.RUNS_ON.value:
+            runs_on.append((t_node.id, f_node.id))
+        if edge.type != RelationType.BELONGS_TO.value:
+            continue
+        if types in [(EntityType.SLI.value, EntityType.PROCESS.value), (EntityType.BLOCK.value, EntityType.DISK.value)]:
+            belongs_to.append((t_node.id, f_node.id))
+        if types == (EntityType.TCP_LINK.value, EntityType.PROCESS.value):
+            tcp_bt_p.append(edge)
+        elif types == (EntityType.SLI.value, EntityType.PROCESS.value):
+            sli_bt_p.append(edge)
+    sli = [(edge1.from_id, edge2.from_id) for edge1 in tcp_bt_p for edge2 in sli_bt_p if edge1.to_id == edge2.to_id]
+
+    host_nodes_map = {}
+    for node in topo_nodes.values():
+        host_nodes_map.setdefault(node.machine_id, []).append(node)
+    host = [(f_node.id, t_node.id) for host_nodes in host_nodes_map.values()
+            for f_node, t_node in permutations(host_nodes, 2)
+            if (f_node.entity_type, t_node.entity_type) in HOST_RULE_TYPES]
+    return belongs_to + runs_on + sli + host
+
+
+def baseline_cross_rule_parsing(topo_nodes: dict, topo_edges: dict) -> list:
+    """原始实现：按关系的顺序逐个解析跨主机的 runs_on 和 store_in 关系"""
+    node_m_t_map = {}
+    for node in topo_nodes.values():
+        node_m_t_map.setdefault((node.machine_id, node.entity_type), []).append(node)
+
+    def get_nodes(machine_id, entity_type):
+        return node_m_t_map.get((machine_id, entity_type), [])
+
+    causal_relations = []
+    for edge in topo_edges.values():
+        f_node, t_node = topo_nodes.get(edge.from_id), topo_nodes.get(edge.to_id)
+        if not f_node or not t_node or f_node.machine_id == t_node.machine_id:
+            continue
+        types = (f_node.entity_type, t_node.entity_type)
+        if edge.type == RelationType.RUNS_ON.value and types == (EntityType.HOST.value, EntityType.PROCESS.value):
+            causal_relations.extend((node.id, t_node.id) for node in get_nodes(f_node.machine_id, EntityType.DISK.value))
+            causal_relations.extend((t_node.id, node.id) for node in get_nodes(f_node.machine_id, EntityType.BLOCK.value))
+        if edge.type == RelationType.STORE_IN.value and types == (EntityType.HOST.value, EntityType.HOST.value):
+            for proc_node in get_nodes(f_node.machine_id, EntityType.PROCESS.value):
+                if proc_node.raw_data.get(PROC_COMM_LABEL) != QEMU_PROC_NAME:
+                    continue
+                causal_relations.extend((proc_node.id, node.id)
+                                        for node in get_nodes(t_node.machine_id, EntityType.DISK.value))
+                causal_relations.extend((node.id, proc_node.id)
+                                        for node in get_nodes(t_node.machine_id, EntityType.BLOCK.value))
+    return causal_relations
+
+
+def build_host_topo(rnd: random.Random, machine_id) -> HostTopo:
+    def new_node(entity_type, idx, raw_data=None):
+        node_id = '{}_{}_{}'.format(machine_id, entity_type, idx)
+        return TopoNode(node_id, node_id, entity_type, machine_id, _TS, raw_data)
+
+    nodes = [new_node(EntityType.HOST.value, 0)]
+    for entity_type in [EntityType.PROCESS.value, EntityType.TCP_LINK.value, EntityType.SLI.value,
+                        EntityType.DISK.value, EntityType.BLOCK.value, EntityType.CPU.value,
+                        EntityType.NETCARD.value, EntityType.CONTAINER.value]:
+        for idx in range(rnd.randint(0, 3)):
+            raw_data = {PROC_COMM_LABEL: rnd.choice([QEMU_PROC_NAME, 'nginx'])} \
+                if entity_type == EntityType.PROCESS.value else None
+            nodes.append(new_node(entity_type, idx, raw_data))
+    rnd.shuffle(nodes)
+
+    edges = []
+    node_list = list(nodes)
+    for _ in range(rnd.randint(0, 30)):
+        f_node, t_node = rnd.choice(node_list), rnd.choice(node_list)
+        edge_type = rnd.choice([RelationType.BELONGS_TO.value, RelationType.RUNS_ON.value,
+                                RelationType.IS_PEER.value])
+        to_id = t_node.id if rnd.random() < 0.9 else 'missing_node'
+        edges.append(TopoEdge('{}_{}_{}'.format(f_node.id, edge_type, to_id), edge_type, f_node.id, to_id))
+    return HostTopo(machine_id, {node.id: node for node in nodes}, {edge.id: edge for edge in edges})
+
+
+def build_cross_edges(rnd: random.Random, host_topos: list) -> list:
+    cross_edges = []
+    for _ in range(6):
+        f_topo, t_topo = rnd.sample(host_topos, 2)
+        f_node, t_node = rnd.choice(list(f_topo.nodes.values())), rnd.choice(list(t_topo.nodes.values()))
+        edge_type = rnd.choice([RelationType.RUNS_ON.value, RelationType.STORE_IN.value])
+        if rnd.random() < 0.5:
+            # 构造能匹配规则的关系
+            f_node = next(node for node in f_topo.nodes.values() if node.entity_type == EntityType.HOST.value)
+            t_node = next((node for node in t_topo.nodes.values() if node.entity_type == (
+                EntityType.PROCESS.value if edge_type == RelationType.RUNS_ON.value else EntityType.HOST.value)),
+                t_node)
+        cross_edges.append(TopoEdge('cross_{}_{}'.format(f_node.id, t_node.id), edge_type, f_node.id, t_node.id,
+                                    f_node, t_node))
+    return cross_edges
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_host_rules_match_baseline(seed):
+    rnd = random.Random(seed)
+    host_topos = [build_host_topo(rnd, 'machine_{}'.format(i)) for i in range(3)]
+
+    for host_topo in host_topos:
+        assert rule_engine.rule_parsing_by_index(host_topo.get_topo_index()) == \
+            baseline_rule_parsing(host_topo.nodes, host_topo.edges)
+
+    # 多个主机的拓扑一起解析时，HostRule 只关联同一主机上的实例
+    all_nodes = {node_id: node for host_topo in host_topos for node_id, node in host_topo.nodes.items()}
+    all_edges = {edge_id: edge for host_topo in host_topos for edge_id, edge in host_topo.edges.items()}
+    assert rule_engine.rule_parsing(all_nodes, all_edges) == baseline_rule_parsing(all_nodes, all_edges)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_cross_host_rules_match_baseline(seed):
+    rnd = random.Random(seed)
+    host_topos = [build_host_topo(rnd, 'machine_{}'.format(i)) for i in range(3)]
+    topo_by_machine = {host_topo.machine_id: host_topo for host_topo in host_topos}
+
+    for cross_edge in build_cross_edges(rnd, host_topos):
+        for affected_machine_id, neigh_machine_id in [(cross_edge.from_node.machine_id, cross_edge.to_node.machine_id),
+                                                      (cross_edge.to_node.machine_id, cross_edge.from_node.machine_id)]:
+            affected_topo, neigh_topo = topo_by_machine.get(affected_machine_id), topo_by_machine.get(neigh_machine_id)
+            topo_nodes = dict(affected_topo.nodes)
+            topo_nodes.update(neigh_topo.nodes)
+            expected = [relation for relation in baseline_cross_rule_parsing(topo_nodes, {cross_edge.id: cross_edge})
+                        if relation[1] in affected_topo.nodes]
+
+            assert ClusterCauseLocator.gen_cross_causal_relations(affected_topo, neigh_topo, cross_edge) == expected
+
+
+FROM_CATEGORIES = {
+    'PROC_CPU': MetricCategoryDetail('PROC_CPU', ['cpu_util', 'cpu_wait'], AnomalyTrend.RISE),
+    'PROC_IO': MetricCategoryDetail('PROC_IO', ['io_wait', 'cpu_wait'], AnomalyTrend.DEFAULT),
+}
+TO_CATEGORIES = {
+    'DISK_IO': MetricCategoryDetail('DISK_IO', ['disk_r_await', 'disk_w_await'], AnomalyTrend.RISE),
+    'DISK_LOAD': MetricCategoryDetail('DISK_LOAD', ['disk_util'], AnomalyTrend.FALL),
+}
+CATEGORY_PAIRS = [
+    ('PROC_CPU', 'DISK_IO'),
+    (METRIC_CATEGORY_ALL, METRIC_CATEGORY_ALL),
+    (METRIC_CATEGORY_OTHER, 'DISK_LOAD'),
+    ('PROC_IO', VirtualMetricCategory.IO_LOAD.value),
+]
+FROM_METRICS = ['cpu_util', 'cpu_wait', 'io_wait', 'proc_other_1', 'proc_other_2']
+TO_METRICS = ['disk_r_await', 'disk_w_await', 'disk_util', 'disk_other']
+
+
+def baseline_avail_causal_relations(real_from_metrics: list, real_to_metrics: list) -> list:
+    """原始实现：每次按指标分类逐个分组，不缓存"""
+    def group_metrics(metrics, categories):
+        parts = {}
+        for cate_type, cate_detail in categories.items():
+            part = [metric for metric in metrics if metric in cate_detail.metrics]
+            if part:
+                parts[cate_type] = part
+        other_part = [metric for metric in metrics if all(metric not in part for part in parts.values())]
+        if other_part:
+            parts[METRIC_CATEGORY_OTHER] = other_part
+        for virtual_cate_type, virtual_metric_id in virtual_metric_id_map.items():
+            parts.setdefault(virtual_cate_type, [virtual_metric_id])
+        return parts
+
+    def with_trend(metric_group, categories):
+        cate_detail = categories.get(metric_group.get('cate_type'))
+        if cate_detail is not None:
+            metric_group.setdefault('trend', cate_detail.trend)
+        return metric_group
+
+    from_groups = group_metrics(real_from_metrics, FROM_CATEGORIES)
+    to_groups = group_metrics(real_to_metrics, TO_CATEGORIES)
+    causal_relations = []
+    for from_cate, to_cate in CATEGORY_PAIRS:
+        for from_group in RuleMeta.aggregate_metric_from_groups(from_cate, from_groups):
+            for to_group in RuleMeta.aggregate_metric_from_groups(to_cate, to_groups):
+                causal_relations.append((with_trend(from_group, FROM_CATEGORIES), with_trend(to_group, TO_CATEGORIES)))
+    return causal_relations
+
+
+def new_rule_meta() -> RuleMeta:
+    return RuleMeta(EntityType.PROCESS.value, EntityType.DISK.value, FROM_CATEGORIES, TO_CATEGORIES,
+                    [MetricCategoryPair(from_cate, to_cate) for from_cate, to_cate in CATEGORY_PAIRS])
+
+
+def test_memoized_relations_match_baseline_in_any_order():
+    rnd = random.Random(0)
+    rule_meta = new_rule_meta()
+
+    for _ in range(50):
+        from_metrics = rnd.sample(FROM_METRICS, rnd.randint(0, len(FROM_METRICS)))
+        to_metrics = rnd.sample(TO_METRICS, rnd.randint(0, len(TO_METRICS)))
+        # 同一指标集合的不同输入顺序共享缓存的模板，输出仍与按该顺序直接计算的结果相同
+        for _ in range(3):
+            rnd.shuffle(from_metrics)
+            rnd.shuffle(to_metrics)
+            assert rule_meta.get_avail_causal_relations(from_metrics, to_metrics) == \
+                baseline_avail_causal_relations(from_metrics, to_metrics)
+
+
+def test_memoized_relations_are_copies():
+    rule_meta = new_rule_meta()
+    expected = baseline_avail_causal_relations(FROM_METRICS, TO_METRICS)
+
+    relations = rule_meta.get_avail_causal_relations(FROM_METRICS, TO_METRICS)
+    # 与 CausalGraph.filter_metric_group_by_trend 相同，替换分组中的指标列表，并原地修改
+    for from_group, to_group in relations:
+        from_group['metrics'] = []
+        to_group.get('metrics').clear()
+        to_group['trend'] = None
+
+    assert rule_meta.get_avail_causal_relations(FROM_METRICS, TO_METRICS) == expected
+    assert rule_meta.get_avail_causal_relations(list(reversed(FROM_METRICS)), TO_METRICS) == \
+        baseline_avail_causal_relations(list(reversed(FROM_METRICS)), TO_METRICS)
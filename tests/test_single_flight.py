@@ -0,0 +1,104 @@
+"""
+合并并发请求测试：并发的相同请求只调用一次，等待的请求共享结果或异常，调用完成后不缓存结果。
+"""
+import threading
+import time
+
+import pytest
+
+from cause_inference.single_flight import SingleFlight, freeze_key
+
+WAIT_TIMEOUT = 5
+
+
+class BlockingFunc:
+    """调用后阻塞，直到 release"""
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.released = threading.Event()
+
+    def __call__(self, *args):
+        self.calls += 1
+        self.released.wait(WAIT_TIMEOUT)
+        if self.error is not None:
+            raise self.error
+        return self.result, args
+
+
+def run_concurrently(flight: SingleFlight, func: BlockingFunc, key, num) -> list:
+    """num 个线程同时以相同的键调用，所有线程都进入 do 后再放行，返回各线程的结果或异常"""
+    results = [None] * num
+
+    def worker(idx):
+        try:
+            results[idx] = flight.do(key, func, idx)
+        except Exception as ex:
+            results[idx] = ex
+
+    threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(num)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    while flight.stats().get('calls') + flight.stats().get('deduplicated') < num:
+        assert time.time() - start < WAIT_TIMEOUT
+        time.sleep(0.01)
+    func.released.set()
+    for thread in threads:
+        thread.join(WAIT_TIMEOUT)
+    return results
+
+
+def test_concurrent_calls_invoke_once():
+    flight = SingleFlight('test', report_interval=0)
+    func = BlockingFunc(result='topo')
+
+    results = run_concurrently(flight, func, ('host_topo', 'm1'), 5)
+
+    assert func.calls == 1
+    # 所有调用共享领先者的结果，包括其调用参数
+    assert len({id(res) for res in results}) == 1
+    assert results[0][0] == 'topo'
+    assert flight.stats() == {'calls': 1, 'deduplicated': 4}
+
+
+def test_followers_reraise_leader_error():
+    flight = SingleFlight('test', report_interval=0)
+    error = ValueError('query failed')
+    func = BlockingFunc(error=error)
+
+    results = run_concurrently(flight, func, 'key', 4)
+
+    assert func.calls == 1
+    assert all(res is error for res in results)
+    assert flight.stats() == {'calls': 1, 'deduplicated': 3}
+
+
+def test_completed_calls_not_cached():
+    flight = SingleFlight('test', report_interval=0)
+    func = BlockingFunc(result='topo')
+    func.released.set()
+
+    assert flight.do('key', func, 0) == ('topo', (0,))
+    assert flight.do('key', func, 1) == ('topo', (1,))
+    assert flight.do('other', func, 2) == ('topo', (2,))
+
+    assert func.calls == 3
+    assert flight.stats() == {'calls': 3, 'deduplicated': 0}
+
+
+def test_error_call_removed_from_flight():
+    flight = SingleFlight('test', report_interval=0)
+    func = BlockingFunc(error=ValueError('query failed'))
+    func.released.set()
+
+    with pytest.raises(ValueError):
+        flight.do('key', func)
+    func.error = None
+    assert flight.do('key', func) == (None, ())
+
+
+def test_freeze_key():
+    assert freeze_key({'b': [1, 2], 'a': {'c': 1}}) == freeze_key({'a': {'c': 1}, 'b': (1, 2)})
+    assert hash(freeze_key({'a': [{1, 2}]})) == hash(freeze_key({'a': [{2, 1}]}))
@@ -0,0 +1,45 @@
+"""
+因果骨架缓存测试：观测元数据更新后，按旧元数据预热的因果骨架不再命中。
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from spider.conf.observe_meta import ObserveMetaMgt
+
+from cause_inference.skeleton import SkeletonCache
+
+_TS = 1700000000
+
+
+@pytest.fixture
+def observe_meta_map(monkeypatch):
+    observe_meta_map = {}
+    monkeypatch.setattr(ObserveMetaMgt(), 'observe_meta_map', observe_meta_map)
+    return observe_meta_map
+
+
+def test_skeleton_cache_misses_after_metadata_update(observe_meta_map):
+    cache = SkeletonCache()
+    skeleton = object()
+    cache.put(_TS, {'m1': skeleton})
+    assert cache.has_topo(_TS)
+    assert cache.get('m1', _TS) is skeleton
+
+    observe_meta_map['proc'] = SimpleNamespace(keys=['machine_id', 'tgid'], labels=['comm'])
+    assert not cache.has_topo(_TS)
+    assert cache.get('m1', _TS) is None
+
+    # 按新的元数据重新预热后命中
+    new_skeleton = object()
+    cache.put(_TS, {'m1': new_skeleton})
+    assert cache.get('m1', _TS) is new_skeleton
+
+
+def test_skeleton_cache_keeps_max_topo_num(observe_meta_map):
+    cache = SkeletonCache(max_topo_num=2)
+    for i in range(3):
+        cache.put(_TS + i, {'m1': object()})
+
+    assert not cache.has_topo(_TS)
+    assert cache.has_topo(_TS + 1) and cache.has_topo(_TS + 2)
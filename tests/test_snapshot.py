@@ -0,0 +1,95 @@
+"""
+状态快照测试：位移在消息处理完成后才记录，从快照恢复后重复消费的异常KPI不会重复定位。
+"""
+import json
+import time
+
+import pytest
+
+from cause_inference.abnormal_event import AbnEvtMgt
+from cause_inference.evt_consumer import EvtConsumeThread
+from cause_inference.inproc_kafka import InprocBroker, InprocConsumer, InprocProducer
+from cause_inference.model import AbnormalEvent
+from cause_inference.snapshot import SnapshotThread, evt_from_dict, evt_to_dict, get_snapshot_offsets, load_snapshot
+
+KPI_TOPIC = 'gala_anteater_hybrid_model'
+KPI_GROUP_ID = 'abn-kpi-inference'
+CONSUMER_TO = 0.05
+VALID_DURATION = 120
+FUTURE_DURATION = 60
+AGING_DURATION = 600
+
+
+def gen_kpi_evt(ts, event_id):
+    return {
+        'Timestamp': ts,
+        'Attributes': {'entity_id': 'proc_1', 'event_id': event_id, 'event_type': 'app'},
+        'Resource': {'metric': 'gala_gopher_sli_rtt_nsec', 'labels': {}, 'score': 1.0},
+    }
+
+
+class StubRecorder:
+    def get_all(self):
+        return []
+
+
+@pytest.fixture
+def now_ms():
+    return int(time.time() * 1000)
+
+
+@pytest.fixture
+def kpi_consumer(now_ms):
+    broker = InprocBroker()
+    broker.create_topic(KPI_TOPIC, 1)
+    producer = InprocProducer(broker=broker)
+    for i in range(3):
+        data = gen_kpi_evt(now_ms + i, 'kpi_{}'.format(i))
+        producer.send(KPI_TOPIC, json.dumps(data).encode(), timestamp_ms=data.get('Timestamp'))
+    consume_thread = EvtConsumeThread(InprocConsumer(KPI_TOPIC, group_id=KPI_GROUP_ID, broker=broker), KPI_TOPIC,
+                                      CONSUMER_TO, stats_interval=0)
+    consume_thread.poll_once()
+    return consume_thread
+
+
+def new_abn_evt_mgt(kpi_consumer) -> AbnEvtMgt:
+    return AbnEvtMgt(kpi_consumer, None, VALID_DURATION, FUTURE_DURATION, AGING_DURATION)
+
+
+def test_offset_recorded_after_processing(kpi_consumer):
+    data = kpi_consumer.wait(0)
+    assert data is not None
+    # 消息还在处理中，快照不应包含该消息的位移
+    assert kpi_consumer.get_delivered_offsets() == {}
+    kpi_consumer.ack()
+    assert kpi_consumer.get_delivered_offsets() == {0: 1}
+
+
+def test_snapshot_offsets_match_pending_kpis(kpi_consumer, tmp_path):
+    abn_evt_mgt = new_abn_evt_mgt(kpi_consumer)
+    abn_evt_mgt.wait_kpi_evts(0)
+
+    path = str(tmp_path / 'snapshot.gz')
+    SnapshotThread(path, 1, abn_evt_mgt, StubRecorder()).save()
+    state = load_snapshot(path)
+
+    assert get_snapshot_offsets(state, KPI_TOPIC) == {0: 3}
+    assert [evt.get('event_id') for evt in state.get('pending_kpis')] == ['kpi_0', 'kpi_1', 'kpi_2']
+
+
+def test_restored_kpis_are_not_scheduled_twice(kpi_consumer, now_ms):
+    pending_kpis = [AbnormalEvent(timestamp=now_ms + i, abnormal_metric_id='gala_gopher_sli_rtt_nsec',
+                                  abnormal_entity_id='proc_1', event_id='kpi_{}'.format(i)) for i in range(2)]
+    abn_evt_mgt = new_abn_evt_mgt(kpi_consumer)
+    abn_evt_mgt.restore([], [evt_from_dict(evt_to_dict(evt)) for evt in pending_kpis])
+    # 快照之后的位移还未确认，恢复后重复消费 kpi_0 和 kpi_1
+    abn_evt_mgt.wait_kpi_evts(0)
+
+    assert [abn_kpi.event_id for abn_kpi in abn_evt_mgt.get_pending_kpis()] == ['kpi_0', 'kpi_1', 'kpi_2']
+
+    # 异常KPI取出后，同一事件ID的新消息可以再次进入等待
+    ready_ts = now_ms + FUTURE_DURATION * 1000
+    abn_evt_mgt.metric_idle_ts = ready_ts
+    assert abn_evt_mgt.pop_ready_kpi(ready_ts).event_id == 'kpi_0'
+    abn_evt_mgt.schedule_kpi(pending_kpis[0])
+    assert len(abn_evt_mgt.get_pending_kpis()) == 3
@@ -0,0 +1,88 @@
+"""
+根因定位工作线程池测试：待处理事件数达到上限时提交阻塞，失败的任务记录错误日志，退出时先等待任务完成再关闭结果发送。
+"""
+import json
+import logging
+import threading
+import time
+
+from cause_inference.__main__ import InferWorkerPool
+from cause_inference.cause_sender import CauseSender
+from cause_inference.inproc_kafka import InprocBroker, InprocProducer
+
+CAUSE_TOPIC = 'gala_cause_inference'
+
+
+def test_submit_blocks_when_slots_exhausted():
+    release = threading.Event()
+    handled = []
+
+    def handler(idx):
+        release.wait(5)
+        handled.append(idx)
+
+    pool = InferWorkerPool(1, handler)
+    # 1 个工作线程时最多有 2 个待处理的事件
+    pool.submit('evt_0', 0)
+    pool.submit('evt_1', 1)
+    submit_thread = threading.Thread(target=pool.submit, args=('evt_2', 2))
+    submit_thread.start()
+    submit_thread.join(0.2)
+    assert submit_thread.is_alive()
+
+    release.set()
+    submit_thread.join(5)
+    assert not submit_thread.is_alive()
+    pool.shutdown()
+    assert handled == [0, 1, 2]
+
+
+def test_failed_inference_logged(caplog):
+    def handler(idx):
+        if idx == 1:
+            raise ValueError('bad event')
+
+    pool = InferWorkerPool(1, handler)
+    with caplog.at_level(logging.ERROR):
+        for idx in range(3):
+            pool.submit('evt_{}'.format(idx), idx)
+        pool.shutdown()
+
+    errors = [record.getMessage() for record in caplog.records if record.levelno == logging.ERROR]
+    assert errors == ['Cause inference failed, event_id=evt_1, because bad event']
+    # 失败的任务也释放了待处理事件的空位
+    assert pool.slots.acquire(blocking=False) and pool.slots.acquire(blocking=False)
+
+
+class ClosableProducer(InprocProducer):
+    def __init__(self, **configs):
+        super().__init__(**configs)
+        self.closed = False
+
+    def send(self, topic, value=None, key=None, partition=None, timestamp_ms=None):
+        assert not self.closed, 'send after producer closed'
+        return super().send(topic, value, key, partition, timestamp_ms)
+
+    def close(self, timeout=None):
+        self.closed = True
+
+
+def test_shutdown_drains_before_sender_close():
+    broker = InprocBroker()
+    cause_sender = CauseSender(ClosableProducer(broker=broker), CAUSE_TOPIC)
+
+    def handler(idx):
+        time.sleep(0.05)
+        cause_sender.send({'Attributes': {'event_id': 'evt_{}'.format(idx)}})
+
+    pool = InferWorkerPool(2, handler)
+    for idx in range(4):
+        pool.submit('evt_{}'.format(idx), idx)
+    # 与服务退出时的顺序一致
+    pool.shutdown()
+    cause_sender.close()
+
+    records = broker.topics.get(CAUSE_TOPIC)[0]
+    assert sorted(json.loads(record.value).get('Attributes').get('event_id') for record in records) == \
+        ['evt_0', 'evt_1', 'evt_2', 'evt_3']
+    assert cause_sender.stats.delivered == 4